@@ -0,0 +1,73 @@
+"""
+Invoice archive: renders a seller's invoices with the real renderer (so each
+PDF embeds the logo and font subsets, like invoiceFiles), moves them to the
+archive, and reports the bytes saved, the time to archive and the cost of
+re-delivering an archived invoice compared with reading the plain file.
+
+    python benchmarks/bench_archive.py --invoices 100
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from common import SAMPLE_SELLER, ROOT, load_bot, make_items
+
+USER_ID = '53017412'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--invoices', type=int, default=100)
+    parser.add_argument('--customers', type=int, default=10)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='kahroba-archive-')
+    bot = load_bot(workdir)
+    bot.INVOICE_DIR = os.path.join(workdir, 'invoiceFiles')
+    bot.invoice_archive.root = os.path.join(workdir, 'invoiceArchive')
+    logos = os.path.join(workdir, 'logos')
+    shutil.copytree(os.path.join(ROOT, 'logos'), logos)
+    bot.LOGO_DIR = logos
+    bot.init_storage()
+    bot.font_registry.load()
+
+    entries = []
+    for i in range(args.invoices):
+        code = f'CUST{i % args.customers:03d}'
+        customer = {'name': f'مشتری {i % args.customers}', 'phone': '09120000000', 'address': 'تهران', 'code': code}
+        items = make_items(3 + i % 8)
+        invoice = bot.price_invoice(items)
+        number = f'2501021200{code}-{i}'
+        file_path = bot.generate_invoice_pdf(items, USER_ID, customer, SAMPLE_SELLER, invoice, number)
+        entries.append(bot.invoice_ledger_entry(USER_ID, number, customer, invoice, file_path, time.time() - 86400))
+    bot.record_invoices(entries).result()
+    paths = [entry.file_path for entry in entries]
+    originals = {path: open(path, 'rb').read() for path in paths}
+
+    started = time.perf_counter()
+    hot = sum(bot.open_invoice(path).read() == originals[path] for path in paths)
+    hot_time = (time.perf_counter() - started) / len(paths)
+
+    started = time.perf_counter()
+    while bot.archive_old_invoices(0):
+        pass
+    archive_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    cold = sum(bot.open_invoice(path).read() == originals[path] for path in paths)
+    cold_time = (time.perf_counter() - started) / len(paths)
+    assert hot == cold == len(paths), (hot, cold)
+
+    report = bot.archive_report()
+    print(f'{len(paths)} invoices, {report["archived_bytes"] / 1e6:.2f} MB as PDF files '
+          f'-> {report["stored_bytes"] / 1e6:.2f} MB archived ({report["chunks"]} unique streams); '
+          f'saved {report["saved_bytes"] / 1e6:.2f} MB')
+    print(f'archiving: {archive_time / len(paths) * 1e3:.2f} ms per invoice | re-delivery read: '
+          f'plain file {hot_time * 1e3:.2f} ms, archived {cold_time * 1e3:.2f} ms (byte-identical)')
+    bot.close_storage()
+
+
+if __name__ == '__main__':
+    main()
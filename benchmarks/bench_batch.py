@@ -0,0 +1,38 @@
+"""
+Throughput of batch invoice export (invoices per second) for different
+numbers of render workers.
+
+    python benchmarks/bench_batch.py --drafts 64 --workers 1 2 4
+"""
+import argparse
+import io
+import os
+import time
+
+from common import SAMPLE_CUSTOMER, SAMPLE_SELLER, load_bot, make_items
+
+USER_ID = '53017412'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--drafts', type=int, default=32)
+    parser.add_argument('--items', type=int, default=8)
+    parser.add_argument('--workers', type=int, nargs='+', default=sorted({1, os.cpu_count() or 1}))
+    args = parser.parse_args()
+
+    bot = load_bot()
+    bot.font_registry.load()
+    resolved = [(make_items(args.items), dict(SAMPLE_CUSTOMER, code=f'CUST{i:03d}')) for i in range(args.drafts)]
+
+    print(f'{args.drafts} drafts x {args.items} items')
+    for workers in args.workers:
+        out = io.BytesIO()
+        started = time.perf_counter()
+        count, _ = bot.render_invoice_batch(resolved, USER_ID, SAMPLE_SELLER, out, workers)
+        elapsed = time.perf_counter() - started
+        print(f'workers={workers:2}: {count / elapsed:7.1f} invoices/s  zip={len(out.getvalue()) / 1e6:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
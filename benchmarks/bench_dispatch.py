@@ -0,0 +1,118 @@
+"""
+Microbenchmark for per-update dispatch: the old main() registered a chain of
+regex MessageHandlers plus catch-all text handlers, and main_handler then
+tried five state handlers in turn, each reloading the user JSON file before
+checking `state`. The router reads the state once and does a table lookup.
+
+    python benchmarks/bench_dispatch.py --rounds 100
+"""
+import argparse
+import datetime
+import json
+import os
+import tempfile
+import time
+
+from telegram import Chat, Message, Update, User
+from telegram.ext import CommandHandler, MessageHandler, filters
+
+from common import load_bot, make_user_record
+
+USER_ID = 1000
+
+
+async def noop(update, context):
+    pass
+
+
+def legacy_handlers():
+    # Same filters, in the same order, as the old main()
+    handlers = [CommandHandler('start', noop), MessageHandler(filters.CONTACT, noop)]
+    for text in ('مشاهده محصولات', 'افزودن محصول', 'صدور فاکتور', 'آپلود لوگوی فروشگاه',
+                 'افزودن آیتم', 'افزودن مشتری', 'مشاهده مشتریان', 'انتخاب مشتری'):
+        handlers.append(MessageHandler(filters.Regex(f'^{text}$'), noop))
+    handlers += [
+        MessageHandler(filters.Regex(r'.*\(ID:.*\)'), noop),
+        MessageHandler(filters.Regex(r'^[Qq]\d+$'), noop),
+        MessageHandler(filters.Regex(r'^[Cc]\d+$'), noop),
+        MessageHandler(filters.PHOTO, noop),
+        CommandHandler('batch', noop),
+        MessageHandler(filters.Document.ALL, noop),
+    ]
+    main_handler = MessageHandler(filters.TEXT & ~filters.COMMAND, noop)
+    handlers.append(main_handler)
+    return handlers, main_handler
+
+
+# States tried by the old main_handler, in order
+LEGACY_CHAIN = ['adding_product', 'adding_customer', 'selecting_customer', 'awaiting_store_info', 'adding_item']
+
+
+def make_update(update_id, text):
+    user = User(USER_ID, 'bench', False)
+    chat = Chat(USER_ID, Chat.PRIVATE)
+    message = Message(update_id, datetime.datetime.now(datetime.timezone.utc), chat, from_user=user, text=text)
+    return Update(update_id, message=message)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=100)
+    parser.add_argument('--users', type=int, default=50, help='users in the legacy JSON file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='kahroba-bench-')
+    bot = load_bot(workdir)
+    bot.init_storage()
+    record = make_user_record(USER_ID)
+    bot.save_user_data(USER_ID, dict(record))
+
+    # The old storage: one JSON file holding every user
+    json_path = os.path.join(workdir, 'user_data.json')
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump({str(USER_ID + i): record for i in range(args.users)}, f, ensure_ascii=False)
+
+    handlers, main_handler = legacy_handlers()
+
+    def legacy_dispatch(update, state):
+        for handler in handlers:
+            if handler.check_update(update):
+                break
+        if handler is main_handler:
+            for wanted in LEGACY_CHAIN:
+                with open(json_path, 'r', encoding='utf-8') as f:
+                    user_state = json.load(f).get(str(USER_ID), {}).get('state')
+                if user_state == wanted:
+                    break
+
+    def router_dispatch(update, state):
+        bot.resolve_route(update)
+
+    scenarios = [
+        ('menu button', 'افزودن آیتم', 'ready'),
+        ('quantity (q3)', 'q3', 'awaiting_quantity'),
+        ('item code in adding_item', '1000-5', 'adding_item'),
+        ('store info', 'فروشگاه، فروشنده', 'awaiting_store_info'),
+    ]
+    for label, text, state in scenarios:
+        update = make_update(1, text)
+        bot.update_user_state(USER_ID, state)
+        with open(json_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        data[str(USER_ID)]['state'] = state
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+
+        for name, dispatch in (('handler chain', legacy_dispatch), ('router', router_dispatch)):
+            dispatch(update, state)
+            started = time.perf_counter()
+            for _ in range(args.rounds):
+                dispatch(update, state)
+            per_update = (time.perf_counter() - started) / args.rounds
+            print(f'{label:26} {name:14}: {per_update * 1e6:10.1f} us per update')
+
+    bot.close_storage()
+
+
+if __name__ == '__main__':
+    main()
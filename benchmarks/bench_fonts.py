@@ -0,0 +1,52 @@
+"""
+Microbenchmark for per-invoice font setup: the old InvoicePDF.header called
+add_font('Vazir', ...) on every invoice, which re-reads Vazir.pkl from disk,
+while the font registry parses the fonts once and attaches them in memory.
+
+    python benchmarks/bench_fonts.py --rounds 500
+"""
+import argparse
+import os
+import time
+
+from fpdf import FPDF
+
+from common import load_bot
+
+
+def old_setup():
+    pdf = FPDF()
+    if os.path.exists('Vazir.ttf'):
+        pdf.add_font('Vazir', '', 'Vazir.ttf', uni=True)
+        pdf.set_font('Vazir', '', 14)
+    return pdf
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=500)
+    args = parser.parse_args()
+
+    bot = load_bot()
+
+    def new_setup():
+        pdf = bot.InvoicePDF()
+        pdf.set_font(pdf.font_name, '', 14)
+        return pdf
+
+    started = time.perf_counter()
+    bot.font_registry.load()
+    load_time = time.perf_counter() - started
+    print(f'registry load (once per process): {load_time * 1e3:8.2f} ms')
+
+    for name, setup in (('add_font per invoice', old_setup), ('font registry', new_setup)):
+        setup()
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            setup()
+        per_invoice = (time.perf_counter() - started) / args.rounds
+        print(f'{name:32}: {per_invoice * 1e6:8.1f} us per invoice')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Bulk catalog import: times parsing and applying a generated product file
+(10k rows by default, CSV and, when openpyxl is installed, XLSX) and the
+single write that stores it, against the old path where every product was a
+separate message followed by a full rewrite of the user's record. The old
+path is measured on the first --old-rows rows and extrapolated.
+
+    python benchmarks/bench_import.py --rows 10000
+"""
+import argparse
+import csv
+import io
+import time
+import tracemalloc
+
+from common import load_bot
+
+USER_ID = '53017412'
+
+
+def product_rows(count):
+    for i in range(1, count + 1):
+        yield ('', f'کلید روشنایی هوشمند مدل {i}', str(1000 + i))
+
+
+def make_csv(count):
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(('id', 'name', 'price'))
+    writer.writerows(product_rows(count))
+    return text.getvalue().encode('utf-8-sig')
+
+
+def make_xlsx(openpyxl, count):
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet('products')
+    sheet.append(('id', 'name', 'price'))
+    for row in product_rows(count):
+        sheet.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def reset(bot):
+    bot.save_user_data(USER_ID, {'phone_number': '0912', 'store_name': 'S', 'seller_name': 'N',
+                                 'last_product_id': 0, 'products': {}})
+    bot.user_cache.flush().result()
+
+
+def bench_import(bot, name, data, filename, rows):
+    reset(bot)
+    tracemalloc.start()
+    started = time.perf_counter()
+    kind, entries, errors = bot.parse_catalog_file(io.BytesIO(data), filename)
+    parsed = time.perf_counter()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    added, _ = bot.apply_catalog_import(USER_ID, kind, entries)
+    applied = time.perf_counter()
+    bot.user_cache.flush(USER_ID).result()
+    written = time.perf_counter()
+    assert added == rows and not errors, (added, errors[:3])
+    print(f'{name:5} {len(data) / 1024:7.0f} KB | parse {(parsed - started) * 1e3:8.1f} ms '
+          f'(peak {peak / 1024 / 1024:5.1f} MB) | apply {(applied - parsed) * 1e3:6.1f} ms '
+          f'| write (1 transaction) {(written - applied) * 1e3:6.1f} ms | total {(written - started):6.2f} s')
+
+
+def bench_one_by_one(bot, rows, old_rows):
+    reset(bot)
+    started = time.perf_counter()
+    for _, name, price in product_rows(old_rows):
+        # What add_product did per message, with the record written straight away
+        user_data = bot.get_user_data(USER_ID)
+        last_product_id = user_data.get('last_product_id', 0)
+        user_data['last_product_id'] = last_product_id + 1
+        user_data['products'][f'{USER_ID}-{last_product_id + 1}'] = {'name': name, 'price': int(price)}
+        bot.save_user_data(USER_ID, user_data)
+        bot.user_cache.flush(USER_ID).result()
+    elapsed = time.perf_counter() - started
+    # Each write serializes the whole, growing record, so cost grows with the square of the count
+    estimate = elapsed * (rows / old_rows) ** 2
+    print(f'one by one: {old_rows} rows in {elapsed:.2f} s ({old_rows} transactions); '
+          f'{rows} rows would take about {estimate:.0f} s of writes alone, plus {rows * 2} chat messages')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--old-rows', type=int, default=1000)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    bot.init_storage()
+
+    bench_import(bot, 'CSV', make_csv(args.rows), 'products.csv', args.rows)
+    if bot.openpyxl is not None:
+        bench_import(bot, 'XLSX', make_xlsx(bot.openpyxl, args.rows), 'products.xlsx', args.rows)
+    else:
+        print('XLSX: openpyxl is not installed, skipped')
+    bench_one_by_one(bot, args.rows, min(args.old_rows, args.rows))
+
+    bot.close_storage()
+
+
+if __name__ == '__main__':
+    main()
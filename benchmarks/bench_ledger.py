@@ -0,0 +1,74 @@
+"""
+Finding past invoices: listing and filtering invoiceFiles/<user_id>/ by file
+name (what finding an old invoice meant before) against a ledger query by
+customer and date range, for a growing number of invoices per seller.
+
+    python benchmarks/bench_ledger.py --invoices 1000 10000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from common import load_bot
+
+USER_ID = '53017412'
+CUSTOMERS = 200
+
+
+def timed(fn, rounds):
+    fn()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        result = fn()
+    return (time.perf_counter() - started) / rounds, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--invoices', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    for count in args.invoices:
+        workdir = tempfile.mkdtemp(prefix='kahroba-ledger-')
+        user_folder = os.path.join(workdir, 'invoiceFiles', USER_ID)
+        os.makedirs(user_folder)
+        # One invoice every 10 minutes, round-robin over the customers
+        start = time.mktime((2025, 1, 1, 8, 0, 0, 0, 0, -1))
+        for i in range(count):
+            stamp = time.strftime('%y%m%d%H%M', time.localtime(start + i * 600))
+            code = f'CUST{i % CUSTOMERS:03d}'
+            open(os.path.join(user_folder, f'{stamp}{code}-{i}_مشتری {i % CUSTOMERS}.pdf'), 'wb').close()
+
+        bot = load_bot(workdir)
+        bot.INVOICE_DIR = os.path.join(workdir, 'invoiceFiles')
+        bot.save_user_data(USER_ID, {'customers': {f'CUST{i:03d}': {'name': f'مشتری {i}'} for i in range(CUSTOMERS)}})
+        bot.user_cache.flush().result()
+        started = time.perf_counter()
+        bot.init_storage()
+        backfill = time.perf_counter() - started
+
+        since = start + count * 300  # The second half of the period
+        until = since + 7 * 86400
+        wanted = 'CUST007'
+
+        def scan():
+            found = []
+            for filename in os.listdir(user_folder):
+                number = filename.split('_', 1)[0]
+                created = time.mktime(time.strptime(number[:10], '%y%m%d%H%M'))
+                if number[10:].rsplit('-', 1)[0] == wanted and since <= created < until:
+                    found.append(filename)
+            return found
+
+        scan_time, scanned = timed(scan, args.rounds)
+        query_time, queried = timed(lambda: bot.find_invoices(USER_ID, wanted, since, until), args.rounds)
+        assert len(scanned) == len(queried), (len(scanned), len(queried))
+        print(f'{count:6} invoices | directory scan: {scan_time * 1e3:8.2f} ms | ledger query: '
+              f'{query_time * 1e3:6.3f} ms | {len(queried)} found | one-off backfill: {backfill:.2f} s')
+        bot.close_storage()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Compares the old product listing (the whole catalog concatenated into one
+message, which Telegram rejects past 4096 characters) with the paged
+listing: time to the first message, its size, and the time to build the
+CSV export, for growing catalogs.
+
+    python benchmarks/bench_listing.py --sizes 40 400 4000
+"""
+import argparse
+import time
+
+from common import load_bot, make_user_record
+
+USER_ID = '53017412'
+TELEGRAM_LIMIT = 4096
+
+
+def timed(fn, rounds):
+    fn()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        result = fn()
+    return (time.perf_counter() - started) / rounds, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[40, 400, 4000])
+    parser.add_argument('--rounds', type=int, default=50)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    bot.init_storage()
+
+    for size in args.sizes:
+        record = make_user_record(USER_ID, products=size, customers=0)
+        record.pop('state')
+        bot.save_user_data(USER_ID, record)
+        products = record['products']
+
+        def old_listing():
+            product_list = "لیست محصولات شما:\n"
+            for product_id, product in products.items():
+                product_list += f"ID: {product_id}, نام: {product['name']}, قیمت: {product['price']} تومان\n"
+            return product_list
+
+        def first_page():
+            bot.get_session(USER_ID)['listing'] = None
+            return bot.listing_view(USER_ID, 'products')[0]
+
+        old_time, old_text = timed(old_listing, args.rounds)
+        new_time, new_text = timed(first_page, args.rounds)
+        next_time, _ = timed(lambda: bot.listing_view(USER_ID, 'products', 1), args.rounds)
+        csv_time, csv_buffer = timed(lambda: bot.catalog_csv('products', products), max(1, args.rounds // 10))
+        sendable = 'yes' if len(old_text) <= TELEGRAM_LIMIT else 'no'
+        with csv_buffer:
+            csv_bytes = len(csv_buffer.read())
+
+        print(f'{size:5} products | whole list: {old_time * 1e6:9.1f} us, {len(old_text):7} chars (sendable: {sendable:3}) '
+              f'| first page: {new_time * 1e6:7.1f} us, {len(new_text):5} chars '
+              f'| next page: {next_time * 1e6:7.1f} us | CSV: {csv_time * 1e3:6.2f} ms, '
+              f'{csv_bytes} bytes')
+
+    bot.close_storage()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Logo uploads and the event loop: several users upload large phone photos at
+once. Compares converting them inline on the loop (the old handler) with the
+logo workers, reporting wall time and how long a 10 ms timer was held up.
+
+    python benchmarks/bench_logo.py --uploads 8 --size 4000x3000
+"""
+import argparse
+import asyncio
+import io
+import os
+import tempfile
+import time
+
+from PIL import Image
+
+from common import load_bot
+
+
+async def probe_lag(stop, samples, interval=0.01):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+def make_photo(width, height):
+    # Noise compresses badly, like a real photo
+    image = Image.effect_noise((width, height), 40).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uploads', type=int, default=8)
+    parser.add_argument('--size', default='4000x3000')
+    args = parser.parse_args()
+
+    bot = load_bot()
+    width, height = map(int, args.size.split('x'))
+    photo = make_photo(width, height)
+    logo_dir = tempfile.mkdtemp(prefix='kahroba-logos-')
+    print(f'{args.uploads} uploads of a {width}x{height} JPEG ({len(photo) / 1e6:.1f} MB), '
+          f'{bot.LOGO_WORKERS} logo workers')
+
+    async def inline(k):
+        bot.save_logo(Image.open(io.BytesIO(photo)), os.path.join(logo_dir, f'inline-{k}.png'))
+
+    async def pipeline(k):
+        await bot.process_logo(photo, os.path.join(logo_dir, f'pipeline-{k}.png'))
+
+    async def run():
+        for name, upload in (('inline', inline), ('workers', pipeline)):
+            stop = asyncio.Event()
+            samples = []
+            probe = asyncio.create_task(probe_lag(stop, samples))
+            await asyncio.sleep(0.05)
+            started = time.perf_counter()
+            await asyncio.gather(*(upload(k) for k in range(args.uploads)))
+            elapsed = time.perf_counter() - started
+            stop.set()
+            await probe
+            print(f'{name:8} wall {elapsed:6.2f} s | loop lag max {max(samples, default=0) * 1e3:7.1f} ms')
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
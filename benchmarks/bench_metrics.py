@@ -0,0 +1,57 @@
+"""
+Overhead of the built-in instrumentation: the cost of one histogram
+observation and counter increment, of timing a whole update (with and
+without the JSON log line), and of rendering the /metrics page.
+
+    python benchmarks/bench_metrics.py --rounds 20000
+"""
+import argparse
+import asyncio
+import logging
+import time
+import types
+
+from common import load_bot
+
+
+def timed(fn, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - started) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=20000)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    logging.getLogger('invoice_bot.metrics').setLevel(logging.WARNING)  # Format the line, skip the output
+    handlers = [f'handler_{k}' for k in range(20)]
+    update = types.SimpleNamespace(update_id=1, effective_message=types.SimpleNamespace(text='سلام'))
+
+    observe = timed(lambda: bot.metrics.observe('stage_seconds', 0.003, stage='render'), args.rounds)
+    inc = timed(lambda: bot.metrics.inc('storage_reads_total', table='users'), args.rounds)
+    print(f'observe: {observe * 1e9:6.0f} ns | inc: {inc * 1e9:6.0f} ns')
+
+    async def updates(rounds):
+        for k in range(rounds):
+            async with bot.measure_update(update, 1) as record:
+                record['handler'] = handlers[k % len(handlers)]
+                bot.metrics.observe('stage_seconds', 0.001, stage='upload')
+
+    for log in (False, True):
+        bot.METRICS_LOG = log
+        started = time.perf_counter()
+        asyncio.run(updates(args.rounds))
+        per_update = (time.perf_counter() - started) / args.rounds
+        print(f'update timing{" + JSON log" if log else ""}: {per_update * 1e6:6.1f} us per update')
+
+    bot.collect_gauges()
+    render = timed(bot.metrics.render, 200)
+    print(f'/metrics page: {len(bot.metrics.render().splitlines())} lines rendered in {render * 1e3:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
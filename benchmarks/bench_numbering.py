@@ -0,0 +1,140 @@
+"""
+Invoice numbering under contention. The old numbers were the current minute
+plus the customer code, so two invoices for one customer within a minute
+got the same number and the second file overwrote the first. The sequence
+allocator hands out per-seller numbers in a database transaction; this
+hammers it from many threads (like concurrent renders) and from several
+processes sharing the database (like webhook replicas) and checks that every
+number is unique and that each seller's numbers have no gaps. It also checks
+that the number printed in a rendered invoice's header reads the same as the
+one in its file name, which the ledger and /resend use.
+
+    python benchmarks/bench_numbering.py --threads 32 --processes 4 --allocations 200
+"""
+import argparse
+import datetime
+import multiprocessing
+import os
+import re
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from common import SAMPLE_CUSTOMER, SAMPLE_SELLER, load_bot, make_items
+
+SELLERS = ['53017412', '40719258', '700001']
+PRINT_SELLER = '900001'
+
+
+def allocate_many(bot, seller, count):
+    return [int(number) for _ in range(count) for number in bot.submit_write(bot.allocate_invoice_numbers, seller).result()]
+
+
+def replica(workdir, seller, count, results):
+    bot = load_bot(workdir)
+    started = time.perf_counter()
+    numbers = allocate_many(bot, seller, count)
+    results.put((numbers, time.perf_counter() - started))
+    bot.close_storage()
+
+
+def pdf_shows(data, text):
+    # FPDF writes Unicode text as UTF-16BE strings, in display order, into the
+    # (compressed) page content streams
+    encoded = text.encode('utf-16-be')
+    for stream in re.findall(rb'stream\r?\n(.*?)endstream', data, re.S):
+        try:
+            stream = zlib.decompress(stream)
+        except zlib.error:
+            pass
+        if encoded in stream:
+            return True
+    return False
+
+
+def check_printed_number(bot):
+    """Renders one invoice with the configured INVOICE_NUMBER_FORMAT; returns failures."""
+    number = bot.submit_write(bot.allocate_invoice_numbers, PRINT_SELLER).result()[0]
+    data = bot.render_invoice_pdf(PRINT_SELLER, SAMPLE_CUSTOMER, SAMPLE_SELLER, bot.price_invoice(make_items(2)), number)
+    file_name = os.path.basename(bot.invoice_file_path(PRINT_SELLER, number, SAMPLE_CUSTOMER))
+    if not file_name.startswith(f'{number}_'):
+        return [f'file name {file_name} does not start with {number}']
+    if not pdf_shows(data, number):
+        return [f'the PDF header does not show {number} as in {file_name}']
+    print(f'printed number: {number} in the header and the file name')
+    return []
+
+
+def check(numbers_by_seller):
+    failures = []
+    for seller, numbers in numbers_by_seller.items():
+        if sorted(numbers) != list(range(1, len(numbers) + 1)):
+            failures.append(f'{seller}: {len(numbers)} numbers, {len(set(numbers))} unique')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--allocations', type=int, default=200, help='numbers per thread or process')
+    args = parser.parse_args()
+
+    # The old scheme: every invoice for CUST017 within the same minute
+    now = datetime.datetime(2025, 1, 2, 11, 48, 5)
+    old = {f"{(now + datetime.timedelta(seconds=i)).strftime('%y%m%d%H%M')}CUST017" for i in range(0, 60, 10)}
+    print(f'old scheme: 6 invoices for one customer in one minute -> {len(old)} distinct file name(s)')
+
+    workdir = tempfile.mkdtemp(prefix='kahroba-numbering-')
+    bot = load_bot(workdir)
+    bot.init_storage()
+    printed = check_printed_number(bot)
+
+    # Plain sequence numbers from here on (also in the replicas), so gaps show up
+    os.environ['INVOICE_NUMBER_FORMAT'] = bot.INVOICE_NUMBER_FORMAT = '{sequence}'
+
+    # Threads in one process, all going through the storage writer
+    total = args.threads * args.allocations
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        batches = list(pool.map(lambda i: (SELLERS[i % len(SELLERS)], allocate_many(bot, SELLERS[i % len(SELLERS)],
+                                                                                   args.allocations)),
+                                range(args.threads)))
+    elapsed = time.perf_counter() - started
+    numbers_by_seller = {}
+    for seller, numbers in batches:
+        if numbers != sorted(numbers):
+            print(f'FAILED: numbers went backwards for {seller}')
+            raise SystemExit(1)
+        numbers_by_seller.setdefault(seller, []).extend(numbers)
+    failures = printed + check(numbers_by_seller)
+    print(f'{args.threads} threads: {total} numbers in {elapsed:.2f} s ({total / elapsed:.0f}/s, '
+          f'{elapsed / total * 1e6:.0f} us each)')
+    bot.close_storage()
+
+    # Several processes on one database file, all numbering the same seller
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    seller = '800001'
+    processes = [context.Process(target=replica, args=(workdir, seller, args.allocations, results))
+                 for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    numbers = [number for batch, _ in outcomes for number in batch]
+    failures += check({seller: numbers})
+    slowest = max(seconds for _, seconds in outcomes)
+    print(f'{args.processes} processes on one seller: {len(numbers)} numbers in {slowest:.2f} s '
+          f'({len(numbers) / slowest:.0f}/s)')
+
+    if failures:
+        print(f'FAILED: {failures}')
+        raise SystemExit(1)
+    print('OK: every number unique, no gaps, never decreasing')
+
+
+if __name__ == '__main__':
+    main()
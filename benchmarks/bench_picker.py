@@ -0,0 +1,86 @@
+"""
+Compares the old product picker (one reply-keyboard button per product)
+with the paginated inline picker: time to build the reply and its JSON
+payload size, for growing catalogs. Also times a name search and the
+one-off index build, and the old linear customer scan in
+save_selected_customer against the customer index lookup.
+
+    python benchmarks/bench_picker.py --sizes 40 400 4000
+"""
+import argparse
+import json
+import time
+
+from telegram import KeyboardButton, ReplyKeyboardMarkup
+
+from common import load_bot, make_user_record
+
+USER_ID = '53017412'
+
+
+def timed(fn, rounds):
+    fn()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        result = fn()
+    return (time.perf_counter() - started) / rounds, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[40, 400, 4000])
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    bot.init_storage()
+
+    for size in args.sizes:
+        record = make_user_record(USER_ID, products=size, customers=size)
+        record.pop('state')
+        bot.save_user_data(USER_ID, record)
+        products = record['products']
+        session = bot.get_session(USER_ID)
+
+        def old_picker():
+            keyboard = [[KeyboardButton(f"{product['name']} (ID: {product_id})")]
+                        for product_id, product in products.items()]
+            return ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+
+        def new_picker(query=None):
+            session['product_query'] = query
+            return bot.product_picker(USER_ID, 0)[1]
+
+        bot.search_indexes.invalidate(USER_ID, 'products')
+        started = time.perf_counter()
+        bot.search_indexes.get(USER_ID, 'products', products, bot.PRODUCT_FIELDS)
+        build = time.perf_counter() - started
+
+        old_time, old_markup = timed(old_picker, args.rounds)
+        new_time, new_markup = timed(new_picker, args.rounds)
+        search_time, _ = timed(lambda: new_picker('مدل 12'), args.rounds)
+        old_bytes = len(json.dumps(old_markup.to_dict(), ensure_ascii=False).encode())
+        new_bytes = len(json.dumps(new_markup.to_dict(), ensure_ascii=False).encode())
+
+        print(f'{size:5} products | old: {old_time * 1e6:9.1f} us, {old_bytes:8} bytes '
+              f'| paged: {new_time * 1e6:7.1f} us, {new_bytes:5} bytes '
+              f'| search: {search_time * 1e6:7.1f} us | index build (once): {build * 1e3:6.2f} ms')
+
+        customers = record['customers']
+        wanted = customers[list(customers)[-1]]['name']
+
+        def old_lookup():
+            for customer in customers.values():
+                if customer['name'] == wanted:
+                    return customer
+
+        index = bot.customer_index(USER_ID, customers)
+        old_time, _ = timed(old_lookup, args.rounds)
+        new_time, _ = timed(lambda: index.lookup(wanted), args.rounds)
+        print(f'{size:5} customers | linear scan: {old_time * 1e6:8.1f} us | index lookup: {new_time * 1e6:6.1f} us')
+
+    bot.close_storage()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Cost of answering "صدور فاکتور": the text preview shown now (priced once,
+then served from the preview cache until the draft changes) against the full
+PDF render every press used to trigger.
+
+    python benchmarks/bench_preview.py --lines 8 40 --rounds 200
+"""
+import argparse
+import time
+
+from common import SAMPLE_CUSTOMER, SAMPLE_SELLER, load_bot, make_items
+
+USER_ID = '53017412'
+
+
+def timed(fn, rounds):
+    fn()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - started) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, nargs='+', default=[8, 40])
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--renders', type=int, default=5)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    bot.init_storage()
+    bot.font_registry.load()
+    session = bot.get_session(USER_ID)
+    session['selected_customer'] = SAMPLE_CUSTOMER
+
+    for lines in args.lines:
+        session['items'] = make_items(lines)
+
+        def fresh_preview():
+            bot.preview_cache.previews.clear()
+            return bot.draft_preview(USER_ID, session)
+
+        fresh = timed(fresh_preview, args.rounds)
+        cached = timed(lambda: bot.draft_preview(USER_ID, session), args.rounds)
+        render = timed(lambda: bot.generate_invoice_pdf(session['items'], USER_ID, SAMPLE_CUSTOMER, SAMPLE_SELLER,
+                                                        invoice_number='bench'), args.renders)
+        print(f'{lines:3}-line draft | preview: {fresh * 1e6:7.1f} us, cached: {cached * 1e6:5.1f} us '
+              f'| PDF render: {render * 1e3:7.1f} ms')
+
+    bot.close_storage()
+
+
+if __name__ == '__main__':
+    main()
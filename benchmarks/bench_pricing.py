@@ -0,0 +1,75 @@
+"""
+Pricing with the exchange-rate service: prices a draft at the current rate
+with the per-product price cache and without it (converting every line's
+catalog price again, as before), measures a rate swap, and checks that
+pricing never mixes two rates while the rate keeps changing underneath.
+
+    python benchmarks/bench_pricing.py --lines 20 --rounds 2000
+"""
+import argparse
+import threading
+import time
+from decimal import Decimal
+
+from common import load_bot, make_items
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    bot.init_storage()
+    items = make_items(args.lines)
+    cached = bot.adjusted_unit_price
+
+    def price_uncached():
+        bot.adjusted_unit_price = cached.__wrapped__
+        try:
+            return bot.price_invoice(items)
+        finally:
+            bot.adjusted_unit_price = cached
+
+    for name, price in (('uncached', price_uncached), ('cached', lambda: bot.price_invoice(items))):
+        price()
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            price()
+        elapsed = (time.perf_counter() - started) / args.rounds
+        print(f'{args.lines}-line draft, {name:8}: {elapsed * 1e6:7.1f} us per pricing')
+
+    started = time.perf_counter()
+    for k in range(100):
+        bot.submit_write(bot.rate_service.set, Decimal(84000 + k), 'bench').result()
+    print(f'rate swap (history row + cache clear): {(time.perf_counter() - started) / 100 * 1e6:.0f} us')
+
+    # Price on one thread while another keeps swapping the rate
+    stop = threading.Event()
+    mixed = priced = 0
+
+    def swapper():
+        k = 0
+        while not stop.is_set():
+            k += 1
+            bot.submit_write(bot.rate_service.set, Decimal(85000 + k % 50), 'bench').result()
+
+    thread = threading.Thread(target=swapper)
+    thread.start()
+    deadline = time.perf_counter() + 1
+    while time.perf_counter() < deadline:
+        invoice = bot.price_invoice(items)
+        priced += 1
+        expected = [bot.round_price(line.unit_price * invoice.dollar_fee) for line in invoice.lines]
+        mixed += expected != [line.adjusted_unit_price for line in invoice.lines]
+    stop.set()
+    thread.join()
+    print(f'{priced} drafts priced during rate swaps, {mixed} with mixed rates')
+    bot.close_storage()
+    if mixed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
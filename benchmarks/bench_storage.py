@@ -0,0 +1,79 @@
+"""
+Compares messages per second of the legacy whole-file user_data.json storage
+against the SQLite backend used by invoice-bot.py.
+
+A "message" is what a typical handler does: load the user record, change the
+state and save it back.
+
+    python benchmarks/bench_storage.py --users 2000 --messages 300
+"""
+import argparse
+import json
+import os
+import random
+import time
+
+from common import load_bot, make_user_record
+
+
+def legacy_save_user_data(path, user_id, data):
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            user_data = json.load(file)
+    else:
+        user_data = {}
+
+    user_data[str(user_id)] = data
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(user_data, file, ensure_ascii=False, indent=4)
+
+
+def legacy_get_user_data(path, user_id):
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            user_data = json.load(file)
+            return user_data.get(str(user_id), {})
+    return {}
+
+
+def run(get, save, user_ids, messages):
+    started = time.perf_counter()
+    for _ in range(messages):
+        user_id = random.choice(user_ids)
+        data = get(user_id)
+        data['state'] = random.choice(['ready', 'adding_item', 'awaiting_quantity'])
+        save(user_id, data)
+    return messages / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--products', type=int, default=200)
+    parser.add_argument('--customers', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=200)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    workdir = os.path.dirname(bot.USER_DATA_DB)
+    json_path = os.path.join(workdir, 'user_data.json')
+
+    user_ids = [str(40000000 + i) for i in range(args.users)]
+    records = {user_id: make_user_record(user_id, args.products, args.customers) for user_id in user_ids}
+    with open(json_path, 'w', encoding='utf-8') as file:
+        json.dump(records, file, ensure_ascii=False, indent=4)
+    bot.migrate_user_data_json(json_path)
+
+    legacy = run(lambda u: legacy_get_user_data(json_path, u),
+                 lambda u, d: legacy_save_user_data(json_path, u, d),
+                 user_ids, args.messages)
+    sqlite = run(bot.get_user_data, bot.save_user_data, user_ids, args.messages)
+
+    size_mb = os.path.getsize(json_path) / 1e6
+    print(f'users={args.users} products/user={args.products} customers/user={args.customers} json={size_mb:.1f} MB')
+    print(f'legacy json : {legacy:10.1f} msg/s')
+    print(f'sqlite (WAL): {sqlite:10.1f} msg/s  ({sqlite / legacy:.0f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import importlib.abc
+import importlib.util
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_PATH = os.path.join(ROOT, 'invoice-bot.py')
+
+
+class BotFinder(importlib.abc.MetaPathFinder):
+    """
+    Makes `import invoice_bot` load invoice-bot.py. Render workers are started
+    with forkserver and import this module again (through the benchmark
+    script) before they unpickle functions from `invoice_bot`.
+    """
+
+    def find_spec(self, name, path, target=None):
+        if name == 'invoice_bot':
+            return importlib.util.spec_from_file_location(name, BOT_PATH)
+        return None
+
+
+sys.meta_path.append(BotFinder())
+
+
+def load_bot(workdir=None):
+    """
+    Imports invoice-bot.py as the `invoice_bot` module.
+    The database, generated invoices and converted logos are pointed at
+    `workdir` so benchmarks never touch the real user data. Fonts and logos
+    are read from the repository root.
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix='kahroba-bench-')
+    os.environ['USER_DATA_DB'] = os.path.join(workdir, 'user_data.db')
+    os.environ['INVOICE_DIR'] = os.path.join(workdir, 'invoiceFiles')
+    os.environ['LOGO_CACHE_DIR'] = os.path.join(workdir, 'logoCache')
+    os.chdir(ROOT)
+    spec = importlib.util.spec_from_file_location('invoice_bot', BOT_PATH)
+    bot = importlib.util.module_from_spec(spec)
+    sys.modules['invoice_bot'] = bot
+    spec.loader.exec_module(bot)
+    return bot
+
+
+def make_user_record(user_id, products=200, customers=100):
+    return {
+        'phone_number': '+989120000000',
+        'state': 'ready',
+        'store_name': 'خانه هوشمند کهربا',
+        'seller_name': 'فروشنده نمونه',
+        'last_product_id': products,
+        'products': {
+            f'{user_id}-{i}': {'name': f'کلید روشنایی هوشمند مدل {i}', 'price': 27.75 + i}
+            for i in range(1, products + 1)
+        },
+        'customers': {
+            f'CUST{i:03d}': {'name': f'مشتری {i}', 'phone': '09120000000', 'address': 'تهران', 'code': f'CUST{i:03d}'}
+            for i in range(1, customers + 1)
+        },
+    }
+
+
+SAMPLE_CUSTOMER = {'name': 'جناب آقای ساغری', 'phone': '09123456789', 'address': 'خیابان حجاب', 'code': 'CUST017'}
+SAMPLE_SELLER = {'store_name': 'خانه هوشمند کهربا', 'seller_name': 'اکبری نژاد'}
+
+
+def make_items(count=8):
+    return [(f'کلید روشنایی هوشمند {i} پل تویا مدل وای‌فای', i % 4 + 1, 27.75 + i) for i in range(count)]
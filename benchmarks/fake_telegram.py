@@ -0,0 +1,274 @@
+"""
+Load harness for webhook mode. Starts a fake Telegram Bot API, runs one or
+more bot replicas in webhook mode against it (sharing one database when
+there are several), and lets many simulated users talk to the bot at once:
+every update is POSTed to a replica round-robin, like a load balancer would,
+and each user sends the next message only after the bot has answered.
+
+Each user adds a customer and a few products and items, asks for an invoice
+and presses the confirm button under the preview. As soon as every
+confirmation is accepted the replicas are sent
+SIGTERM, so the run also checks that shutdown drains in-flight renders.
+Finally the database is checked for lost updates.
+
+Needs python-telegram-bot[webhooks] (tornado).
+
+    python benchmarks/fake_telegram.py --users 50 --rounds 3 --replicas 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import signal
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.web import Application, RequestHandler
+
+from common import BOT_PATH, ROOT
+
+TOKEN = '123456:FAKE-TOKEN'
+FONT_FILES = ('Vazir.ttf', 'Vazir-Bold.ttf', 'Vazir.pkl', 'Vazir-Bold.pkl', 'Vazir.cw127.pkl')
+SECRET = 'load-test-secret'
+ME = {'id': 123456, 'is_bot': True, 'first_name': 'Kahroba', 'username': 'kahroba_fake_bot',
+      'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+
+
+class FakeAPI:
+    """Answers Bot API calls and hands each reply to the user waiting for it."""
+
+    def __init__(self):
+        self.replies = {}  # chat id -> asyncio.Queue of method names
+        self.buttons = {}  # chat id -> callback data of the last inline keyboard sent
+        self.calls = 0
+
+    def queue(self, chat_id):
+        return self.replies.setdefault(int(chat_id), asyncio.Queue())
+
+    def handle(self, method, params):
+        self.calls += 1
+        method = method.lower()
+        if method == 'getme':
+            return ME
+        if method in ('setwebhook', 'deletewebhook', 'answercallbackquery'):
+            return True
+        chat_id = int(params.get('chat_id', 0))
+        markup = params.get('reply_markup')
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        if markup and 'inline_keyboard' in markup:
+            self.buttons[chat_id] = [button.get('callback_data') for row in markup['inline_keyboard'] for button in row]
+        self.queue(chat_id).put_nowait(method)
+        return {'message_id': self.calls, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', '')}
+
+
+class BotAPIHandler(RequestHandler):
+    def initialize(self, api):
+        self.api = api
+
+    def post(self, token, method):
+        params = {name: self.get_body_argument(name) for name in self.request.body_arguments}
+        if not params and self.request.body and self.request.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(self.request.body)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'ok': True, 'result': self.api.handle(method, params)}))
+
+    get = post
+
+
+def prepare_workdir(workdir):
+    # Replicas run in the workdir, so every relative data path (logos, their
+    # converted copies, the archive, profiles) is created there and the
+    # repository is never written to; only the fonts are copied in
+    for name in FONT_FILES:
+        shutil.copy(os.path.join(ROOT, name), workdir)
+
+
+def replica_env(args, workdir, api_port, port):
+    env = dict(os.environ)
+    env.update({
+        'BOT_MODE': 'webhook',
+        'BOT_TOKEN': TOKEN,
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{api_port}/bot',
+        'WEBHOOK_LISTEN': '127.0.0.1',
+        'WEBHOOK_PORT': str(port),
+        'WEBHOOK_URL': f'http://127.0.0.1:{port}',
+        'WEBHOOK_SECRET': SECRET,
+        'USER_DATA_DB': os.path.join(workdir, 'user_data.db'),
+        'INVOICE_DIR': os.path.join(workdir, 'invoiceFiles'),
+        'LOGO_DIR': os.path.join(workdir, 'logos'),
+        'LOGO_CACHE_DIR': os.path.join(workdir, 'logoCache'),
+        'SHARED_STORAGE': '1' if args.replicas > 1 else '0',
+        'RENDER_QUEUE_LIMIT': str(args.users),
+    })
+    return env
+
+
+def user_script(user_id, rounds):
+    # (text, Bot API methods to wait for, in order; other replies in between are skipped)
+    yield 'افزودن مشتری', ['sendmessage']
+    yield f'مشتری {user_id} - 09120000000 - تهران - C{user_id}', ['sendmessage']
+    yield 'انتخاب مشتری', ['sendmessage']
+    yield f'مشتری {user_id}', ['sendmessage', 'sendmessage']
+    for k in range(1, rounds + 1):
+        yield 'افزودن محصول', ['sendmessage']
+        yield f'کالا {k}-{1000 + k}', ['sendmessage']
+        yield 'افزودن آیتم', ['sendmessage']
+        yield f'کالا {k} (ID: {user_id}-{k})', ['sendmessage']
+        yield f'q{k}', ['sendmessage']
+    yield 'صدور فاکتور', ['sendmessage']  # The preview, with confirm and cancel buttons
+    yield 'invoice:confirm', None  # Answered after SIGTERM, see run()
+
+
+async def wait_for(queue, methods, timeout):
+    for method in methods:
+        while await asyncio.wait_for(queue.get(), timeout) != method:
+            pass
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))] if samples else 0
+
+
+def check_database(workdir, users, rounds):
+    failures = []
+    db = sqlite3.connect(os.path.join(workdir, 'user_data.db'))
+    records = {user_id: json.loads(data) for user_id, data in db.execute('SELECT user_id, data FROM users')}
+    sessions = {user_id: json.loads(data) for user_id, data in db.execute('SELECT user_id, data FROM sessions')}
+    db.close()
+    for user_id in map(str, users):
+        record = records.get(user_id, {})
+        if len(record.get('products', {})) != rounds or record.get('last_product_id') != rounds:
+            failures.append(f'{user_id}: {len(record.get("products", {}))} products')
+        if f'C{user_id}' not in record.get('customers', {}):
+            failures.append(f'{user_id}: customer missing')
+        if sessions.get(user_id, {}).get('items'):
+            failures.append(f'{user_id}: draft not cleared after the invoice')
+        invoice_dir = os.path.join(workdir, 'invoiceFiles', user_id)
+        if not os.path.isdir(invoice_dir) or len(os.listdir(invoice_dir)) != 1:
+            failures.append(f'{user_id}: invoice file missing')
+    return failures
+
+
+async def run(args, workdir):
+    api = FakeAPI()
+    server = Application([(r'/bot([^/]+)/(\w+)', BotAPIHandler, {'api': api})]).listen(args.api_port, '127.0.0.1')
+
+    ports = [args.port + i for i in range(args.replicas)]
+    replicas = [subprocess.Popen([sys.executable, BOT_PATH], cwd=workdir,
+                                 env=replica_env(args, workdir, args.api_port, port),
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL if args.quiet else None)
+                for port in ports]
+    client = AsyncHTTPClient(max_clients=args.connections)
+
+    # Wait until every replica has called setWebhook and is listening
+    for port in ports:
+        for _ in range(300):
+            try:
+                await client.fetch(f'http://127.0.0.1:{port}/', raise_error=False, request_timeout=1)
+                break
+            except (ConnectionError, OSError):
+                await asyncio.sleep(0.1)
+
+    users = [900000 + i for i in range(args.users)]
+    post_latency, reply_latency = [], []
+    counter = iter(range(1, 10 ** 9))
+    invoices_posted = asyncio.Event()
+    posted = [0]
+
+    async def post(user_id, text, callback_data=None):
+        update_id = next(counter)
+        sender = {'id': user_id, 'is_bot': False, 'first_name': 'load'}
+        message = {'message_id': update_id, 'date': int(time.time()), 'text': text,
+                   'chat': {'id': user_id, 'type': 'private'}}
+        if callback_data is None:
+            update = {'update_id': update_id, 'message': dict(message, **{'from': sender})}
+        else:
+            update = {'update_id': update_id, 'callback_query': {
+                'id': str(update_id), 'from': sender, 'chat_instance': str(user_id),
+                'message': message, 'data': callback_data}}
+        port = ports[update_id % len(ports)]
+        started = time.perf_counter()
+        response = await client.fetch(HTTPRequest(
+            f'http://127.0.0.1:{port}/telegram', method='POST', body=json.dumps(update),
+            headers={'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': SECRET}))
+        post_latency.append(time.perf_counter() - started)
+        assert response.code == 200
+
+    async def simulate(user_id):
+        queue = api.queue(user_id)
+        for text, methods in user_script(user_id, args.rounds):
+            started = time.perf_counter()
+            if text.startswith('invoice:'):
+                # Press the button under the preview
+                data = next(data for data in api.buttons.get(user_id, []) if data and data.startswith(text))
+                await post(user_id, '', data)
+            else:
+                await post(user_id, text)
+            if methods is None:
+                posted[0] += 1
+                if posted[0] == len(users):
+                    invoices_posted.set()
+                # The buttons are removed, then the invoice arrives as a document and a confirmation
+                await wait_for(queue, ['editmessagereplymarkup', 'senddocument', 'sendmessage'], args.timeout)
+            else:
+                await wait_for(queue, methods, args.timeout)
+            reply_latency.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    simulations = asyncio.gather(*(simulate(user_id) for user_id in users))
+    await invoices_posted.wait()
+    stop_at = time.perf_counter()
+    for replica in replicas:
+        replica.send_signal(signal.SIGTERM)
+    await simulations
+    elapsed = time.perf_counter() - started
+    exit_codes = [await asyncio.to_thread(replica.wait, args.timeout) for replica in replicas]
+    server.stop()
+
+    updates = len(post_latency)
+    print(f'{updates} updates from {len(users)} users over {args.replicas} replica(s) in {elapsed:.2f} s '
+          f'({updates / elapsed:.0f} updates/s)')
+    print(f'webhook POST   p50 {percentile(post_latency, 0.5) * 1e3:7.1f} ms  '
+          f'p99 {percentile(post_latency, 0.99) * 1e3:7.1f} ms')
+    print(f'reply latency  p50 {percentile(reply_latency, 0.5) * 1e3:7.1f} ms  '
+          f'p99 {percentile(reply_latency, 0.99) * 1e3:7.1f} ms  '
+          f'mean {statistics.mean(reply_latency) * 1e3:7.1f} ms')
+    print(f'SIGTERM to exit: {time.perf_counter() - stop_at:.2f} s, exit codes {exit_codes}')
+    return users
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=3, help='products and items per user')
+    parser.add_argument('--replicas', type=int, default=1)
+    parser.add_argument('--connections', type=int, default=64, help='concurrent webhook POSTs')
+    parser.add_argument('--port', type=int, default=18443, help='first replica port')
+    parser.add_argument('--api-port', type=int, default=18081)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--quiet', action='store_true', help='hide bot logs')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='kahroba-webhook-')
+    prepare_workdir(workdir)
+    users = asyncio.run(run(args, workdir))
+    failures = check_database(workdir, users, args.rounds)
+    if failures:
+        print(f'FAILED: {len(failures)} problems')
+        for failure in failures[:20]:
+            print('  ' + failure)
+        raise SystemExit(1)
+    print('OK: every user has their products, customer and invoice (no lost updates)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Load test for invoice rendering: measures how long the event loop stalls
+while many invoices are generated concurrently, first by calling
+generate_invoice_pdf inline (the old behaviour) and then through the
+render process pool. Also compares what a user waits for on one invoice:
+rendering to a file and reading it back for the upload (the old path)
+against rendering into memory and queueing the file write.
+
+    python benchmarks/load_render.py --invoices 32
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from common import SAMPLE_CUSTOMER, SAMPLE_SELLER, load_bot, make_items
+
+USER_ID = '53017412'
+
+
+async def probe_lag(stop, samples, interval=0.01):
+    # Measures how late a 10 ms sleep wakes up, i.e. how long the loop was blocked
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+async def measure(render, invoices):
+    stop = asyncio.Event()
+    samples = []
+    probe = asyncio.create_task(probe_lag(stop, samples))
+    await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    results = await asyncio.gather(*(render() for _ in range(invoices)), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe
+    failures = sum(isinstance(result, Exception) for result in results)
+    samples.sort()
+    p99 = samples[int(len(samples) * 0.99) - 1] if samples else 0
+    return elapsed, statistics.median(samples) if samples else 0, p99, max(samples, default=0), failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--invoices', type=int, default=32)
+    parser.add_argument('--items', type=int, default=8)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    items = make_items(args.items)
+    bot.RENDER_QUEUE_LIMIT = max(bot.RENDER_QUEUE_LIMIT, args.invoices)
+
+    async def inline():
+        return bot.generate_invoice_pdf(items, USER_ID, SAMPLE_CUSTOMER, SAMPLE_SELLER)
+
+    async def pooled():
+        return await bot.render_invoice(items, USER_ID, SAMPLE_CUSTOMER, SAMPLE_SELLER)
+
+    async def run():
+        # Warm up the pool so process start-up is not counted
+        await asyncio.gather(*(pooled() for _ in range(bot.RENDER_WORKERS)))
+        print(f'{args.invoices} concurrent invoices, {bot.RENDER_WORKERS} render workers')
+        print(f'{"mode":8} {"wall s":>8} {"lag p50 ms":>11} {"lag p99 ms":>11} {"lag max ms":>11} {"failed":>7}')
+        for name, render in (('inline', inline), ('pool', pooled)):
+            elapsed, p50, p99, worst, failures = await measure(render, args.invoices)
+            print(f'{name:8} {elapsed:8.2f} {p50 * 1e3:11.1f} {p99 * 1e3:11.1f} {worst * 1e3:11.1f} {failures:7}')
+
+    asyncio.run(run())
+
+    invoice = bot.price_invoice(items)
+
+    def via_disk():
+        file_path = bot.generate_invoice_pdf(items, USER_ID, SAMPLE_CUSTOMER, SAMPLE_SELLER, invoice, 'bench-disk')
+        with open(file_path, 'rb') as file:
+            return file.read()
+
+    def in_memory():
+        data = bot.render_invoice_pdf(USER_ID, SAMPLE_CUSTOMER, SAMPLE_SELLER, invoice, 'bench-memory')
+        bot.save_invoice_file(bot.invoice_file_path(USER_ID, 'bench-memory', SAMPLE_CUSTOMER), data)
+        return data
+
+    for name, render in (('disk', via_disk), ('memory', in_memory)):
+        render()
+        started = time.perf_counter()
+        for _ in range(args.invoices):
+            render()
+        print(f'reply path, {name:6}: {(time.perf_counter() - started) / args.invoices * 1e3:6.1f} ms per invoice')
+    bot.shutdown_render_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+Stress test for concurrent update processing: replays interleaved traffic
+from many users through PerUserUpdateProcessor and the message router, with
+a tiny user cache (so records are evicted and re-read all the time) and a
+fast flush timer. Every user adds a customer, products and invoice items in
+several steps, asks for an invoice, confirms the preview with its button
+(which awaits the render pool before it clears the draft) and then starts a
+new draft. A reordered or lost update
+shows up as a missing product, a wrong counter, a missing invoice or items
+in the wrong draft, both in memory and in the database.
+Finally one user floods the processor with slow updates while another user
+sends a single one, which must not wait behind the flood.
+
+    python benchmarks/stress_updates.py --users 50 --rounds 5
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import tempfile
+import time
+import types
+
+from telegram import CallbackQuery, Chat, Message, Update, User
+
+from common import load_bot
+
+
+class FakeBot:
+    """Stands in for telegram.Bot; replies take a random, short time."""
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+        await asyncio.sleep(random.random() * 0.002)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        if hasattr(document, 'read'):
+            document.read()
+        return await self.send_message(chat_id, None)
+
+    async def answer_callback_query(self, callback_query_id, **kwargs):
+        return True
+
+    async def edit_message_reply_markup(self, chat_id=None, message_id=None, **kwargs):
+        return await self.send_message(chat_id, None)
+
+
+def add_item(user_id, k):
+    name = f'کالا {k}'
+    yield 'افزودن محصول'
+    yield f'{name}-{1000 + k}'
+    yield 'افزودن آیتم'
+    yield f'{name} (ID: {user_id}-{k})'
+    yield f'q{k}'
+
+
+def user_script(bot, user_id, rounds):
+    yield 'افزودن مشتری'
+    yield f'مشتری {user_id} - 09120000000 - تهران - C{user_id}'
+    yield 'انتخاب مشتری'
+    yield f'مشتری {user_id}'
+    for k in range(1, rounds + 1):
+        yield from add_item(user_id, k)
+    yield 'صدور فاکتور'
+    # The button under the preview carries the fingerprint of the expected draft
+    items = [(f'کالا {k}', k, 1000 + k) for k in range(1, rounds + 1)]
+    customer = {'code': f'C{user_id}', 'name': f'مشتری {user_id}'}
+    fingerprint = bot.draft_fingerprint(items, customer, bot.rate_service.get().version)
+    yield CallbackQuery(str(user_id), User(user_id, 'stress', False), 'stress',
+                        data=f'invoice:confirm:{fingerprint}')
+    # The next draft must survive the previous invoice's render
+    yield from add_item(user_id, rounds + 1)
+
+
+def interleave(scripts, seed):
+    # Random merge that keeps each user's own messages in order
+    rng = random.Random(seed)
+    pending = {user_id: list(script) for user_id, script in scripts.items()}
+    while pending:
+        user_id = rng.choice(list(pending))
+        yield user_id, pending[user_id].pop(0)
+        if not pending[user_id]:
+            del pending[user_id]
+
+
+def make_update(fake_bot, update_id, user_id, text):
+    user = User(user_id, 'stress', False)
+    chat = Chat(user_id, Chat.PRIVATE)
+    if isinstance(text, CallbackQuery):
+        # A button press on the bot's last message
+        message = Message(update_id, datetime.datetime.now(datetime.timezone.utc), chat)
+        message.set_bot(fake_bot)
+        query = CallbackQuery(text.id, user, text.chat_instance, message=message, data=text.data)
+        query.set_bot(fake_bot)
+        return Update(update_id, callback_query=query)
+    message = Message(update_id, datetime.datetime.now(datetime.timezone.utc), chat, from_user=user, text=text)
+    message.set_bot(fake_bot)
+    return Update(update_id, message=message)
+
+
+def check(bot, users, rounds, records, sessions):
+    failures = []
+    for user_id in users:
+        record = records(user_id)
+        products = record.get('products', {})
+        expected = {f'{user_id}-{k}': {'name': f'کالا {k}', 'price': 1000 + k} for k in range(1, rounds + 2)}
+        if products != expected or record.get('last_product_id') != rounds + 1:
+            failures.append(f'{user_id}: {len(products)} products, last_product_id={record.get("last_product_id")}')
+        if f'C{user_id}' not in record.get('customers', {}):
+            failures.append(f'{user_id}: customer missing')
+        items = [tuple(item) for item in sessions(user_id)['items']]
+        if items != [(f'کالا {rounds + 1}', rounds + 1, 1000 + rounds + 1)]:
+            failures.append(f'{user_id}: new draft holds {items[:3]}')
+        invoice_dir = os.path.join(bot.INVOICE_DIR, str(user_id))
+        if not os.path.isdir(invoice_dir) or len(os.listdir(invoice_dir)) != 1:
+            failures.append(f'{user_id}: invoice missing')
+    return failures
+
+
+def check_flood(bot, fake_bot, slots=4, flood=40, delay=0.02):
+    # Updates queued behind the flooding user's lock must not hold slots
+    processor = bot.PerUserUpdateProcessor(slots)
+
+    async def slow():
+        await asyncio.sleep(delay)
+
+    async def run():
+        tasks = [asyncio.create_task(processor.process_update(make_update(fake_bot, i, 710000, 'flood'), slow()))
+                 for i in range(1, flood + 1)]
+        await asyncio.sleep(delay / 2)
+        started = time.perf_counter()
+        await processor.process_update(make_update(fake_bot, flood + 1, 710001, 'other'), asyncio.sleep(0))
+        latency = time.perf_counter() - started
+        await asyncio.gather(*tasks)
+        return latency
+
+    latency = asyncio.run(run())
+    print(f'other user\'s update during a flood of {flood}: {latency * 1000:.1f} ms '
+          f'(flood needs {flood * delay * 1000:.0f} ms)')
+    if latency > flood * delay / 4:
+        return [f'other user waited {latency * 1000:.1f} ms behind the flood']
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=5, help='items on each user\'s invoice')
+    parser.add_argument('--cache-size', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    os.environ['USER_CACHE_SIZE'] = str(args.cache_size)
+    os.environ['USER_CACHE_FLUSH_THRESHOLD'] = str(max(1, args.cache_size // 2))
+    workdir = tempfile.mkdtemp(prefix='kahroba-stress-')
+    bot = load_bot(workdir)
+    bot.USER_CACHE_FLUSH_INTERVAL = 0.005
+    bot.RENDER_QUEUE_LIMIT = max(bot.RENDER_QUEUE_LIMIT, args.users)
+    bot.init_storage()
+    bot.font_registry.load()
+
+    users = [700000 + i for i in range(args.users)]
+    for user_id in users:
+        bot.save_user_data(user_id, {'phone_number': '0912', 'store_name': 'S', 'seller_name': 'N'})
+    traffic = list(interleave({user_id: user_script(bot, user_id, args.rounds) for user_id in users}, args.seed))
+
+    fake_bot = FakeBot()
+    context = types.SimpleNamespace(bot_data={}, user_data={})
+    processor = bot.PerUserUpdateProcessor(bot.UPDATE_CONCURRENCY)
+
+    async def run():
+        flusher = asyncio.create_task(bot.flush_user_data_periodically())
+        started = time.perf_counter()
+        tasks = []
+        # Like Application: one task per update, created in arrival order
+        for update_id, (user_id, text) in enumerate(traffic, start=1):
+            update = make_update(fake_bot, update_id, user_id, text)
+            route = bot.route_callback if update.callback_query else bot.route_message
+            tasks.append(asyncio.create_task(processor.process_update(update, route(update, context))))
+            if update_id % 20 == 0:
+                await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+        flusher.cancel()
+        return elapsed
+
+    elapsed = asyncio.run(run())
+    bot.shutdown_render_pool()
+    print(f'{len(traffic)} updates from {args.users} users in {elapsed:.2f} s '
+          f'({len(traffic) / elapsed:.0f} updates/s), {fake_bot.sent} replies')
+
+    failures = check(bot, users, args.rounds, bot.get_user_data, bot.get_session)
+    failures += check_flood(bot, fake_bot)
+    bot.close_storage()
+
+    # Read everything back from the database with empty caches
+    bot.user_cache.records.clear()
+    bot.session_store.sessions.clear()
+    bot.session_store.load()
+    failures += check(bot, users, args.rounds, bot.load_user_record, bot.get_session)
+    bot.close_storage()
+
+    if failures:
+        print(f'FAILED: {len(failures)} problems')
+        for failure in failures[:20]:
+            print('  ' + failure)
+        raise SystemExit(1)
+    print('OK: no lost or reordered updates (memory and database), no waiting behind a flood')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,117 +1,1786 @@
 from fpdf import FPDF
 import os
 import json
-from telegram import ReplyKeyboardMarkup, KeyboardButton, Contact
-from telegram.ext import Application, CommandHandler, MessageHandler, filters
+from telegram import ReplyKeyboardMarkup, KeyboardButton, Contact, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, BaseUpdateProcessor, CallbackQueryHandler, CommandHandler, MessageHandler, filters
 import logging
 import arabic_reshaper
 from bidi.algorithm import get_display
 import jdatetime  # Import the library
-from PIL import Image
+from PIL import Image, ImageOps
 import io
+import csv
+import tempfile
 import re
 import textwrap
+import bisect
+import math
+import time
+import functools
+import sqlite3
+import threading
+import multiprocessing
+import asyncio
+import atexit
+import signal
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import zipfile
+import zlib
+import hashlib
+import argparse
+import sys
+import socket
+import urllib.request
+import contextlib
+import contextvars
+from collections import Counter, OrderedDict, deque, namedtuple
 from datetime import datetime
+from dataclasses import dataclass
+from decimal import Decimal, ROUND_HALF_EVEN
 
-dollarFee = 83600 # Example multiplier
 # تنظیمات اولیه
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# مسیر فایل JSON برای ذخیره‌سازی اطلاعات
+# سنجه‌های کارایی: هیستوگرام زمان هندلرها و مراحل، شمارنده‌ها و گیج‌ها
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))  # Prometheus endpoint; 0 disables it
+METRICS_LISTEN = os.environ.get('METRICS_LISTEN', '127.0.0.1')
+METRICS_LOG = os.environ.get('METRICS_LOG', '0') == '1'  # One JSON log line per update
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # seconds
+
+metrics_logger = logging.getLogger(f'{__name__}.metrics')
+
+# Timings of the update being handled, for the structured log and the profiler
+current_update = contextvars.ContextVar('current_update', default=None)
+
+
+class Metrics:
+    """
+    Process-wide counters, gauges and latency histograms, keyed by name and
+    labels and rendered in the Prometheus text format.
+    Render workers are separate processes: they collect into their own
+    instance and send export(reset=True) back with each job, which the bot
+    merge()s, so stages timed in a worker show up here too.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}  # key -> per-bucket counts (last one is +Inf), then the sum
+        self.lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(METRIC_BUCKETS) + 2)
+            histogram[bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+        record_update_timing(key, seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def stage(self, stage):
+        return self.timer('stage_seconds', stage=stage)
+
+    def export(self, reset=False):
+        with self.lock:
+            state = (dict(self.counters), {key: list(value) for key, value in self.histograms.items()})
+            if reset:
+                self.counters.clear()
+                self.histograms.clear()
+        return state
+
+    def merge(self, state):
+        counters, histograms = state
+        for key, amount in counters.items():
+            self.inc(key[0], amount, **dict(key[1]))
+        with self.lock:
+            for key, buckets in histograms.items():
+                histogram = self.histograms.setdefault(key, [0] * len(buckets))
+                for index, value in enumerate(buckets):
+                    histogram[index] += value
+        for key, buckets in histograms.items():
+            record_update_timing(key, buckets[-1])
+
+    def render(self, prefix='invoice_bot_'):
+        def series(name, labels, extra=()):
+            labels = ','.join(f'{label}="{value}"' for label, value in tuple(labels) + tuple(extra))
+            return f'{prefix}{name}{{{labels}}}' if labels else f'{prefix}{name}'
+
+        lines = []
+        with self.lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({key[0] for key in values}):
+                    lines.append(f'# TYPE {prefix}{name} {kind}')
+                    lines += [f'{series(name, labels)} {value}' for (key, labels), value in sorted(values.items())
+                              if key == name]
+            for name in sorted({key[0] for key in self.histograms}):
+                lines.append(f'# TYPE {prefix}{name} histogram')
+                for (key, labels), histogram in sorted(self.histograms.items()):
+                    if key != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(METRIC_BUCKETS + ('+Inf',), histogram):
+                        cumulative += count
+                        lines.append(f'{series(name + "_bucket", labels, [("le", bound)])} {cumulative}')
+                    lines.append(f'{series(name + "_count", labels)} {cumulative}')
+                    lines.append(f'{series(name + "_sum", labels)} {histogram[-1]:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def record_update_timing(key, seconds):
+    # Adds a timing to the update being handled on this task, if any
+    record = current_update.get()
+    if record is not None:
+        name, labels = key
+        label = ','.join(str(value) for _, value in labels)
+        name = name.removesuffix('_seconds') + (f':{label}' if label else '')
+        record['timings'][name] = record['timings'].get(name, 0) + seconds
+
+# مسیر فایل JSON قدیمی (فقط برای مهاجرت یک‌باره)
 USER_DATA_FILE = 'user_data.json'
 
-# تابع ذخیره‌سازی اطلاعات کاربر
-def save_user_data(user_id, data):
-    if os.path.exists(USER_DATA_FILE):
-        with open(USER_DATA_FILE, 'r', encoding='utf-8') as file:
-            user_data = json.load(file)
-    else:
+# مسیر ذخیره فایل‌های فاکتور
+INVOICE_DIR = os.environ.get('INVOICE_DIR', 'invoiceFiles')
+
+# مسیر پایگاه داده SQLite برای ذخیره‌سازی اطلاعات
+USER_DATA_DB = os.environ.get('USER_DATA_DB', 'user_data.db')
+
+# چند نمونه بات روی یک پایگاه داده مشترک (حالت webhook پشت load balancer)
+SHARED_STORAGE = os.environ.get('SHARED_STORAGE', '0') == '1'
+STORAGE_LEASE_TTL = float(os.environ.get('STORAGE_LEASE_TTL', 120))  # seconds
+REPLICA_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+db_connection = None
+db_lock = threading.RLock()
+read_connection = None
+read_lock = threading.Lock()
+storage_writer = None
+
+
+def get_db():
+    """
+    Returns the shared SQLite connection, creating the schema on first use.
+    Each user is stored as a single keyed row, so reads and writes only touch
+    that user's record instead of the whole data set.
+    """
+    global db_connection
+    with db_lock:
+        if db_connection is None:
+            connection = sqlite3.connect(USER_DATA_DB, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            connection.execute('CREATE TABLE IF NOT EXISTS sessions (user_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS user_leases (user_id TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS invoices (user_id TEXT NOT NULL, invoice_number TEXT NOT NULL, '
+                'customer_code TEXT, customer_name TEXT, created_at REAL NOT NULL, subtotal INTEGER, '
+                'installation_fee INTEGER, total INTEGER, dollar_fee TEXT, items TEXT, file_path TEXT NOT NULL, '
+                'rate_version INTEGER, PRIMARY KEY (user_id, invoice_number))'
+            )
+            if 'rate_version' not in {column[1] for column in connection.execute('PRAGMA table_info(invoices)')}:
+                connection.execute('ALTER TABLE invoices ADD COLUMN rate_version INTEGER')
+            connection.execute('CREATE INDEX IF NOT EXISTS invoices_by_date ON invoices (user_id, created_at)')
+            connection.execute('CREATE INDEX IF NOT EXISTS invoices_by_customer ON invoices (user_id, customer_code, created_at)')
+            connection.execute('CREATE TABLE IF NOT EXISTS exchange_rates (version INTEGER PRIMARY KEY AUTOINCREMENT, rate TEXT NOT NULL, source TEXT, set_at REAL NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS invoice_sequences (user_id TEXT PRIMARY KEY, last_number INTEGER NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS archive_chunks (digest TEXT PRIMARY KEY, size INTEGER NOT NULL, stored INTEGER NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS archive_recipes (digest TEXT PRIMARY KEY, size INTEGER NOT NULL, recipe BLOB NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS archived_invoices (file_path TEXT PRIMARY KEY, digest TEXT NOT NULL, archived_at REAL NOT NULL)')
+            db_connection = connection
+        return db_connection
+
+
+def get_read_db():
+    """
+    Returns a read-only connection for point lookups. With WAL it reads the
+    last committed state while the storage writer is busy, so a cache miss
+    never waits behind queued writes. Callers hold read_lock.
+    """
+    global read_connection
+    if read_connection is None:
+        get_db()  # Creates the file and the schema
+        read_connection = sqlite3.connect(f'file:{os.path.abspath(USER_DATA_DB)}?mode=ro', uri=True,
+                                          timeout=30, isolation_level=None, check_same_thread=False)
+    return read_connection
+
+
+def get_storage_writer():
+    """
+    Single thread that performs every database write in submission order.
+    Callers snapshot their data first and hand the writer plain values, so a
+    write never races with a handler changing the same dict.
+    """
+    global storage_writer
+    if storage_writer is None:
+        storage_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage-writer')
+    return storage_writer
+
+
+def timed_write(fn, *args):
+    # Only writes are submitted; reads use the read-only connection
+    operation = getattr(fn, '__name__', type(fn).__name__)
+    metrics.inc('storage_writes_total', op=operation)
+    with metrics.timer('storage_write_seconds', op=operation):
+        return fn(*args)
+
+
+def submit_write(fn, *args):
+    """Queues a storage call on the writer and returns its future."""
+    try:
+        return get_storage_writer().submit(timed_write, fn, *args)
+    except RuntimeError:
+        # The interpreter is shutting down (atexit) and refuses new threads;
+        # nothing else runs any more, so write on this thread
+        future = Future()
+        try:
+            future.set_result(timed_write(fn, *args))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+def migrate_user_data_json(json_path=USER_DATA_FILE):
+    """
+    One-shot import of the legacy user_data.json into the database.
+    Returns the number of migrated users (0 if it already ran).
+    """
+    db = get_db()
+    with db_lock:
+        if db.execute("SELECT 1 FROM meta WHERE key = 'migrated_user_data_json'").fetchone():
+            return 0
         user_data = {}
+        if os.path.exists(json_path):
+            with open(json_path, 'r', encoding='utf-8') as file:
+                user_data = json.load(file)
+
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany(
+                'INSERT OR IGNORE INTO users (user_id, data) VALUES (?, ?)',
+                [(str(user_id), json.dumps(data, ensure_ascii=False)) for user_id, data in user_data.items()]
+            )
+            db.execute("INSERT INTO meta (key, value) VALUES ('migrated_user_data_json', ?)", (json_path,))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+    logger.info("%d کاربر از %s منتقل شد.", len(user_data), json_path)
+    return len(user_data)
+
+
+def init_storage():
+    get_db()
+    submit_write(migrate_user_data_json).result()
+    submit_write(backfill_invoice_ledger).result()
+    submit_write(rate_service.load).result()
+    if SESSION_SNAPSHOT:
+        restored = session_store.load()
+        logger.info("%d نشست فعال بازیابی شد.", restored)
+
+
+def load_user_record(user_id):
+    with read_lock:
+        row = get_read_db().execute('SELECT data FROM users WHERE user_id = ?', (str(user_id),)).fetchone()
+    data = json.loads(row[0]) if row else {}
+    # Conversation state lives in the session store, not in the durable record
+    data.pop('state', None)
+    return data
+
+
+def store_user_records(records):
+    """Writes several (user_id, json_text) pairs in a single transaction."""
+    if not records:
+        return 0
+    with db_lock:
+        db = get_db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany(
+                'INSERT INTO users (user_id, data) VALUES (?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET data = excluded.data',
+                records
+            )
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+    return len(records)
+
+
+def store_sessions(sessions, now, ttl):
+    """
+    Upserts (user_id, json_text, updated_at) snapshots and purges expired
+    ones. The purge also runs for an empty batch, so snapshots left from
+    before SESSION_SNAPSHOT was turned off still expire.
+    """
+    with db_lock:
+        db = get_db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if sessions:
+                db.executemany(
+                    'INSERT INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?) '
+                    'ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at',
+                    sessions
+                )
+            db.execute('DELETE FROM sessions WHERE updated_at < ?', (now - ttl,))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+    return len(sessions)
+
+
+def try_user_lease(user_id, owner, ttl):
+    """
+    Takes the cross-replica lease on a user if it is free, expired or already
+    ours. Returns True when `owner` holds the lease afterwards.
+    """
+    now = time.time()
+    with db_lock:
+        cursor = get_db().execute(
+            'INSERT INTO user_leases (user_id, owner, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(user_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+            'WHERE user_leases.expires_at < ? OR user_leases.owner = excluded.owner',
+            (str(user_id), owner, now + ttl, now)
+        )
+    return cursor.rowcount == 1
+
+
+def release_user_lease(user_id, owner):
+    with db_lock:
+        get_db().execute('DELETE FROM user_leases WHERE user_id = ? AND owner = ?', (str(user_id), owner))
+
+
+def load_session_record(user_id):
+    with read_lock:
+        row = get_read_db().execute('SELECT data FROM sessions WHERE user_id = ?', (str(user_id),)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+# دفتر فاکتورهای صادرشده و شماره‌گذاری فاکتورها
+INVOICE_LIST_LIMIT = int(os.environ.get('INVOICE_LIST_LIMIT', 20))
+INVOICE_NUMBER_FORMAT = os.environ.get('INVOICE_NUMBER_FORMAT', '{date:%y%m%d}-{sequence:04d}')
+INVOICE_SEQUENCE_START = int(os.environ.get('INVOICE_SEQUENCE_START', 1))  # First number of each seller
+
+
+# One row of the invoices table, in column order
+LedgerEntry = namedtuple('LedgerEntry', ['user_id', 'invoice_number', 'customer_code', 'customer_name', 'created_at',
+                                         'subtotal', 'installation_fee', 'total', 'dollar_fee', 'items', 'file_path',
+                                         'rate_version'])
+
+
+def invoice_ledger_entry(user_id, invoice_number, customer, invoice, file_path, created_at=None):
+    """Builds the ledger row for a rendered invoice, with a snapshot of its priced lines."""
+    items = json.dumps([[line.name, line.quantity, str(line.unit_price), line.adjusted_unit_price, line.total]
+                        for line in invoice.lines], ensure_ascii=False)
+    return LedgerEntry(
+        user_id=str(user_id), invoice_number=invoice_number,
+        customer_code=customer.get('code') if customer else None,
+        customer_name=customer.get('name') if customer else None,
+        created_at=created_at or time.time(), subtotal=invoice.subtotal, installation_fee=invoice.installation_fee,
+        total=invoice.total, dollar_fee=str(invoice.dollar_fee), items=items, file_path=file_path,
+        rate_version=invoice.rate_version,
+    )
+
+
+def store_invoice_entries(entries):
+    """Writes ledger rows in a single transaction; a re-used number replaces the older row, like its file."""
+    if not entries:
+        return 0
+    with db_lock:
+        db = get_db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany(
+                f'INSERT OR REPLACE INTO invoices ({", ".join(LedgerEntry._fields)}) '
+                f'VALUES ({", ".join("?" * len(LedgerEntry._fields))})',
+                entries
+            )
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+    return len(entries)
+
+
+def allocate_invoice_numbers(user_id, count=1):
+    """
+    Reserves the seller's next `count` sequence numbers in one transaction
+    and returns them formatted with INVOICE_NUMBER_FORMAT. SQLite serializes
+    the update across threads and across replicas sharing the database, so a
+    number is never handed out twice and numbers only grow.
+    """
+    with db_lock:
+        db = get_db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute(
+                'INSERT INTO invoice_sequences (user_id, last_number) VALUES (?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET last_number = last_number + ?',
+                (str(user_id), INVOICE_SEQUENCE_START - 1 + count, count)
+            )
+            last = db.execute('SELECT last_number FROM invoice_sequences WHERE user_id = ?', (str(user_id),)).fetchone()[0]
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+    today = datetime.now()
+    return [INVOICE_NUMBER_FORMAT.format(date=today, sequence=sequence) for sequence in range(last - count + 1, last + 1)]
+
+
+async def next_invoice_numbers(user_id, count=1):
+    return await asyncio.wrap_future(submit_write(allocate_invoice_numbers, user_id, count))
+
+
+def record_invoices(entries):
+    """Queues ledger rows on the storage writer; returns its future."""
+    return submit_write(store_invoice_entries, entries)
+
+
+def find_invoices(user_id, customer_code=None, since=None, until=None, invoice_number=None, limit=INVOICE_LIST_LIMIT):
+    """
+    Newest first: the user's invoices, optionally for one customer, within
+    [since, until) (timestamps) or with one number. Returns dicts.
+    """
+    query = 'SELECT * FROM invoices WHERE user_id = ?'
+    params = [str(user_id)]
+    for clause, value in (('customer_code = ?', customer_code), ('created_at >= ?', since),
+                          ('created_at < ?', until), ('invoice_number = ?', invoice_number)):
+        if value is not None:
+            query += ' AND ' + clause
+            params.append(value)
+    query += ' ORDER BY created_at DESC LIMIT ?'
+    params.append(limit)
+    metrics.inc('storage_reads_total', table='invoices')
+    with metrics.timer('storage_read_seconds', table='invoices'), read_lock:
+        cursor = get_read_db().execute(query, params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def backfill_invoice_ledger(invoice_dir=None):
+    """
+    One-shot scan of invoiceFiles/<user_id>/<number>_<customer>.pdf into the
+    ledger, for invoices rendered before it existed. The date and customer
+    code come from the number (the code only when it matches a customer of
+    that user); totals and items are unknown. Returns the number of files.
+    """
+    invoice_dir = invoice_dir or INVOICE_DIR
+    db = get_db()
+    with db_lock:
+        if db.execute("SELECT 1 FROM meta WHERE key = 'backfilled_invoice_ledger'").fetchone():
+            return 0
+    entries = []
+    if os.path.isdir(invoice_dir):
+        for user_id in os.listdir(invoice_dir):
+            user_folder = os.path.join(invoice_dir, user_id)
+            if not os.path.isdir(user_folder):
+                continue
+            customers = load_user_record(user_id).get('customers', {})
+            for filename in os.listdir(user_folder):
+                if not filename.endswith('.pdf'):
+                    continue
+                invoice_number, _, customer_name = filename[:-len('.pdf')].partition('_')
+                # Numbers are yymmddHHMM + customer code, with a -N suffix for batches
+                customer_code = invoice_number[10:].rsplit('-', 1)[0]
+                file_path = os.path.join(user_folder, filename)
+                try:
+                    created_at = datetime.strptime(invoice_number[:10], "%y%m%d%H%M").timestamp()
+                except ValueError:
+                    created_at = os.path.getmtime(file_path)
+                entries.append((user_id, invoice_number, customer_code if customer_code in customers else None,
+                                customer_name or None, created_at, None, None, None, None, None, file_path))
+    with db_lock:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # Invoices recorded since are more complete than what the file name tells
+            db.executemany('INSERT OR IGNORE INTO invoices (user_id, invoice_number, customer_code, customer_name, '
+                           'created_at, subtotal, installation_fee, total, dollar_fee, items, file_path) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', entries)
+            db.execute("INSERT INTO meta (key, value) VALUES ('backfilled_invoice_ledger', ?)", (invoice_dir,))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+    logger.info("%d فاکتور از %s به دفتر فاکتورها اضافه شد.", len(entries), invoice_dir)
+    return len(entries)
+
+
+# بایگانی فشرده و بدون تکرار فاکتورهای قدیمی
+INVOICE_ARCHIVE_DIR = os.environ.get('INVOICE_ARCHIVE_DIR', 'invoiceArchive')
+ARCHIVE_AFTER_DAYS = float(os.environ.get('ARCHIVE_AFTER_DAYS', 30))
+ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', 6 * 3600))  # seconds; 0 disables the background job
+ARCHIVE_BATCH = int(os.environ.get('ARCHIVE_BATCH', 50))  # invoices per archiving pass
+ARCHIVE_CHUNK_MIN = 1024  # Smaller PDF streams stay inline in the recipe
+
+
+class InvoiceArchive:
+    """
+    Content-addressed cold tier for invoice PDFs. A PDF is stored as a recipe
+    of literal bytes and references to its larger streams; each stream is
+    kept once under its SHA-256 (zlib-compressed when that helps) no matter
+    how many invoices embed it, so the logo and font subsets every invoice of
+    a seller repeats cost nothing after the first. Identical PDFs share one
+    recipe. read() rebuilds the original bytes exactly and checks the hash.
+    Hashing, compression and chunk files are handled by the calling thread;
+    only the bookkeeping transaction runs on the storage writer, so put()
+    must not be called from the writer itself.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def chunk_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    @staticmethod
+    def split(data):
+        """Yields (literal, stream) pairs; the stream is None after the last one."""
+        position = 0
+        for match in re.finditer(rb'(?<!end)stream\r?\n', data):
+            start = match.end()
+            if start < position:
+                continue
+            end = data.find(b'endstream', start)
+            if end - start < ARCHIVE_CHUNK_MIN:
+                continue
+            yield data[position:start], data[start:end]
+            position = end
+        yield data[position:], None
+
+    def _write_chunk(self, digest, chunk):
+        # The first byte says whether the body is compressed
+        packed = zlib.compress(chunk, 9)
+        body = b'z' + packed if len(packed) < len(chunk) else b'r' + chunk
+        path = self.chunk_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Replicas may share the archive and write the same chunk at once
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(body)
+        os.replace(temp_path, path)
+        return len(body)
+
+    def pack(self, data):
+        """
+        Hashes and splits a PDF and writes its new chunks; returns (digest,
+        recipe, chunks, written), with recipe None when the PDF is already
+        archived.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        with db_lock:
+            known = get_db().execute('SELECT 1 FROM archive_recipes WHERE digest = ?', (digest,)).fetchone()
+        if known:
+            return digest, None, [], 0
+        chunks, recipe, written = [], bytearray(), 0
+        for literal, stream in self.split(data):
+            recipe += b'L' + len(literal).to_bytes(4, 'big') + literal
+            if stream is None:
+                continue
+            chunk_digest = hashlib.sha256(stream).digest()
+            recipe += b'C' + chunk_digest
+            if not os.path.exists(self.chunk_path(chunk_digest.hex())):
+                stored = self._write_chunk(chunk_digest.hex(), stream)
+                chunks.append((chunk_digest.hex(), len(stream), stored))
+                written += stored
+        recipe = zlib.compress(bytes(recipe), 9)
+        return digest, recipe, chunks, written + len(recipe)
+
+    @staticmethod
+    def record_archived(file_path, digest, size, recipe, chunks):
+        """Storage-writer job: records a packed PDF and points file_path at it."""
+        db = get_db()
+        with db_lock:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.executemany('INSERT OR IGNORE INTO archive_chunks (digest, size, stored) VALUES (?, ?, ?)', chunks)
+                if recipe is not None:
+                    db.execute('INSERT OR IGNORE INTO archive_recipes (digest, size, recipe) VALUES (?, ?, ?)',
+                               (digest, size, recipe))
+                db.execute('INSERT OR REPLACE INTO archived_invoices (file_path, digest, archived_at) VALUES (?, ?, ?)',
+                           (file_path, digest, time.time()))
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+
+    @staticmethod
+    def forget(file_path):
+        """Storage-writer job: drops file_path from the archive, and its recipe when nothing else uses it."""
+        db = get_db()
+        with db_lock:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute('SELECT digest FROM archived_invoices WHERE file_path = ?', (file_path,)).fetchone()
+                db.execute('DELETE FROM archived_invoices WHERE file_path = ?', (file_path,))
+                if row is not None:
+                    db.execute('DELETE FROM archive_recipes WHERE digest = ? AND NOT EXISTS '
+                               '(SELECT 1 FROM archived_invoices WHERE digest = ?)', (row[0], row[0]))
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+
+    def put(self, file_path, data):
+        """Archives one PDF under its path; returns the bytes newly written to disk."""
+        digest, recipe, chunks, written = self.pack(data)
+        submit_write(self.record_archived, file_path, digest, len(data), recipe, chunks).result()
+        return written
+
+    def read(self, file_path):
+        """Rebuilds an archived PDF; raises FileNotFoundError when the path was never archived."""
+        with read_lock:
+            row = get_read_db().execute(
+                'SELECT archive_recipes.digest, recipe FROM archived_invoices '
+                'JOIN archive_recipes USING (digest) WHERE file_path = ?', (file_path,)
+            ).fetchone()
+        if row is None:
+            raise FileNotFoundError(file_path)
+        digest, recipe = row
+        recipe = zlib.decompress(recipe)
+        data, position = bytearray(), 0
+        while position < len(recipe):
+            if recipe[position:position + 1] == b'L':
+                length = int.from_bytes(recipe[position + 1:position + 5], 'big')
+                data += recipe[position + 5:position + 5 + length]
+                position += 5 + length
+            else:
+                with open(self.chunk_path(recipe[position + 1:position + 33].hex()), 'rb') as file:
+                    body = file.read()
+                data += zlib.decompress(body[1:]) if body[:1] == b'z' else body[1:]
+                position += 33
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise IOError(f"archived invoice {file_path} is corrupt")
+        return bytes(data)
+
+
+invoice_archive = InvoiceArchive(INVOICE_ARCHIVE_DIR)
+
+
+def archive_old_invoices(max_age=None, limit=ARCHIVE_BATCH):
+    """
+    Moves up to `limit` rendered PDFs older than max_age seconds (default
+    ARCHIVE_AFTER_DAYS) from invoiceFiles into the archive, deleting each
+    file once its archived copy reads back identical; a copy that does not
+    is logged and dropped and the file stays where it is. An invoice rendered
+    again after it was archived is archived again. Returns the number moved.
+    Runs on a worker thread rather than the storage writer: reading, hashing
+    and compressing happen here and each invoice queues one short
+    transaction.
+    """
+    max_age = ARCHIVE_AFTER_DAYS * 86400 if max_age is None else max_age
+    with db_lock:
+        rows = get_db().execute(
+            'SELECT invoices.file_path FROM invoices LEFT JOIN archived_invoices USING (file_path) '
+            'WHERE invoices.created_at < ? AND (archived_invoices.file_path IS NULL '
+            'OR archived_invoices.archived_at < invoices.created_at) ORDER BY invoices.created_at',
+            (time.time() - max_age,)
+        ).fetchall()
+    moved = 0
+    for (file_path,) in rows:
+        try:
+            with open(file_path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            continue
+        invoice_archive.put(file_path, data)
+        try:
+            matches = invoice_archive.read(file_path) == data
+        except (OSError, zlib.error) as e:
+            logger.error("خواندن نسخه بایگانی %s ناموفق بود: %r", file_path, e)
+            matches = False
+        if not matches:
+            logger.error("نسخه بایگانی %s با فایل اصلی یکی نیست؛ فایل اصلی نگه داشته شد.", file_path)
+            submit_write(invoice_archive.forget, file_path).result()
+            continue
+        os.remove(file_path)
+        moved += 1
+        if moved >= limit:
+            break
+    return moved
 
-    user_data[str(user_id)] = data
-    with open(USER_DATA_FILE, 'w', encoding='utf-8') as file:
-        json.dump(user_data, file, ensure_ascii=False, indent=4)
+
+def open_invoice(file_path):
+    """Opens a rendered invoice for re-delivery, from invoiceFiles or, once moved, from the archive."""
+    try:
+        return open(file_path, 'rb')
+    except FileNotFoundError:
+        return io.BytesIO(invoice_archive.read(file_path))
+
+
+def archive_report():
+    """Disk use of invoiceFiles and of the archive, and what the archive saves."""
+    with db_lock:
+        db = get_db()
+        archived, original = db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM archived_invoices JOIN archive_recipes USING (digest)'
+        ).fetchone()
+        chunks, chunk_bytes = db.execute('SELECT COUNT(*), COALESCE(SUM(stored), 0) FROM archive_chunks').fetchone()
+        recipes, recipe_bytes = db.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(recipe)), 0) FROM archive_recipes').fetchone()
+    hot_files = hot_bytes = 0
+    if os.path.isdir(INVOICE_DIR):
+        for user_id in os.listdir(INVOICE_DIR):
+            user_folder = os.path.join(INVOICE_DIR, user_id)
+            if os.path.isdir(user_folder):
+                for entry in os.scandir(user_folder):
+                    if entry.name.endswith('.pdf'):
+                        hot_files += 1
+                        hot_bytes += entry.stat().st_size
+    stored = chunk_bytes + recipe_bytes
+    return {'hot_files': hot_files, 'hot_bytes': hot_bytes, 'archived_files': archived, 'unique_pdfs': recipes,
+            'chunks': chunks, 'archived_bytes': original, 'stored_bytes': stored, 'saved_bytes': original - stored}
+
+
+def format_archive_report(report):
+    ratio = report['archived_bytes'] / report['stored_bytes'] if report['stored_bytes'] else 0
+    return (f"invoiceFiles: {report['hot_files']} فایل، {report['hot_bytes'] / 1e6:.1f} MB\n"
+            f"بایگانی: {report['archived_files']} فاکتور ({report['unique_pdfs']} فایل یکتا، {report['chunks']} بخش) "
+            f"{report['archived_bytes'] / 1e6:.1f} MB -> {report['stored_bytes'] / 1e6:.1f} MB "
+            f"({ratio:.1f} برابر فشرده‌تر)، صرفه‌جویی {report['saved_bytes'] / 1e6:.1f} MB")
+
+
+async def archive_invoices_periodically():
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+        try:
+            moved = total = 0
+            while True:
+                moved = await asyncio.to_thread(archive_old_invoices)
+                total += moved
+                if moved < ARCHIVE_BATCH:
+                    break
+            if total:
+                report = await asyncio.to_thread(archive_report)
+                logger.info("%d فاکتور بایگانی شد.\n%s", total, format_archive_report(report))
+        except Exception:
+            logger.exception("خطا در بایگانی فاکتورها")
+
+
+def archive_cli(argv):
+    parser = argparse.ArgumentParser(prog='invoice-bot.py archive', description='بایگانی فاکتورهای قدیمی و گزارش فضای ذخیره‌شده')
+    parser.add_argument('--days', type=float, default=ARCHIVE_AFTER_DAYS, help='archive invoices older than this')
+    parser.add_argument('--report', action='store_true', help='only print the report')
+    args = parser.parse_args(argv)
+
+    init_storage()
+    if not args.report:
+        total = 0
+        while True:
+            moved = archive_old_invoices(args.days * 86400)
+            total += moved
+            if moved < ARCHIVE_BATCH:
+                break
+        print(f"{total} فاکتور بایگانی شد.", file=sys.stderr)
+    print(format_archive_report(archive_report()))
+    close_storage()
+
+
+# کش رکوردهای کاربران با نوشتن تأخیری
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+USER_CACHE_FLUSH_INTERVAL = float(os.environ.get('USER_CACHE_FLUSH_INTERVAL', 2.0))  # seconds
+USER_CACHE_FLUSH_THRESHOLD = int(os.environ.get('USER_CACHE_FLUSH_THRESHOLD', 100))  # dirty records
+
+
+class UserDataCache:
+    """
+    LRU-bounded write-back cache of user records.
+    save() only marks a record dirty; dirty records are written to the
+    database in one batch by flush(), which runs on a timer, when too many
+    records are dirty, when a dirty record is evicted and on shutdown.
+    Records are serialized on the calling thread and written by the storage
+    writer. Cache misses read committed rows on the read-only connection; a
+    dirty record that was evicted is kept in `pending` until its write
+    commits, so it is never read back stale. prefetch() does the read on a
+    worker thread, so handlers on the event loop find the record cached.
+    get() returns the cached dict itself, so callers must still call save()
+    after changing it.
+    """
+
+    def __init__(self, max_size, flush_threshold):
+        self.max_size = max(1, max_size)
+        self.flush_threshold = flush_threshold
+        self.records = OrderedDict()
+        self.dirty = set()
+        self.pending = {}  # user_id -> (record, json text) evicted but not yet committed
+        self.lock = threading.RLock()
+
+    def get(self, user_id):
+        user_id = str(user_id)
+        with self.lock:
+            if user_id in self.records:
+                self.records.move_to_end(user_id)
+                return self.records[user_id]
+            data = self.pending.get(user_id, (None,))[0]
+        if data is None:
+            metrics.inc('storage_reads_total', table='users')
+            with metrics.timer('storage_read_seconds', table='users'):
+                data = load_user_record(user_id)
+        with self.lock:
+            # Another thread may have cached a newer copy while we were reading
+            if user_id in self.records:
+                return self.records[user_id]
+            data = self.pending.get(user_id, (data,))[0]
+            self.records[user_id] = data
+            self._evict()
+        return data
+
+    async def prefetch(self, user_id):
+        with self.lock:
+            if str(user_id) in self.records:
+                return
+        await asyncio.to_thread(self.get, user_id)
+
+    def save(self, user_id, data):
+        user_id = str(user_id)
+        with self.lock:
+            self.records[user_id] = data
+            self.records.move_to_end(user_id)
+            self.dirty.add(user_id)
+            self._evict()
+            should_flush = len(self.dirty) >= self.flush_threshold
+        if should_flush:
+            self.flush()
+
+    def _evict(self):
+        evicted = []
+        while len(self.records) > self.max_size:
+            user_id, data = self.records.popitem(last=False)
+            if user_id in self.dirty:
+                self.dirty.discard(user_id)
+                text = json.dumps(data, ensure_ascii=False)
+                self.pending[user_id] = (data, text)
+                evicted.append((user_id, text))
+        if evicted:
+            self._write(evicted)
+
+    def _write(self, batch):
+        future = submit_write(store_user_records, batch)
+        future.add_done_callback(lambda done: self._written(batch, done))
+        return future
+
+    def _written(self, batch, done):
+        with self.lock:
+            for user_id, text in batch:
+                # Unless the record was evicted again since this write was queued
+                if self.pending.get(user_id, (None, None))[1] is text:
+                    del self.pending[user_id]
+        if done.exception():
+            self._restore(batch)
+
+    def _restore(self, batch):
+        # Keep failed records dirty so the next flush retries them
+        logger.error("ذخیره %d رکورد کاربر ناموفق بود؛ دوباره تلاش می‌شود.", len(batch))
+        with self.lock:
+            for user_id, text in batch:
+                if user_id not in self.records:
+                    self.records[user_id] = json.loads(text)
+                self.dirty.add(user_id)
+
+    async def reload(self, user_id):
+        """Replaces a clean cached copy with what other replicas wrote (shared storage mode)."""
+        user_id = str(user_id)
+        with self.lock:
+            if user_id not in self.dirty:
+                self.records.pop(user_id, None)
+        await self.prefetch(user_id)
+
+    def flush(self, user_id=None):
+        """Queues dirty records (all, or one user's); returns a future for the number written."""
+        with self.lock, metrics.stage('serialize_users'):
+            user_ids = self.dirty if user_id is None else self.dirty & {str(user_id)}
+            batch = [(dirty_id, json.dumps(self.records[dirty_id], ensure_ascii=False)) for dirty_id in user_ids]
+            self.dirty.difference_update(dirty_id for dirty_id, _ in batch)
+        return self._write(batch)
+
+
+user_cache = UserDataCache(USER_CACHE_SIZE, USER_CACHE_FLUSH_THRESHOLD)
+
+
+# تابع ذخیره‌سازی اطلاعات کاربر
+def save_user_data(user_id, data):
+    user_cache.save(user_id, data)
 
 # تابع دریافت اطلاعات کاربر
 def get_user_data(user_id):
-    if os.path.exists(USER_DATA_FILE):
-        with open(USER_DATA_FILE, 'r', encoding='utf-8') as file:
-            user_data = json.load(file)
-            return user_data.get(str(user_id), {})
-    return {}
+    return user_cache.get(user_id)
+
+
+async def flush_user_data_periodically():
+    while True:
+        await asyncio.sleep(USER_CACHE_FLUSH_INTERVAL)
+        try:
+            # Snapshots are taken here on the event loop; only the writes leave it
+            await asyncio.wrap_future(user_cache.flush())
+            await asyncio.wrap_future(session_store.flush())
+        except Exception:
+            logger.exception("خطا در ذخیره‌سازی اطلاعات کاربران")
+
+
+def close_storage():
+    global db_connection, read_connection, storage_writer
+    # Queued invoice files still record their ledger entries
+    drain_invoice_files()
+    flushed = user_cache.flush().result()
+    session_store.flush().result()
+    if storage_writer is not None:
+        storage_writer.shutdown(wait=True)
+        storage_writer = None
+    with db_lock:
+        if db_connection is not None:
+            db_connection.close()
+            db_connection = None
+    with read_lock:
+        if read_connection is not None:
+            read_connection.close()
+            read_connection = None
+    logger.info("%d رکورد کاربر پیش از خروج ذخیره شد.", flushed)
+
+# لایه وضعیت گفتگو: وضعیت فعلی و پیش‌نویس فاکتور هر کاربر
+SESSION_TTL = float(os.environ.get('SESSION_TTL', 6 * 3600))  # seconds of inactivity
+SESSION_SNAPSHOT = os.environ.get('SESSION_SNAPSHOT', '1') != '0'
+
+
+def new_session():
+    return {'state': 'ready', 'items': [], 'selected_customer': None, 'selected_product': None,
+            'product_query': None, 'customer_query': None, 'listing': None,
+            'updated_at': time.time()}
+
+
+class SessionStore:
+    """
+    Ephemeral per-user conversation state kept next to the in-progress
+    invoice draft (items, selected customer and product).
+    Sessions expire after SESSION_TTL seconds of inactivity. Changed sessions
+    are written as a compact snapshot to the `sessions` table by flush(), so
+    a restart does not lose drafts and a state change never rewrites the
+    user's catalog.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.sessions = {}
+        self.dirty = set()
+        self.lock = threading.RLock()
+
+    def get(self, user_id):
+        user_id = str(user_id)
+        with self.lock:
+            session = self.sessions.get(user_id)
+            if session is None or time.time() - session['updated_at'] > self.ttl:
+                session = self.sessions[user_id] = new_session()
+            return session
+
+    def touch(self, user_id):
+        user_id = str(user_id)
+        with self.lock:
+            self.get(user_id)['updated_at'] = time.time()
+            self.dirty.add(user_id)
+
+    def load(self):
+        if not SESSION_SNAPSHOT:
+            return 0
+        cutoff = time.time() - self.ttl
+        with db_lock:
+            rows = get_db().execute('SELECT user_id, data FROM sessions WHERE updated_at >= ?', (cutoff,)).fetchall()
+        with self.lock:
+            for user_id, data in rows:
+                self.sessions[user_id] = json.loads(data)
+        return len(rows)
+
+    async def reload(self, user_id):
+        """Replaces the local copy with the stored snapshot (shared storage mode)."""
+        user_id = str(user_id)
+        metrics.inc('storage_reads_total', table='sessions')
+        with metrics.timer('storage_read_seconds', table='sessions'):
+            session = await asyncio.to_thread(load_session_record, user_id)
+        with self.lock:
+            if user_id in self.dirty:
+                return
+            if session is None:
+                self.sessions.pop(user_id, None)
+            else:
+                self.sessions[user_id] = session
+
+    def flush(self, user_id=None):
+        """Queues changed sessions (all, or one user's) on the storage writer; returns its future."""
+        now = time.time()
+        with self.lock, metrics.stage('serialize_sessions'):
+            expired = [expired_id for expired_id, session in self.sessions.items()
+                       if now - session['updated_at'] > self.ttl]
+            for expired_id in expired:
+                del self.sessions[expired_id]
+                self.dirty.discard(expired_id)
+            user_ids = self.dirty if user_id is None else self.dirty & {str(user_id)}
+            batch = [(dirty_id, json.dumps(self.sessions[dirty_id], ensure_ascii=False, separators=(',', ':')),
+                      self.sessions[dirty_id]['updated_at']) for dirty_id in user_ids]
+            self.dirty.difference_update(dirty_id for dirty_id, _, _ in batch)
+        if not SESSION_SNAPSHOT:
+            batch = []
+        future = submit_write(store_sessions, batch, now, self.ttl)
+        future.add_done_callback(lambda done: done.exception() and self._restore(batch))
+        return future
+
+    def _restore(self, batch):
+        with self.lock:
+            self.dirty.update(user_id for user_id, _, _ in batch if user_id in self.sessions)
+
+
+session_store = SessionStore(SESSION_TTL)
+
+
+def get_session(user_id):
+    return session_store.get(user_id)
+
+
+def save_session(user_id):
+    session_store.touch(user_id)
+
 
 def update_user_state(user_id, state):
-    user_data = get_user_data(user_id)
-    user_data['state'] = state
-    save_user_data(user_id, user_data)
+    session_store.get(user_id)['state'] = state
+    session_store.touch(user_id)
 
 def get_user_state(user_id):
-    user_data = get_user_data(user_id)
-    return user_data.get('state', 'ready')
+    return session_store.get(user_id)['state']
+
+
+# نرخ دلار: منبع قابل تعویض، تاریخچه نسخه‌دار و جایگزینی بدون توقف بات
+DEFAULT_DOLLAR_FEE = os.environ.get('DOLLAR_FEE', '83600')  # Seeds the history on first start
+RATE_SOURCE = os.environ.get('RATE_SOURCE', '')  # file:<path> or an http(s) URL; empty: /rate only
+RATE_REFRESH_INTERVAL = float(os.environ.get('RATE_REFRESH_INTERVAL', 60))  # seconds
+RATE_ADMIN_IDS = {admin.strip() for admin in os.environ.get('RATE_ADMIN_IDS', '').split(',') if admin.strip()}
+
+
+@dataclass(frozen=True)
+class ExchangeRate:
+    version: int
+    rate: Decimal  # Toman per dollar
+    source: str
+    set_at: float
+
+
+def parse_rate(text):
+    try:
+        rate = Decimal(str(text).translate(PERSIAN_NORMALIZATION).replace(',', '').replace('٬', '').strip())
+    except ArithmeticError:
+        raise ValueError(text)
+    if not rate.is_finite() or rate <= 0:
+        raise ValueError(text)
+    return rate
+
+
+def store_exchange_rate(rate, source):
+    """Appends a rate to the history and returns it as an ExchangeRate."""
+    now = time.time()
+    with db_lock:
+        cursor = get_db().execute('INSERT INTO exchange_rates (rate, source, set_at) VALUES (?, ?, ?)',
+                                  (str(rate), source, now))
+    return ExchangeRate(cursor.lastrowid, rate, source, now)
+
+
+def load_exchange_rate():
+    with read_lock:
+        row = get_read_db().execute(
+            'SELECT version, rate, source, set_at FROM exchange_rates ORDER BY version DESC LIMIT 1'
+        ).fetchone()
+    return ExchangeRate(row[0], Decimal(row[1]), row[2], row[3]) if row else None
+
+
+class FileRateSource:
+    """Reads the rate from a text file each time the file changes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+
+    def fetch(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self.mtime:
+            return None
+        with open(self.path, 'r', encoding='utf-8') as file:
+            rate = parse_rate(file.read())
+        self.mtime = mtime
+        return rate
+
+
+class HttpRateSource:
+    """Polls a JSON endpoint answering {"rate": 83600}; stands in for a real provider."""
+
+    def __init__(self, url):
+        self.url = url
+
+    def fetch(self):
+        with urllib.request.urlopen(self.url, timeout=10) as response:
+            return parse_rate(json.load(response)['rate'])
+
+
+RATE_SOURCES = {
+    'file': lambda spec: FileRateSource(spec[len('file:'):]),
+    'http': HttpRateSource,
+    'https': HttpRateSource,
+}
+
+
+def make_rate_source(spec):
+    return RATE_SOURCES[spec.split(':', 1)[0]](spec) if spec else None
+
+
+class RateService:
+    """
+    Holds the current dollar rate as an immutable ExchangeRate. A new rate is
+    appended to the exchange_rates history and swapped in with one
+    assignment, so a single pricing never mixes two rates. Drafts keep no
+    rate of their own: they are priced again at the current rate when the
+    invoice is confirmed, and because the preview fingerprint includes the
+    rate version, a confirm after a rate change gets a fresh preview instead
+    of an invoice at a price the user never saw. Each invoice records the
+    version it used. Writes run on the storage writer; sync() also picks up
+    rates set by other replicas.
+    """
+
+    def __init__(self, source=None):
+        self.source = source
+        self.current = None
+
+    def load(self):
+        self.current = load_exchange_rate() or store_exchange_rate(parse_rate(DEFAULT_DOLLAR_FEE), 'default')
+        return self.current
+
+    def get(self):
+        if self.current is None:
+            submit_write(self.load).result()
+        return self.current
+
+    def swap(self, current):
+        # sync() reads off the writer and may return after a newer set()
+        if self.current is None or current.version > self.current.version:
+            self.current = current
+            # Prices at the old rate are never asked for again
+            adjusted_unit_price.cache_clear()
+
+    def set(self, rate, source):
+        current = store_exchange_rate(rate, source)
+        self.swap(current)
+        logger.info("نرخ دلار: %s تومان (نسخه %d، منبع %s)", rate, current.version, source)
+        return current
+
+    def sync(self):
+        latest = load_exchange_rate()
+        if latest is not None:
+            self.swap(latest)
+        return self.current
+
+    def fetch(self):
+        """Asks the configured source for a rate; None when there is no source or nothing changed."""
+        if self.source is None:
+            return None
+        try:
+            return self.source.fetch()
+        except (OSError, ValueError, KeyError) as error:
+            logger.warning("دریافت نرخ دلار از %s ناموفق بود: %s", RATE_SOURCE, error)
+            return None
+
+
+rate_service = RateService(make_rate_source(RATE_SOURCE))
+
+
+async def refresh_rate_periodically():
+    # The source is read right away at startup, then every RATE_REFRESH_INTERVAL
+    while True:
+        try:
+            rate = await asyncio.to_thread(rate_service.fetch)
+            if rate is not None and rate != rate_service.current.rate:
+                await asyncio.wrap_future(submit_write(rate_service.set, rate, RATE_SOURCE))
+            else:
+                await asyncio.to_thread(rate_service.sync)
+        except Exception:
+            logger.exception("خطا در به‌روزرسانی نرخ دلار")
+        await asyncio.sleep(RATE_REFRESH_INTERVAL)
+
+
+# موتور قیمت‌گذاری فاکتور
+INSTALLATION_FEE_RATE = Decimal('0.20')  # اجرت نصب: 20 درصد جمع اقلام
+PRICE_ROUNDING = Decimal(1000)
+
+
+@dataclass(frozen=True)
+class InvoiceLine:
+    row: int
+    name: str
+    quantity: int
+    unit_price: Decimal  # Catalog price in dollars
+    adjusted_unit_price: int  # Toman, rounded to PRICE_ROUNDING
+    total: int
+
+
+@dataclass(frozen=True)
+class InvoiceModel:
+    lines: tuple
+    dollar_fee: Decimal
+    subtotal: int
+    installation_fee: int
+    total: int
+    rate_version: int = None  # exchange_rates version; None for an explicit dollar_fee
+
+
+def round_price(amount):
+    # Half-even, like the round() the invoice used before
+    return int((amount / PRICE_ROUNDING).quantize(Decimal(1), rounding=ROUND_HALF_EVEN) * PRICE_ROUNDING)
+
+
+PRICE_CACHE_SIZE = int(os.environ.get('PRICE_CACHE_SIZE', 4096))
+
+
+@functools.lru_cache(maxsize=PRICE_CACHE_SIZE)
+def adjusted_unit_price(unit_price, dollar_fee):
+    """Catalog price as a Decimal and converted to rounded Toman; cleared when the rate changes."""
+    unit_price = Decimal(str(unit_price))
+    return unit_price, round_price(unit_price * dollar_fee)
+
+
+def price_invoice(items, dollar_fee=None):
+    """
+    Computes line totals, the installation fee and the grand total once,
+    in exact decimal arithmetic, at the current exchange rate unless a
+    dollar_fee is given. The returned model is immutable and is only read by
+    the renderer, previews and exports.
+    """
+    if dollar_fee is None:
+        rate = rate_service.get()
+        dollar_fee, rate_version = rate.rate, rate.version
+    else:
+        dollar_fee, rate_version = Decimal(str(dollar_fee)), None
+    lines = []
+    subtotal = 0
+    for row, (name, quantity, unit_price) in enumerate(items, start=1):
+        unit_price, adjusted = adjusted_unit_price(unit_price, dollar_fee)
+        total = int(quantity) * adjusted
+        subtotal += total
+        lines.append(InvoiceLine(row, name, int(quantity), unit_price, adjusted, total))
+    installation_fee = round_price(subtotal * INSTALLATION_FEE_RATE)
+    return InvoiceModel(tuple(lines), dollar_fee, subtotal, installation_fee, subtotal + installation_fee,
+                        rate_version)
+
+
+# لایه شکل‌دهی متن فارسی (reshape + bidi) با کش
+SHAPING_CACHE_SIZE = int(os.environ.get('SHAPING_CACHE_SIZE', 4096))
+
+
+@functools.lru_cache(maxsize=SHAPING_CACHE_SIZE)
+def shape_text(text):
+    """Reshapes and reorders Persian text for FPDF, cached by the raw string."""
+    return get_display(arabic_reshaper.reshape(text))
+
+
+def shape_field(label, value):
+    """
+    Shapes "label: value" for a right-aligned cell with the value kept out of
+    the bidi pass, which would otherwise print 250102-0001 as 0001-250102.
+    """
+    return f'{value} {shape_text(label + ":")}'
+
+
+def format_amount(amount):
+    # Digits and thousands separators come out of reshape/bidi unchanged
+    return f'{amount:,}'
+
+
+@functools.lru_cache(maxsize=SHAPING_CACHE_SIZE)
+def wrap_product_name(name, max_width=38):
+    """Returns the shaped, wrapped product name and its number of lines."""
+    wrapped_lines = textwrap.wrap(shape_text(name), width=max_width, break_long_words=False)
+    # Reverse the order of wrapped lines for correct Arabic/Persian display
+    wrapped_lines = wrapped_lines[::-1]
+    return "\n".join(wrapped_lines), len(wrapped_lines)
+
+
+# برچسب‌های ثابت فاکتور که یک بار شکل‌دهی می‌شوند
+LABELS = {key: shape_text(text) for key, text in {
+    'title': 'به نام ایزد یکتا',
+    'invoice_title': 'فاکتور فروش',
+    'brand': 'خانه هوشمند کهربا',
+    'total_price': 'قیمت کل (تومان)',
+    'unit_price': 'قیمت واحد (تومان)',
+    'quantity': 'تعداد',
+    'description': 'شرح کالا یا خدمات',
+    'row': 'ردیف',
+    'installation_fee': 'اجرت نصب و راه‌اندازی سیستم',
+    'grand_total': 'جمع کل',
+    'footer_validity': '• با توجه به نوسانات نرخ ارز اعتبار پیش فاکتور تنها یک روز می باشد.',
+    'footer_contact': '• شماره تماس 09109359043',
+}.items()}
+
+
+# رجیستری فونت‌ها: فونت‌ها یک بار در هر پروسه خوانده می‌شوند
+FONT_FILES = {'': 'Vazir.ttf', 'B': 'Vazir-Bold.ttf'}
+
+
+class FontRegistry:
+    """
+    Parses the Vazir fonts once per process and attaches copies of their
+    metrics to every new InvoicePDF, so creating an invoice never re-reads
+    the TTF files or their .pkl caches.
+    """
+
+    def __init__(self, font_files):
+        self.font_files = font_files
+        self.fonts = {}
+        self.family = 'Arial'
+        self.loaded = False
+
+    def load(self):
+        if self.loaded:
+            return
+        for style, path in self.font_files.items():
+            if not os.path.exists(path):
+                logger.warning("فایل فونت %s یافت نشد.", path)
+                continue
+            pdf = FPDF()
+            pdf.add_font('Vazir', style, path, uni=True)
+            fontkey = 'vazir' + style
+            font = dict(pdf.fonts[fontkey])
+            # Without a .pkl name FPDF computes the low-range widths in memory at
+            # output time instead of loading Vazir.cw127.pkl from disk
+            font['unifilename'] = None
+            self.fonts[fontkey] = (font, pdf.font_files[fontkey], path)
+        if 'vazir' in self.fonts:
+            self.family = 'Vazir'
+        else:
+            logger.warning("فایل فونت یافت نشد، از Arial استفاده می‌شود.")
+        self.loaded = True
+
+    def attach(self, pdf, family, style=''):
+        """Adds the font to the document on first use, like FPDF.add_font would."""
+        self.attach_key(pdf, family.lower() + style.upper())
+
+    def attach_key(self, pdf, fontkey):
+        if fontkey in pdf.fonts or fontkey not in self.fonts:
+            return
+        font, font_file, path = self.fonts[fontkey]
+        # Metrics are shared read-only; the glyph subset is per document
+        pdf.fonts[fontkey] = dict(font, i=len(pdf.fonts) + 1, subset=list(range(0, 32)))
+        pdf.font_files[fontkey] = dict(font_file)
+        pdf.font_files[path] = {'type': 'TTF'}
+
+
+font_registry = FontRegistry(FONT_FILES)
+
+
+# لوگوی فروشگاه: یک بار در اندازه مناسب ذخیره و نسخه پردازش‌شده آن در حافظه نگه داشته می‌شود
+LOGO_DIR = os.environ.get('LOGO_DIR', 'logos')
+LOGO_CACHE_DIR = os.environ.get('LOGO_CACHE_DIR', 'logoCache')  # Converted copies of logos stored before uploads were normalized
+NORMALIZE_LOGOS = os.environ.get('NORMALIZE_LOGOS', '0') == '1'  # Convert them all at startup instead of on first use
+LOGO_WIDTH_MM = 30
+LOGO_DPI = int(os.environ.get('LOGO_DPI', 300))
+LOGO_MAX_WIDTH = round(LOGO_WIDTH_MM / 25.4 * LOGO_DPI)  # pixels
+LOGO_MAX_UPLOAD_BYTES = int(os.environ.get('LOGO_MAX_UPLOAD_BYTES', 10 * 1024 * 1024))
+LOGO_MAX_PIXELS = int(os.environ.get('LOGO_MAX_PIXELS', 50_000_000))  # Decoded size, against decompression bombs
+LOGO_FORMATS = ('JPEG', 'PNG', 'WEBP', 'GIF', 'BMP')
+LOGO_WORKERS = int(os.environ.get('LOGO_WORKERS', 2))
+
+
+def normalize_logo(image):
+    """
+    Returns an 8-bit RGB copy of the image, flattened onto white and scaled
+    down to fill the 30 mm logo box at LOGO_DPI. FPDF embeds such a PNG's
+    compressed data as-is, without unpacking an alpha channel.
+    """
+    if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    else:
+        image = image.convert('RGB')
+    if image.width > LOGO_MAX_WIDTH:
+        height = max(1, round(image.height * LOGO_MAX_WIDTH / image.width))
+        image = image.resize((LOGO_MAX_WIDTH, height), Image.LANCZOS)
+    return image
+
+
+def save_logo(image, file_path):
+    image = normalize_logo(image)
+    image.info.clear()  # No EXIF, ICC profile or text chunks in the stored PNG
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True, icc_profile=None)
+    # Renders read the logo at any time, so it is replaced in one step; the
+    # temporary name is per process, as replicas may convert the same logo
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    temp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(buffer.getvalue())
+    os.replace(temp_path, file_path)
+
+
+class LogoRejected(Exception):
+    """An uploaded logo that cannot be used; the message is shown to the user."""
+
+
+def ingest_logo(data, file_path):
+    """
+    Validates an uploaded image and stores it as the seller's logo. Runs in
+    the logo worker threads; raises LogoRejected for unusable uploads.
+    """
+    if len(data) > LOGO_MAX_UPLOAD_BYTES:
+        raise LogoRejected(f"حجم تصویر نباید بیشتر از {LOGO_MAX_UPLOAD_BYTES // (1024 * 1024)} مگابایت باشد.")
+    try:
+        # Only the header is read here; nothing is decoded yet
+        image = Image.open(io.BytesIO(data))
+    except (OSError, Image.DecompressionBombError):
+        raise LogoRejected("فایل ارسال‌شده یک تصویر معتبر نیست.")
+    if image.format not in LOGO_FORMATS:
+        raise LogoRejected("فرمت تصویر پشتیبانی نمی‌شود. لطفاً تصویر JPG یا PNG ارسال کنید.")
+    if image.width * image.height > LOGO_MAX_PIXELS:
+        raise LogoRejected("ابعاد تصویر بیش از حد بزرگ است.")
+    # JPEGs are decoded at the smallest scale that still covers the logo box
+    # (either side may become the width once the EXIF rotation is applied)
+    image.draft('RGB', (LOGO_MAX_WIDTH, LOGO_MAX_WIDTH))
+    try:
+        image = ImageOps.exif_transpose(image)
+        save_logo(image, file_path)
+    except (OSError, SyntaxError, ValueError):
+        raise LogoRejected("تصویر ارسال‌شده خراب است یا قابل خواندن نیست.")
+    return file_path
+
+
+logo_workers = None
+
+
+async def process_logo(data, file_path):
+    """Runs ingest_logo off the event loop, at most LOGO_WORKERS uploads at a time."""
+    global logo_workers
+    if logo_workers is None:
+        logo_workers = ThreadPoolExecutor(max_workers=LOGO_WORKERS, thread_name_prefix='logos')
+    return await asyncio.get_running_loop().run_in_executor(logo_workers, ingest_logo, data, file_path)
+
+
+def normalized_logo(file_path, signature):
+    """
+    Returns the path of a PDF-ready version of a stored logo. Logos saved
+    before uploads were normalized get a converted copy in LOGO_CACHE_DIR,
+    named after the original's mtime and size; the original is never
+    modified, and a copy that exists is reused by every replica.
+    """
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    cached = os.path.join(LOGO_CACHE_DIR, f'{name}-{signature[0]}-{signature[1]}.png')
+    if os.path.exists(cached):
+        return cached
+    with Image.open(file_path) as image:
+        if image.mode == 'RGB' and image.width <= LOGO_MAX_WIDTH and 'icc_profile' not in image.info:
+            return file_path
+        image.load()
+    save_logo(image, cached)
+    # Copies made for an older version of this logo are no longer used
+    for stale in os.listdir(LOGO_CACHE_DIR):
+        if stale.endswith('.png') and stale.rsplit('-', 2)[0] == name and stale != os.path.basename(cached):
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(LOGO_CACHE_DIR, stale))
+    logger.info("نسخه بهینه لوگوی %s ساخته شد.", name)
+    return cached
+
+
+def normalize_existing_logos():
+    # Optional warm-up (NORMALIZE_LOGOS=1); otherwise each logo is converted on first use
+    if not os.path.isdir(LOGO_DIR):
+        return
+    for name in os.listdir(LOGO_DIR):
+        if not name.endswith('.png'):
+            continue  # .tmp files are left over from an interrupted save
+        file_path = os.path.join(LOGO_DIR, name)
+        try:
+            stat = os.stat(file_path)
+            normalized_logo(file_path, (stat.st_mtime_ns, stat.st_size))
+        except Exception:
+            logger.exception("خطا در بهینه‌سازی لوگوی %s", name)
+
+
+class LogoCache:
+    """Parsed logo images per path, reused until the file changes; see normalized_logo."""
+
+    def __init__(self):
+        self.images = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self.images.get(path)
+        if cached and cached[0] == signature:
+            return cached[1]
+        try:
+            source = normalized_logo(path, signature)
+        except (OSError, SyntaxError, ValueError):
+            logger.exception("خطا در بهینه‌سازی لوگوی %s", path)
+            source = path
+        info = FPDF()._parsepng(source)
+        with self.lock:
+            self.images[path] = (signature, info)
+        return info
+
+    def invalidate(self, path):
+        with self.lock:
+            self.images.pop(path, None)
+
+
+logo_cache = LogoCache()
+
+
+# کش قالب ثابت فاکتور (سربرگ، ردیف فروشنده، سرستون جدول و پاورقی) برای هر فروشنده
+INVOICE_TEMPLATES = os.environ.get('INVOICE_TEMPLATES', '1') != '0'
+INVOICE_TEMPLATE_CACHE_SIZE = int(os.environ.get('INVOICE_TEMPLATE_CACHE_SIZE', 512))
+
+
+class InvoiceTemplateCache:
+    """
+    LRU cache of recorded static invoice parts.
+    A recording holds the page content operators a part produced, the glyphs
+    it added to each font subset and the images it placed, so the part can be
+    stamped into another invoice without laying it out again. Keys start with
+    the seller's template key, see InvoicePDF.template_key.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.segments = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            segment = self.segments.get(key)
+            if segment is not None:
+                self.segments.move_to_end(key)
+            return segment
+
+    def put(self, key, segment):
+        with self.lock:
+            self.segments[key] = segment
+            while len(self.segments) > self.max_size:
+                self.segments.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            for key in [key for key in self.segments if key[0][0] == str(user_id)]:
+                del self.segments[key]
+
+
+invoice_templates = InvoiceTemplateCache(INVOICE_TEMPLATE_CACHE_SIZE)
+
+
+def invalidate_invoice_template(user_id):
+    # Render workers keep their own cache; they miss automatically because the
+    # key contains the store info and the logo's mtime and size
+    invoice_templates.invalidate(user_id)
 
 
 # کلاس ایجاد فاکتور
 class InvoicePDF(FPDF):
-    
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        font_registry.load()
+        self.font_name = font_registry.family
+
+    def set_font(self, family, style='', size=0):
+        font_registry.attach(self, family, style)
+        super().set_font(family, style, size)
+
+    def logo_path(self):
+        return os.path.join(LOGO_DIR, f'{self.user_id}.png')
+
+    def template_key(self):
+        try:
+            stat = os.stat(self.logo_path())
+            logo = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            logo = None
+        return (str(self.user_id), self.seller.get('store_name'), self.seller.get('seller_name'), logo, self.font_name)
+
+    def stamp(self, name, draw):
+        """
+        Draws a static part of the invoice. With INVOICE_TEMPLATES on, the part
+        is recorded the first time for this seller and replayed afterwards.
+        """
+        if not INVOICE_TEMPLATES or self.font_name not in ('Vazir',):
+            draw()
+            return
+        if not hasattr(self, 'cached_template_key'):
+            self.cached_template_key = self.template_key()
+        key = (self.cached_template_key, name)
+        segment = invoice_templates.get(key)
+        if segment is not None and self.replay_segment(segment):
+            return
+        segment = self.record_segment(draw)
+        if segment is not None:
+            invoice_templates.put(key, segment)
+
+    def record_segment(self, draw):
+        page = self.page
+        start_length = len(self.pages[page])
+        start_x, start_y = self.x, self.y
+        start_font = (self.font_family, self.font_style, self.font_size_pt)
+        subset_lengths = {fontkey: len(font.get('subset', ())) for fontkey, font in self.fonts.items()}
+        draw()
+        if self.page != page or any(font['type'] != 'TTF' for font in self.fonts.values()):
+            return None  # Page break or core font fallback: not reusable
+        glyphs = {}
+        for fontkey, font in self.fonts.items():
+            # New fonts start with the 32 control codes FPDF always includes
+            glyphs[fontkey] = (font['i'], list(font['subset'][subset_lengths.get(fontkey, 32):]))
+        return {
+            'content': self.pages[page][start_length:],
+            'start': (start_x, start_y), 'end': (self.x, self.y), 'lasth': self.lasth,
+            'start_font': start_font, 'end_font': (self.font_family, self.font_style, self.font_size_pt),
+            'glyphs': glyphs,
+            'images': {name: dict(info) for name, info in self.images.items()},
+        }
+
+    def replay_segment(self, segment):
+        start_x, start_y = segment['start']
+        end_x, end_y = segment['end']
+        if abs(self.x - start_x) > 0.001:
+            return False
+        if not self.in_footer and self.y + (end_y - start_y) > self.page_break_trigger:
+            return False
+
+        # Resources must get the same /F and /I numbers the recording used
+        for fontkey, (index, _) in sorted(segment['glyphs'].items(), key=lambda entry: entry[1][0]):
+            font_registry.attach_key(self, fontkey)
+            if fontkey not in self.fonts or self.fonts[fontkey]['i'] != index:
+                return False
+        for name, info in sorted(segment['images'].items(), key=lambda entry: entry[1]['i']):
+            if name not in self.images:
+                if len(self.images) + 1 != info['i']:
+                    return False
+                self.images[name] = dict(info)
+            elif self.images[name]['i'] != info['i']:
+                return False
+        for fontkey, (_, glyphs) in segment['glyphs'].items():
+            self.fonts[fontkey]['subset'].extend(glyphs)
+
+        if segment['start_font'][0]:
+            self.set_font(*segment['start_font'])
+        dy = self.y - start_y
+        if abs(dy) > 0.001:
+            # Same operators, moved down by dy (PDF y axis points up)
+            self._out(f'q 1 0 0 1 0 {-dy * self.k:.2f} cm')
+            self.pages[self.page] += segment['content']
+            self._out('Q')
+        else:
+            self.pages[self.page] += segment['content']
+        self.x, self.y = end_x, end_y + dy
+        self.lasth = segment['lasth']
+        # The font selected inside the part may not be the current one after Q
+        self.font_family = ''
+        self.set_font(*segment['end_font'])
+        return True
+
+    def draw_letterhead(self):
+        self.set_font(self.font_name, '', 14)
+
+        # Add the logo (aligned to the right)
+        logo_path = self.logo_path()
+        logo = logo_cache.get(logo_path)
+        if logo:
+            if logo_path not in self.images:
+                # FPDF deletes the image data after output, so each document gets its own copy
+                self.images[logo_path] = dict(logo, i=len(self.images) + 1)
+            self.image(logo_path, x=170, y=10, w=LOGO_WIDTH_MM)  # Logo on the right
+
+        # Add the title (centered horizontally)
+        title = LABELS['title']
+        self.set_xy(10, 15)  # Position cursor for the title
+        self.cell(0, 10, title, align='C', ln=True)  # Center the title in the row
+
+        # Add the additional lines
+        line1 = LABELS['invoice_title']
+        line2 = LABELS['brand']
+        self.set_font(self.font_name, '', 12)  # Adjust font size for these lines
+        self.cell(0, 10, line1, align='C', ln=True)  # First additional line
+        self.cell(0, 10, line2, align='C', ln=True)  # Second additional line
+
+        # Add spacing after the header
+        self.ln(10)
+
+    def draw_seller_info(self):
+        store_name = self.seller.get('store_name', 'نام فروشگاه تعریف نشده')
+        seller_name = self.seller.get('seller_name', 'نام فروشنده تعریف نشده')
+        self.cell(95, 10, shape_text(f'توسط: {seller_name}'), 1, 0, 'R')
+        self.cell(95, 10, shape_text(f'فروشگاه: {store_name}'), 1, 1, 'R')
+        self.ln(2)  # Space after seller info
+
+    def draw_table_header(self):
+        self.set_font(self.font_name, '', 12)
+        self.cell(40, 10, LABELS['total_price'], 1, 0, 'C')
+        self.cell(40, 10, LABELS['unit_price'], 1, 0, 'C')
+        self.cell(15, 10, LABELS['quantity'], 1, 0, 'C')
+        self.cell(83, 10, LABELS['description'], 1, 0, 'C')
+        self.cell(12, 10, LABELS['row'], 1, 1, 'C')
+
+    def draw_footer_text(self):
+        # Prepare the footer content
+        self.set_font(self.font_name, '', 10)
+
+        description = LABELS['footer_validity']
+        contact = LABELS['footer_contact']
+
+        # Add the lines to the PDF (right-aligned)
+        self.cell(0, 10, description, align='R', ln=True)
+        self.cell(0, 10, contact, align='R', ln=True)
+
+        # Additional spacing after bullet points (if needed)
+        self.ln(5)
+
     def header(self):
         # Only add the header on the first page
         if self.page_no() == 1:
-            # Add the font
-            if os.path.exists('Vazir.ttf'):
-                self.add_font('Vazir', '', 'Vazir.ttf', uni=True)
-                self.set_font('Vazir', '', 14)
-            else:
-                self.set_font('Arial', '', 14)
-                logger.warning("فایل فونت یافت نشد، از Arial استفاده می‌شود.")
-
-            # Add the logo (aligned to the right)
-            logo_path = f'logos/{self.user_id}.png'  # Adjust based on your storage structure
-            if os.path.exists(logo_path):
-                self.image(logo_path, x=170, y=10, w=30)  # Logo on the right
-
-            # Add the title (centered horizontally)
-            title = get_display(arabic_reshaper.reshape('به نام ایزد یکتا'))
-            self.set_xy(10, 15)  # Position cursor for the title
-            self.cell(0, 10, title, align='C', ln=True)  # Center the title in the row
-
-            # Add the additional lines
-            line1 = get_display(arabic_reshaper.reshape('فاکتور فروش'))
-            line2 = get_display(arabic_reshaper.reshape('خانه هوشمند کهربا'))
-            self.set_font('Vazir', '', 12)  # Adjust font size for these lines
-            self.cell(0, 10, line1, align='C', ln=True)  # First additional line
-            self.cell(0, 10, line2, align='C', ln=True)  # Second additional line
-
-            # Add spacing after the header
-            self.ln(10)
+            self.stamp('letterhead', self.draw_letterhead)
 
             # Seller Info
-            user_data = get_user_data(self.user_id)
-            store_name = user_data.get('store_name', 'نام فروشگاه تعریف نشده')
-            seller_name = user_data.get('seller_name', 'نام فروشنده تعریف نشده')
             current_date = jdatetime.date.today().strftime('%Y/%m/%d')
-
-            # Generate the unique invoice number
-            current_datetime = datetime.now().strftime("%y%m%d%H%M")
-            customer_code = self.customer["code"] if self.customer else "0000"
-            invoice_number = f"{current_datetime}{customer_code}"
+            invoice_number = self.invoice_number  # Same number as the file name
 
             # Layout adjustments for Seller Info
-            self.set_font('Vazir' if os.path.exists('Vazir.ttf') else 'Arial', '', 12)
-            self.cell(95, 10, get_display(arabic_reshaper.reshape(f'تاریخ: {current_date}')), 1, 0, 'R')
-            self.cell(95, 10, get_display(arabic_reshaper.reshape(f'شماره فاکتور: {invoice_number}')), 1, 1, 'R')
-            self.cell(95, 10, get_display(arabic_reshaper.reshape(f'توسط: {seller_name}')), 1, 0, 'R')
-            self.cell(95, 10, get_display(arabic_reshaper.reshape(f'فروشگاه: {store_name}')), 1, 1, 'R')
-            self.ln(2)  # Space after seller info
+            self.set_font(self.font_name, '', 12)
+            self.cell(95, 10, shape_text(f'تاریخ: {current_date}'), 1, 0, 'R')
+            self.cell(95, 10, shape_field('شماره فاکتور', invoice_number), 1, 1, 'R')
+            self.stamp('seller', self.draw_seller_info)
 
             # Add customer details
             customer = self.customer
             if customer:
-                self.cell(95, 10, get_display(arabic_reshaper.reshape(f'نام مشتری: {customer["name"]}')), 1, 0, 'R')
-                self.cell(95, 10, get_display(arabic_reshaper.reshape(f'شماره تماس: {customer["phone"]}')), 1, 1, 'R')
-                self.cell(95, 10, get_display(arabic_reshaper.reshape(f'آدرس: {customer["address"]}')), 1, 0, 'R')
-                self.cell(95, 10, get_display(arabic_reshaper.reshape(f'کد مشتری: {customer["code"]}')), 1, 1, 'R')
+                self.cell(95, 10, shape_text(f'نام مشتری: {customer["name"]}'), 1, 0, 'R')
+                self.cell(95, 10, shape_text(f'شماره تماس: {customer["phone"]}'), 1, 1, 'R')
+                self.cell(95, 10, shape_text(f'آدرس: {customer["address"]}'), 1, 0, 'R')
+                self.cell(95, 10, shape_text(f'کد مشتری: {customer["code"]}'), 1, 1, 'R')
             self.ln(10)
         else:
             # If not the first page, we just return without doing anything (no header)
@@ -120,83 +1789,25 @@ class InvoicePDF(FPDF):
     def footer(self):
         # Move to the last available position after the items
         self.ln(10)  # Add space before the footer
+        self.stamp('footer', self.draw_footer_text)
 
-        # Prepare the footer content
-        self.set_font('Vazir' if os.path.exists('Vazir.ttf') else 'Arial', '', 10)
-        
-        description = get_display(arabic_reshaper.reshape(
-            '• با توجه به نوسانات نرخ ارز اعتبار پیش فاکتور تنها یک روز می باشد.'
-        ))
-        contact = get_display(arabic_reshaper.reshape('• شماره تماس 09109359043'))
-        
-        # Add the lines to the PDF (right-aligned)
-        self.cell(0, 10, description, align='R', ln=True)
-        self.cell(0, 10, contact, align='R', ln=True)
-        
-        # Additional spacing after bullet points (if needed)
-        self.ln(5)
+    def invoice_body(self, invoice):
+        # Table Header for products (excluding installation fee)
+        self.stamp('table_header', self.draw_table_header)
 
-    def invoice_body(self, items):
-        global dollarFee  # Use the global dollarFee variable
-
-        # Step 1: Calculate the total price of items after applying dollarFee
-        total_price = 0
-        for idx, item in enumerate(items, start=1):
-            name, quantity, unit_price = item
-
-            # Apply dollarFee multiplier to the unit price
-            adjusted_unit_price = unit_price * dollarFee
-            
-            # Round the adjusted unit price to the nearest multiple of 1000
-            adjusted_unit_price = round(adjusted_unit_price / 1000) * 1000
-            
-            total = quantity * adjusted_unit_price
-            total_price += total
-
-        # Step 2: Calculate the "اجرت نصب" (installation fee) as 20% of the total price
-        installation_fee = total_price * 0.20  # 20% of the total price
-        installation_fee = round(installation_fee / 1000) * 1000  # Round to the nearest 1000
-
-        # Step 3: Table Header for products (excluding installation fee)
-        self.set_font('Vazir' if os.path.exists('Vazir.ttf') else 'Arial', '', 12)
-        self.cell(40, 10, get_display(arabic_reshaper.reshape('قیمت کل (تومان)')), 1, 0, 'C')
-        self.cell(40, 10, get_display(arabic_reshaper.reshape('قیمت واحد (تومان)')), 1, 0, 'C')
-        self.cell(15, 10, get_display(arabic_reshaper.reshape('تعداد')), 1, 0, 'C')
-        self.cell(83, 10, get_display(arabic_reshaper.reshape('شرح کالا یا خدمات')), 1, 0, 'C')
-        self.cell(12, 10, get_display(arabic_reshaper.reshape('ردیف')), 1, 1, 'C')
-
-        # Step 4: Table Body for products
-        total_price = 0
-        self.set_font('Vazir' if os.path.exists('Vazir.ttf') else 'Arial', '', 12)
-        for idx, item in enumerate(items, start=1):
-            name, quantity, unit_price = item
-
-            # Apply dollarFee multiplier to the unit price
-            adjusted_unit_price = unit_price * dollarFee
-            
-            # Round the adjusted unit price to the nearest multiple of 1000
-            adjusted_unit_price = round(adjusted_unit_price / 1000) * 1000
-            
-            total = quantity * adjusted_unit_price
-            total_price += total
-
-            idx_text = str(idx)
-            quantity_text = str(quantity)
-            unit_price_text = get_display(arabic_reshaper.reshape(f'{adjusted_unit_price:,}'))
-            total_text = get_display(arabic_reshaper.reshape(f'{total:,}'))
+        # Table Body for products
+        self.set_font(self.font_name, '', 12)
+        for line in invoice.lines:
+            idx_text = str(line.row)
+            quantity_text = str(line.quantity)
+            unit_price_text = format_amount(line.adjusted_unit_price)
+            total_text = format_amount(line.total)
 
             # Wrap product name intelligently at spaces
-            name_text = get_display(arabic_reshaper.reshape(name))
-            max_width = 38  # Maximum characters per line
-            wrapped_lines = textwrap.wrap(name_text, width=max_width, break_long_words=False)
-
-            # Reverse the order of wrapped lines for correct Arabic/Persian display
-            wrapped_lines = wrapped_lines[::-1]  
-            wrapped_name = "\n".join(wrapped_lines)
+            wrapped_name, num_lines = wrap_product_name(line.name)
 
             # Calculate the required height for the cell
             line_height = 8  # Adjust the line height for better spacing
-            num_lines = len(wrapped_lines)
             cell_height = line_height * num_lines
 
             # Align other cells to match the height of the name cell
@@ -212,51 +1823,374 @@ class InvoicePDF(FPDF):
 
             self.cell(12, cell_height, idx_text, 1, 1, 'C')  # Move to the next line
 
-        # Step 5: Display Installation Fee as a separate item
-        installation_fee_text = get_display(arabic_reshaper.reshape(f"{installation_fee:,}"))
+        # Display Installation Fee as a separate item
+        installation_fee_text = format_amount(invoice.installation_fee)
         self.cell(40, 10, installation_fee_text, 1, 0, 'C')
-        self.cell(150, 10, get_display(arabic_reshaper.reshape('اجرت نصب و راه‌اندازی سیستم')), 1, 1, 'R')
+        self.cell(150, 10, LABELS['installation_fee'], 1, 1, 'R')
 
-        # Step 6: Total Price (including اجرت نصب)
-        total_price_with_installation = total_price + installation_fee
-        total_price_text = get_display(arabic_reshaper.reshape(f'{total_price_with_installation:,} تومان'))
+        # Total Price (including اجرت نصب)
+        total_price_text = shape_text(f'{format_amount(invoice.total)} تومان')
         self.cell(40, 10, total_price_text, 1, 0, 'C')
-        self.cell(150, 10, get_display(arabic_reshaper.reshape('جمع کل')), 1, 1, 'R')
+        self.cell(150, 10, LABELS['grand_total'], 1, 1, 'R')
 
 
+# تابع ایجاد فاکتور
 
 
 
-# تابع ایجاد فاکتور
+def get_seller_info(user_id):
+    user_data = get_user_data(user_id)
+    return {key: user_data[key] for key in ('store_name', 'seller_name') if user_data.get(key)}
 
 
+def generate_invoice_pdf(items, user_id, customer=None, seller=None, invoice=None, invoice_number=None):
+    # Callers that already priced the draft pass the InvoiceModel in
+    if invoice is None:
+        invoice = price_invoice(items)
 
-def generate_invoice_pdf(items, user_id, customer=None):
-    # Generate the unique invoice number and file name
-    current_datetime = datetime.now().strftime("%y%m%d%H%M")
-    customer_code = customer["code"] if customer else "0000"
-    invoice_number = f"{current_datetime}{customer_code}"
+    # The seller info is passed in by callers running in a render worker,
+    # which must not touch the storage layer
+    if seller is None:
+        seller = get_seller_info(user_id)
+
+    # The number is allocated once by the caller and used for both the file
+    # name and the header; only in-process callers may leave it out
+    if invoice_number is None:
+        invoice_number = submit_write(allocate_invoice_numbers, user_id).result()[0]
+
+    file_path = invoice_file_path(user_id, invoice_number, customer)
+    write_invoice_file(file_path, render_invoice_pdf(user_id, customer, seller, invoice, invoice_number))
+    return file_path  # Return the full path of the generated invoice
 
-    # Create folder for the user if it doesn't exist
-    user_folder = os.path.join("invoiceFiles", str(user_id))
-    os.makedirs(user_folder, exist_ok=True)
 
-    # Create the invoice file name with invoice number and customer name
+def invoice_file_path(user_id, invoice_number, customer):
+    # The invoice file name holds the invoice number and customer name
     customer_name = customer["name"] if customer else "Unknown"
-    invoice_filename = f"{invoice_number}_{customer_name}.pdf"
-    file_path = os.path.join(user_folder, invoice_filename)
+    return os.path.join(INVOICE_DIR, str(user_id), f"{invoice_number}_{customer_name}.pdf")
+
 
-    # Generate the PDF invoice
+def render_invoice_pdf(user_id, customer, seller, invoice, invoice_number):
+    """Lays out an already priced and numbered invoice and returns the PDF bytes; nothing is written to disk."""
     pdf = InvoicePDF()
     pdf.customer = customer
     pdf.user_id = user_id
+    pdf.seller = seller
     pdf.invoice_number = invoice_number  # Pass the invoice number to the header
 
-    pdf.add_page()
-    pdf.invoice_body(items)
-    pdf.output(file_path)
+    with metrics.stage('layout_header'):
+        pdf.add_page()
+    with metrics.stage('layout_body'):
+        pdf.invoice_body(invoice)
+    with metrics.stage('pdf_output'):
+        data = pdf.output(dest='S')
+    metrics.inc('invoices_rendered_total')
+    # fpdf 1.x returns the document as a latin-1 str, fpdf2 as a bytearray
+    return data.encode('latin-1') if isinstance(data, str) else bytes(data)
+
+
+def render_invoice_job(*args):
+    # Runs in a render worker; the worker's timings travel back with the PDF
+    data = render_invoice_pdf(*args)
+    return data, metrics.export(reset=True)
+
+
+def write_invoice_file(file_path, data):
+    # Create folder for the user if it doesn't exist
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    # Readers (/resend, the archiver) never see a half-written file
+    with open(file_path + '.tmp', 'wb') as file:
+        file.write(data)
+    os.replace(file_path + '.tmp', file_path)
+
+
+# ذخیره فایل فاکتورها خارج از مسیر پاسخ به کاربر
+INVOICE_FILE_WRITERS = int(os.environ.get('INVOICE_FILE_WRITERS', 2))
+
+invoice_file_writer = None
+
+
+def store_invoice_file(file_path, data, entries=()):
+    # The ledger row is written after the file, so /resend only finds invoices it can open
+    write_invoice_file(file_path, data)
+    if entries:
+        record_invoices(entries).result()
+    return file_path
+
+
+def log_failed_invoice_file(future):
+    if future.exception() is not None:
+        logger.error("ذخیره فایل فاکتور ناموفق بود.", exc_info=future.exception())
 
-    return file_path  # Return the full path of the generated invoice
+
+def save_invoice_file(file_path, data, entries=()):
+    """
+    Queues the rendered PDF (and optionally its ledger entries) to be written
+    by a background thread and returns the future. The user is sent the
+    in-memory bytes meanwhile; drain_invoice_files() waits for the queue.
+    """
+    global invoice_file_writer
+    if invoice_file_writer is None:
+        invoice_file_writer = ThreadPoolExecutor(max_workers=INVOICE_FILE_WRITERS, thread_name_prefix='invoice-files')
+    future = invoice_file_writer.submit(store_invoice_file, file_path, data, entries)
+    future.add_done_callback(log_failed_invoice_file)
+    return future
+
+
+def drain_invoice_files():
+    global invoice_file_writer
+    if invoice_file_writer is not None:
+        invoice_file_writer.shutdown(wait=True)
+        invoice_file_writer = None
+
+
+# صف رندر فاکتور در پروسه‌های جداگانه
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', os.cpu_count() or 1))
+RENDER_QUEUE_LIMIT = int(os.environ.get('RENDER_QUEUE_LIMIT', RENDER_WORKERS * 4))  # queued + running jobs
+RENDER_TIMEOUT = float(os.environ.get('RENDER_TIMEOUT', 30))  # seconds per job
+
+render_pool = None
+pending_renders = 0
+
+
+class RenderQueueFull(Exception):
+    pass
+
+
+def render_pool_context():
+    # Forking a process that already runs the storage writer, the event loop and
+    # PTB's threads can copy a held lock into the child; start clean workers
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def init_render_worker():
+    # Ctrl+C is handled by the parent, which shuts the pool down cleanly
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    font_registry.load()
+
+
+def get_render_pool():
+    global render_pool
+    if render_pool is None:
+        render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=render_pool_context(),
+                                          initializer=init_render_worker)
+    return render_pool
+
+
+async def run_render_job(fn, *args):
+    """
+    Runs fn(*args) in the process pool and returns its result. Raises
+    RenderQueueFull when RENDER_QUEUE_LIMIT jobs are already waiting or
+    running, and asyncio.TimeoutError when the job takes longer than
+    RENDER_TIMEOUT (the worker still finishes it in the background).
+    """
+    global pending_renders
+    if pending_renders >= RENDER_QUEUE_LIMIT:
+        raise RenderQueueFull()
+    pending_renders += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(get_render_pool(), fn, *args), RENDER_TIMEOUT)
+    finally:
+        pending_renders -= 1
+
+
+async def render_invoice(items, user_id, customer, seller, invoice=None, invoice_number=None):
+    """
+    Runs render_invoice_pdf in the process pool and returns the invoice's
+    file path and PDF bytes; the file is not written yet (see save_invoice_file).
+    Raises like run_render_job.
+    """
+    # Workers must not touch the storage layer, which numbering and the rate need
+    if invoice is None:
+        invoice = price_invoice(items)
+    if invoice_number is None:
+        invoice_number = (await next_invoice_numbers(user_id))[0]
+    with metrics.stage('render'):
+        data, worker_metrics = await run_render_job(render_invoice_job, user_id, customer, seller,
+                                                    invoice, invoice_number)
+    metrics.merge(worker_metrics)
+    return invoice_file_path(user_id, invoice_number, customer), data
+
+
+def shutdown_render_pool():
+    global render_pool
+    if render_pool is not None:
+        # Let queued and running renders finish before exiting
+        render_pool.shutdown(wait=True)
+        render_pool = None
+    drain_invoice_files()
+
+
+# صدور گروهی فاکتور
+BATCH_MAX_DRAFTS = int(os.environ.get('BATCH_MAX_DRAFTS', 500))
+
+
+def resolve_batch_drafts(drafts, user_data):
+    """
+    Turns batch drafts into (items, customer) pairs using the seller's
+    current catalog, so re-running a batch re-prices it.
+    A draft looks like {"customer": "CUST001", "items": [["<product id>", 2], ...]};
+    an item may also be given in full as [name, quantity, unit_price], and the
+    customer as a {"name", "phone", "address", "code"} object.
+    Returns the resolved drafts, their row numbers in the file and a list of
+    error messages.
+    """
+    products = user_data.get('products', {})
+    customers = user_data.get('customers', {})
+    resolved, rows, errors = [], [], []
+    for number, draft in enumerate(drafts, start=1):
+        try:
+            customer = draft['customer']
+            if not isinstance(customer, dict):
+                customer = customers[str(customer)]
+            items = []
+            for item in draft['items']:
+                if len(item) == 3:
+                    name, quantity, unit_price = item
+                else:
+                    product_id, quantity = item
+                    product = products[str(product_id)]
+                    name, unit_price = product['name'], product['price']
+                if int(quantity) <= 0:
+                    raise ValueError(quantity)
+                items.append((name, int(quantity), unit_price))
+            if not items:
+                raise ValueError('empty draft')
+            resolved.append((items, customer))
+            rows.append(number)
+        except KeyError as e:
+            errors.append(f"پیش‌نویس {number}: شناسه {e} یافت نشد.")
+        except (TypeError, ValueError) as e:
+            errors.append(f"پیش‌نویس {number}: فرمت نامعتبر ({e})")
+    return resolved, rows, errors
+
+
+def render_invoice_batch(resolved, user_id, seller, out, workers=None, progress=None):
+    """
+    Renders drafts across a process pool with generate_invoice_pdf and writes
+    each PDF into the ZIP stream `out` as soon as it is ready.
+    progress(done, total) is called after every invoice. A draft that fails
+    to render is logged and skipped; the others are still zipped and
+    recorded. Returns the number issued and the indexes in `resolved` of the
+    drafts that were not.
+    """
+    numbers = submit_write(allocate_invoice_numbers, user_id, len(resolved)).result()
+    invoices = [price_invoice(items) for items, _ in resolved]
+    entries, failed = [], []
+    try:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=render_pool_context(),
+                                 initializer=init_render_worker) as pool, \
+                zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as archive:
+            futures = {
+                pool.submit(generate_invoice_pdf, items, user_id, customer, seller, invoice, number): index
+                for index, ((items, customer), number, invoice) in enumerate(zip(resolved, numbers, invoices))
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                index = futures[future]
+                try:
+                    file_path = future.result()
+                except Exception as e:
+                    logger.error("صدور فاکتور %s از گروه کاربر %s ناموفق بود: %r", numbers[index], user_id, e)
+                    failed.append(index)
+                else:
+                    archive.write(file_path, arcname=os.path.basename(file_path))
+                    entries.append(invoice_ledger_entry(user_id, numbers[index], resolved[index][1],
+                                                        invoices[index], file_path))
+                if progress:
+                    progress(done, len(futures))
+    finally:
+        record_invoices(entries).result()
+    return len(entries), sorted(failed)
+
+
+async def render_invoice_batch_async(resolved, user_id, seller, out, progress=None):
+    """
+    Bot variant of render_invoice_batch that shares the render pool with
+    interactive invoices. If a render times out, or the queue stays full for
+    RENDER_TIMEOUT, the drafts not rendered yet are cancelled; invoices that
+    did render are still zipped, saved and recorded. Returns the number
+    issued and the indexes in `resolved` of the drafts that were not.
+    """
+    numbers = await next_invoice_numbers(user_id, len(resolved))
+    slots = asyncio.Semaphore(RENDER_WORKERS)
+    entries, saved, issued = [], [], set()
+
+    async def render_one(items, customer, number):
+        invoice = price_invoice(items)
+        async with slots:
+            deadline = time.monotonic() + RENDER_TIMEOUT
+            while True:
+                try:
+                    file_path, data = await render_invoice(items, user_id, customer, seller, invoice, number)
+                    break
+                except RenderQueueFull:
+                    # Interactive invoices go first
+                    if time.monotonic() > deadline:
+                        raise
+                    await asyncio.sleep(0.5)
+        entries.append(invoice_ledger_entry(user_id, number, customer, invoice, file_path))
+        saved.append(asyncio.wrap_future(save_invoice_file(file_path, data)))
+        return file_path, data
+
+    tasks = [asyncio.ensure_future(render_one(items, customer, number))
+             for (items, customer), number in zip(resolved, numbers)]
+    indexes = {task: index for index, task in enumerate(tasks)}
+    pending = set(tasks)
+    try:
+        with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as archive:
+            while pending:
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    if task.cancelled():
+                        continue
+                    error = task.exception()
+                    if isinstance(error, (RenderQueueFull, asyncio.TimeoutError)):
+                        logger.warning("صدور گروهی فاکتورهای کاربر %s متوقف شد: %r", user_id, error)
+                        for waiting in pending:
+                            waiting.cancel()
+                        continue
+                    file_path, data = task.result()
+                    # Zipped straight from memory instead of reading the file back
+                    await asyncio.to_thread(archive.writestr, os.path.basename(file_path), data)
+                    issued.add(indexes[task])
+                    if progress:
+                        await progress(len(issued), len(tasks))
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*saved)
+        await asyncio.wrap_future(record_invoices(entries))
+    return len(issued), [index for index in range(len(tasks)) if index not in issued]
+
+
+def batch_cli(argv):
+    parser = argparse.ArgumentParser(prog='invoice-bot.py batch', description='صدور گروهی فاکتور در قالب فایل ZIP')
+    parser.add_argument('drafts', help='JSON file with a list of drafts')
+    parser.add_argument('--user', required=True, help='Telegram user id of the seller')
+    parser.add_argument('--output', default='invoices.zip')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    init_storage()
+    font_registry.load()
+    with open(args.drafts, 'r', encoding='utf-8') as file:
+        drafts = json.load(file)
+    resolved, rows, errors = resolve_batch_drafts(drafts, get_user_data(args.user))
+    for error in errors:
+        print(error, file=sys.stderr)
+
+    def progress(done, total):
+        print(f"\r{done}/{total}", end='', file=sys.stderr, flush=True)
+
+    started = time.perf_counter()
+    with open(args.output, 'wb') as out:
+        count, failed = render_invoice_batch(resolved, args.user, get_seller_info(args.user), out, args.workers, progress)
+    elapsed = time.perf_counter() - started
+    print(f"\n{count} فاکتور در {elapsed:.1f} ثانیه ({count / elapsed:.1f} فاکتور در ثانیه) -> {args.output}", file=sys.stderr)
+    if failed:
+        print("صدور این پیش‌نویس‌ها ناموفق بود: " + "، ".join(str(rows[index]) for index in failed), file=sys.stderr)
+    close_storage()
 
 
 # تابع مدیریت بات تلگرام
@@ -285,25 +2219,25 @@ async def contact_handler(update, context):
     phone_number = contact.phone_number
     user_data = get_user_data(user_id)
     user_data['phone_number'] = phone_number
-    user_data['state'] = 'awaiting_store_info'
     save_user_data(user_id, user_data)
+    update_user_state(user_id, 'awaiting_store_info')
     await update.message.reply_text('شماره تلفن شما ذخیره شد. لطفاً نام فروشگاه و نام فروشنده را به شکل زیر وارد کنید:\n\nفروشگاه: نام فروشگاه - فروشنده: نام فروشنده')
 
 async def handle_store_info(update, context):
     user_id = str(update.effective_user.id)
-    user_data = get_user_data(user_id)
-
-    if user_data.get('state') != 'awaiting_store_info':
+    if get_user_state(user_id) != 'awaiting_store_info':
         return False  # State does not match, so return and continue to next handler
 
+    user_data = get_user_data(user_id)
     try:
         store_info = update.message.text.split('-')
         store_name = store_info[0].split(':')[1].strip()
         seller_name = store_info[1].split(':')[1].strip()
         user_data['store_name'] = store_name
         user_data['seller_name'] = seller_name
-        user_data['state'] = 'ready'
         save_user_data(user_id, user_data)
+        invalidate_invoice_template(user_id)
+        update_user_state(user_id, 'ready')
         await update.message.reply_text('اطلاعات فروشگاه شما ذخیره شد.')
         return True  # Input processed successfully
     except (IndexError, ValueError):
@@ -311,13 +2245,216 @@ async def handle_store_info(update, context):
 
 
 
+# جستجو و صفحه‌بندی محصولات
+PICKER_PAGE_SIZE = int(os.environ.get('PICKER_PAGE_SIZE', 8))
+SEARCH_INDEX_CACHE_SIZE = int(os.environ.get('SEARCH_INDEX_CACHE_SIZE', 256))
+CUSTOMER_CODE_MAX_BYTES = 48  # Callback data is limited to 64 bytes
+
+# Arabic letter variants, ZWNJ, tatweel, diacritics and non-ASCII digits
+PERSIAN_NORMALIZATION = str.maketrans({
+    'ي': 'ی', 'ى': 'ی', 'ئ': 'ی', 'ك': 'ک', 'ة': 'ه', 'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ؤ': 'و',
+    '\u200c': ' ', '\u0640': None,
+    **{chr(code): None for code in range(0x064B, 0x0653)}, '\u0670': None,
+    **{persian: str(digit) for digit, persian in enumerate('۰۱۲۳۴۵۶۷۸۹')},
+    **{arabic: str(digit) for digit, arabic in enumerate('٠١٢٣٤٥٦٧٨٩')},
+})
+
+
+def normalize_persian(text):
+    return text.translate(PERSIAN_NORMALIZATION).lower()
+
+
+def search_tokens(text):
+    return re.findall(r'\w+', normalize_persian(text))
+
+
+class SearchIndex:
+    """
+    Token index over one user's catalog (products or customers).
+    Keys keep the catalog order; a query matches entries that have, for every
+    query token, a token starting with it, so "کلید هوش" finds
+    "کلید روشنایی هوشمند".
+    """
+
+    def __init__(self, entries, fields):
+        self.fields = fields
+        self.keys = []
+        self.positions = {}
+        self.postings = {}
+        for key, entry in entries.items():
+            self._index(key, entry)
+        self.tokens = sorted(self.postings)
+
+    @property
+    def size(self):
+        return len(self.keys)
+
+    def _index(self, key, entry):
+        position = len(self.keys)
+        self.keys.append(key)
+        self.positions[key] = position
+        text = ' '.join(str(entry.get(field, '')) for field in self.fields)
+        for token in set(search_tokens(text)):
+            if token not in self.postings:
+                self.postings[token] = []
+                if hasattr(self, 'tokens'):
+                    bisect.insort(self.tokens, token)
+            self.postings[token].append(position)
+
+    def add(self, key, entry):
+        """Indexes a new entry in place; returns False if the key already exists."""
+        if key in self.positions:
+            return False
+        self._index(key, entry)
+        return True
+
+    def search(self, query):
+        result = None
+        for token in search_tokens(query):
+            matches = set()
+            for candidate in self.tokens[bisect.bisect_left(self.tokens, token):]:
+                if not candidate.startswith(token):
+                    break
+                matches.update(self.postings[candidate])
+            result = matches if result is None else result & matches
+            if not result:
+                break
+        return [self.keys[position] for position in sorted(result or ())]
+
+
+def normalize_phone(phone):
+    # 09123456789, +989123456789, 00989123456789 and ۰۹۱۲... all become 9123456789
+    digits = re.sub(r'\D', '', normalize_persian(str(phone)))
+    return digits[-10:] if len(digits) >= 10 else digits
+
+
+def normalize_name(name):
+    return ' '.join(search_tokens(name))
+
+
+class CustomerIndex(SearchIndex):
+    """SearchIndex over customers, plus exact lookups by phone and by name."""
+
+    def __init__(self, entries, fields):
+        self.by_phone = {}
+        self.by_name = {}
+        super().__init__(entries, fields)
+
+    def _index(self, key, entry):
+        super()._index(key, entry)
+        phone = normalize_phone(entry.get('phone', ''))
+        if phone:
+            self.by_phone.setdefault(phone, []).append(key)
+        self.by_name.setdefault(normalize_name(entry.get('name', '')), []).append(key)
+
+    def lookup(self, text):
+        """Customer codes matching `text` exactly as a code, phone number or name."""
+        text = text.strip()
+        if text in self.positions:
+            return [text]
+        phone = normalize_phone(text)
+        if len(phone) >= 7 and phone in self.by_phone:
+            return self.by_phone[phone]
+        return self.by_name.get(normalize_name(text), [])
+
+
+class SearchIndexCache:
+    """
+    LRU cache of per-user search indexes, keyed by (user_id, catalog name).
+    Handlers that add an entry call add() so a cached index stays current;
+    an index whose size no longer matches the catalog (e.g. changed by
+    another replica) is rebuilt.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id, catalog, entries, fields, index_class=SearchIndex):
+        key = (str(user_id), catalog)
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is not None and index.size == len(entries):
+                self.indexes.move_to_end(key)
+                return index
+        index = index_class(entries, fields)
+        with self.lock:
+            self.indexes[key] = index
+            while len(self.indexes) > self.max_size:
+                self.indexes.popitem(last=False)
+        return index
+
+    def add(self, user_id, catalog, key, entry):
+        with self.lock:
+            index = self.indexes.get((str(user_id), catalog))
+            if index is not None and not index.add(key, entry):
+                # An existing entry changed; rebuild on next use
+                del self.indexes[(str(user_id), catalog)]
+
+    def invalidate(self, user_id, catalog):
+        with self.lock:
+            self.indexes.pop((str(user_id), catalog), None)
+
+
+search_indexes = SearchIndexCache(SEARCH_INDEX_CACHE_SIZE)
+PRODUCT_FIELDS = ('name',)
+CUSTOMER_FIELDS = ('name', 'phone', 'code')
+
+
+def customer_index(user_id, customers):
+    return search_indexes.get(user_id, 'customers', customers, CUSTOMER_FIELDS, CustomerIndex)
+
+
+def paginate(keys, page):
+    """Returns the keys on `page` (clamped), the page number and the page count."""
+    pages = max(1, math.ceil(len(keys) / PICKER_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    return keys[page * PICKER_PAGE_SIZE:(page + 1) * PICKER_PAGE_SIZE], page, pages
+
+
+def picker_keyboard(kind, buttons, page, pages):
+    """Inline keyboard with one button per entry and a prev / page / next row."""
+    rows = [[InlineKeyboardButton(text, callback_data=f'{kind}:pick:{key}')] for key, text in buttons]
+    if pages > 1:
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton('« قبلی', callback_data=f'{kind}:page:{page - 1}'))
+        navigation.append(InlineKeyboardButton(f'{page + 1}/{pages}', callback_data=f'{kind}:noop:'))
+        if page < pages - 1:
+            navigation.append(InlineKeyboardButton('بعدی »', callback_data=f'{kind}:page:{page + 1}'))
+        rows.append(navigation)
+    return InlineKeyboardMarkup(rows)
+
+
+def product_picker(user_id, page=0):
+    """Returns the text and inline keyboard for one page of the product picker."""
+    products = get_user_data(user_id).get('products', {})
+    query = get_session(user_id).get('product_query')
+    index = search_indexes.get(user_id, 'products', products, PRODUCT_FIELDS)
+    product_ids = index.search(query) if query else index.keys
+    shown, page, pages = paginate(product_ids, page)
+    buttons = [(product_id, f"{products[product_id]['name']} - {products[product_id]['price']}")
+               for product_id in shown if product_id in products]
+    reply_markup = picker_keyboard('product', buttons, page, pages)
+    if query:
+        if not product_ids:
+            text = f"محصولی با «{query}» یافت نشد. عبارت دیگری بفرستید."
+        else:
+            text = f"{len(product_ids)} محصول برای «{query}» پیدا شد:"
+        reply_markup = InlineKeyboardMarkup(tuple(reply_markup.inline_keyboard) + (
+            (InlineKeyboardButton('همه محصولات', callback_data='product:all:'),),))
+    else:
+        text = "لطفاً محصول مورد نظر را انتخاب کنید یا بخشی از نام آن را برای جستجو بفرستید:"
+    return text, reply_markup
+
+
 async def handle_add_item(update, context):
     user_id = str(update.effective_user.id)
-    user_data = get_user_data(user_id)
-
-    if user_data.get('state') != 'adding_item':
+    if get_user_state(user_id) != 'adding_item':
         return False  # State does not match, so return and continue to next handler
 
+    user_data = get_user_data(user_id)
     product_id = update.message.text.strip()
     products = user_data.get('products', {})
 
@@ -326,12 +2463,10 @@ async def handle_add_item(update, context):
         return False  # Return False to allow other handlers to process the input
 
     product = products[product_id]
-    if 'items' not in context.user_data:
-        context.user_data['items'] = []
-
-    context.user_data['items'].append((product['name'], 1, product['price']))
-    user_data['state'] = 'ready'  # Reset state after adding the item
-    save_user_data(user_id, user_data)
+    session = get_session(user_id)
+    session['items'].append((product['name'], 1, product['price']))
+    session['state'] = 'ready'  # Reset state after adding the item
+    save_session(user_id)
 
     await update.message.reply_text(f"محصول '{product['name']}' به فاکتور اضافه شد.")
     return True  # Input processed successfully
@@ -346,49 +2481,82 @@ async def add_item_handler(update, context):
         await update.message.reply_text("شما هیچ محصولی ثبت نکرده‌اید. ابتدا از گزینه 'افزودن محصول' استفاده کنید.")
         return
 
-    # Generate a dynamic keyboard with product names
-    keyboard = [[KeyboardButton(f"{product['name']} (ID: {product_id})")] for product_id, product in products.items()]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
-
     # Update user state
-    user_data['state'] = 'selecting_product'
-    save_user_data(user_id, user_data)
+    session = get_session(user_id)
+    session['state'] = 'selecting_product'
+    session['product_query'] = None
+    save_session(user_id)
 
-    await update.message.reply_text("لطفاً محصول مورد نظر را انتخاب کنید:", reply_markup=reply_markup)
+    # One page of an inline keyboard; the rest is reached by paging or search
+    text, reply_markup = product_picker(user_id)
+    await update.message.reply_text(text, reply_markup=reply_markup)
 
 async def handle_product_selection(update, context):
     user_id = str(update.effective_user.id)
-    user_data = get_user_data(user_id)
-
-    if user_data.get('state') != 'selecting_product':
+    if get_user_state(user_id) != 'selecting_product':
         return  # Ignore if the user is not selecting a product.
 
-    # Extract product ID from the selected text
     selected_text = update.message.text
-    product_id = selected_text.split("(ID:")[1].split(")")[0].strip()
+    if "(ID:" in selected_text:
+        # A button from the old reply keyboard that may still be on screen
+        product_id = selected_text.split("(ID:")[1].split(")")[0].strip()
+        await select_product(update.message, user_id, product_id)
+        return
 
-    products = user_data.get('products', {})
+    # Anything else is a search over product names
+    session = get_session(user_id)
+    session['product_query'] = selected_text.strip()
+    save_session(user_id)
+    text, reply_markup = product_picker(user_id)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+
+async def product_pick_callback(update, context, product_id):
+    user_id = str(update.effective_user.id)
+    if get_user_state(user_id) != 'selecting_product':
+        await update.callback_query.answer("این فهرست دیگر فعال نیست. دوباره «افزودن آیتم» را بزنید.")
+        return
+    await update.callback_query.answer()
+    await select_product(update.callback_query.message, user_id, product_id)
+
+
+async def product_page_callback(update, context, page):
+    user_id = str(update.effective_user.id)
+    await update.callback_query.answer()
+    text, reply_markup = product_picker(user_id, int(page))
+    await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+
+
+async def product_all_callback(update, context, argument):
+    user_id = str(update.effective_user.id)
+    get_session(user_id)['product_query'] = None
+    save_session(user_id)
+    await product_page_callback(update, context, 0)
+
+
+async def select_product(message, user_id, product_id):
+    products = get_user_data(user_id).get('products', {})
     if product_id not in products:
-        await update.message.reply_text("محصول انتخاب‌شده معتبر نیست. لطفاً دوباره تلاش کنید.")
+        await message.reply_text("محصول انتخاب‌شده معتبر نیست. لطفاً دوباره تلاش کنید.")
         return
 
     # Save the selected product ID and update state
-    context.user_data['selected_product'] = product_id
-    user_data['state'] = 'awaiting_quantity'
-    save_user_data(user_id, user_data)
+    session = get_session(user_id)
+    session['selected_product'] = product_id
+    session['state'] = 'awaiting_quantity'
+    save_session(user_id)
 
-    await update.message.reply_text(
+    await message.reply_text(
         f"محصول '{products[product_id]['name']}' انتخاب شد. لطفاً تعداد آن را با پیشوند 'q' وارد کنید (مثال: q3 برای تعداد 3)."
     )
 
-from telegram import ReplyKeyboardMarkup, KeyboardButton
 
 async def handle_quantity_input(update, context):
     user_id = str(update.effective_user.id)
-    user_data = get_user_data(user_id)
+    session = get_session(user_id)
 
     # Check the state
-    if user_data.get('state') != 'awaiting_quantity':
+    if session['state'] != 'awaiting_quantity':
         return  # Ignore if the user is not entering a quantity.
 
     # Extract the quantity from the message (e.g., "q3")
@@ -403,23 +2571,19 @@ async def handle_quantity_input(update, context):
         return
 
     # Retrieve the selected product
-    product_id = context.user_data.get('selected_product')
+    product_id = session['selected_product']
     if not product_id:
         await update.message.reply_text("محصول انتخاب‌شده معتبر نیست. لطفاً دوباره تلاش کنید.")
         return
 
-    products = user_data.get('products', {})
+    products = get_user_data(user_id).get('products', {})
     product = products[product_id]
 
-    # Add the item to the invoice
-    if 'items' not in context.user_data:
-        context.user_data['items'] = []
-
-    context.user_data['items'].append((product['name'], quantity, product['price']))
-
-    # Reset user state
-    user_data['state'] = 'ready'
-    save_user_data(user_id, user_data)
+    # Add the item to the invoice and reset user state
+    session['items'].append((product['name'], quantity, product['price']))
+    session['selected_product'] = None
+    session['state'] = 'ready'
+    save_session(user_id)
 
     # Initial keyboard
     keyboard = [
@@ -438,10 +2602,6 @@ async def handle_quantity_input(update, context):
 
 async def add_product_handler(update, context):
     user_id = str(update.effective_user.id)
-    user_data = get_user_data(user_id)
-    if 'products' not in user_data:
-        user_data['products'] = {}
-
     update_user_state(user_id, 'adding_product')
     await update.message.reply_text(
         "لطفاً محصول خود را به شکل زیر وارد کنید:\n\nنام محصول-قیمت واحد\n\nمثال: نازل-10000"
@@ -450,21 +2610,21 @@ async def add_product_handler(update, context):
 
 async def add_product(update, context):
     user_id = str(update.effective_user.id)
-    user_data = get_user_data(user_id)
-
-    if user_data.get('state') != 'adding_product':
+    if get_user_state(user_id) != 'adding_product':
         return False  # State does not match, so return and continue to next handler
 
+    user_data = get_user_data(user_id)
     try:
         product_info = update.message.text.split('-')
         name = product_info[0].strip()
         price = int(product_info[1].strip())
-        last_product_id = user_data['last_product_id']
+        last_product_id = user_data.get('last_product_id', 0)
         product_id = f"{user_id}-{last_product_id + 1}"  # Unique ID per user
         user_data['last_product_id'] = last_product_id + 1
-        user_data['products'][product_id] = {"name": name, "price": price}
-        user_data['state'] = 'ready'
+        user_data.setdefault('products', {})[product_id] = {"name": name, "price": price}
         save_user_data(user_id, user_data)
+        search_indexes.add(user_id, 'products', product_id, user_data['products'][product_id])
+        update_user_state(user_id, 'ready')
         await update.message.reply_text(f"محصول '{name}' با قیمت {price} تومان اضافه شد. شناسه محصول: {product_id}")
         return True  # Input processed successfully
     except (IndexError, ValueError):
@@ -472,72 +2632,251 @@ async def add_product(update, context):
 
 
 
-async def view_products(update, context):
-    user_id = str(update.effective_user.id)
-    user_data = get_user_data(user_id)
-    products = user_data.get('products', {})
-    if not products:
-        await update.message.reply_text("شما هیچ محصولی ثبت نکرده‌اید.")
+# فهرست‌های صفحه‌بندی‌شده و خروجی CSV/PDF
+LISTING_PAGE_CHARS = int(os.environ.get('LISTING_PAGE_CHARS', 3500))  # Telegram allows 4096 per message
+CATALOG_SPOOL_BYTES = int(os.environ.get('CATALOG_SPOOL_BYTES', 1 << 20))  # Larger catalog files go to disk
+
+
+def product_line(product_id, product):
+    return f"ID: {product_id}, نام: {product['name']}, قیمت: {product['price']} تومان"
+
+
+def customer_line(code, customer):
+    return f"کد: {code}, نام: {customer['name']}, شماره: {customer['phone']}, آدرس: {customer['address']}"
+
+
+# catalog -> (title, line format, index fields, index class, export columns; the first column is the key)
+LISTINGS = {
+    'products': ("لیست محصولات شما", product_line, PRODUCT_FIELDS, SearchIndex, ('id', 'name', 'price')),
+    'customers': ("لیست مشتریان شما", customer_line, CUSTOMER_FIELDS, CustomerIndex,
+                  ('code', 'name', 'phone', 'address')),
+}
+
+
+def listing_pages(keys, entries, format_line, start=0, limit=LISTING_PAGE_CHARS):
+    """
+    Yields (start, end, lines) for consecutive message-sized pages of a
+    catalog, from keys[start] on. Each page is formatted only when requested.
+    """
+    while start < len(keys):
+        lines, size, end = [], 0, start
+        while end < len(keys):
+            line = format_line(keys[end], entries[keys[end]])[:limit]
+            if lines and size + len(line) + 1 > limit:
+                break
+            lines.append(line)
+            size += len(line) + 1
+            end += 1
+        yield start, end, lines
+        start = end
+
+
+def listing_view(user_id, kind, page=0):
+    """Returns the text and navigation keyboard (or None) for one page of a listing."""
+    title, format_line, fields, index_class, _ = LISTINGS[kind]
+    entries = get_user_data(user_id).get(kind, {})
+    keys = search_indexes.get(user_id, kind, entries, fields, index_class).keys
+
+    # Page boundaries found so far, so "next" and "previous" never rescan the list
+    session = get_session(user_id)
+    listing = session.get('listing')
+    if not listing or listing['kind'] != kind or listing['size'] != len(keys):
+        listing = session['listing'] = {'kind': kind, 'size': len(keys), 'starts': [0]}
+    starts = listing['starts']
+    while len(starts) <= page:
+        _, end, _ = next(listing_pages(keys, entries, format_line, starts[-1]))
+        if end >= len(keys):
+            break
+        starts.append(end)
+    page = min(max(page, 0), len(starts) - 1)
+    start, end, lines = next(listing_pages(keys, entries, format_line, starts[page]))
+    if end < len(keys) and len(starts) == page + 1:
+        starts.append(end)
+    save_session(user_id)
+
+    if start == 0 and end == len(keys):
+        return f"{title}:\n" + "\n".join(lines), None
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton('« قبلی', callback_data=f'list:{kind}:{page - 1}'))
+    if end < len(keys):
+        navigation.append(InlineKeyboardButton('بعدی »', callback_data=f'list:{kind}:{page + 1}'))
+    export = [InlineKeyboardButton('دریافت CSV', callback_data=f'export:{kind}:csv'),
+              InlineKeyboardButton('دریافت PDF', callback_data=f'export:{kind}:pdf')]
+    text = f"{title} ({start + 1} تا {end} از {len(keys)}):\n" + "\n".join(lines)
+    return text, InlineKeyboardMarkup([navigation, export])
+
+
+def catalog_rows(kind, entries):
+    columns = LISTINGS[kind][4]
+    for key, entry in entries.items():
+        yield (key,) + tuple(entry.get(column, '') for column in columns[1:])
+
+
+def catalog_csv(kind, entries):
+    """
+    Writes the whole catalog as CSV (UTF-8 with BOM, so Excel shows Persian)
+    row by row and returns the file; large catalogs spill to disk. The file
+    can be imported again with /import.
+    """
+    buffer = tempfile.SpooledTemporaryFile(CATALOG_SPOOL_BYTES)
+    text = io.TextIOWrapper(buffer, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text)
+    writer.writerow(LISTINGS[kind][4])
+    writer.writerows(catalog_rows(kind, entries))
+    text.flush()
+    text.detach()
+    buffer.seek(0)
+    return buffer
+
+
+class ListingPDF(FPDF):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        font_registry.load()
+        self.font_name = font_registry.family
+
+    def set_font(self, family, style='', size=0):
+        font_registry.attach(self, family, style)
+        super().set_font(family, style, size)
+
+
+# Column widths (mm) of the PDF export, matching LISTINGS' export columns
+LISTING_PDF_WIDTHS = {
+    'products': (35, 115, 40),
+    'customers': (30, 50, 35, 75),
+}
+
+
+def generate_listing_pdf(kind, rows):
+    """Renders a catalog export as a right-to-left table; runs in the render pool."""
+    pdf = ListingPDF()
+    pdf.set_auto_page_break(True, margin=15)
+    pdf.add_page()
+    pdf.set_font(pdf.font_name, '', 14)
+    pdf.cell(0, 10, shape_text(LISTINGS[kind][0]), ln=1, align='C')
+    pdf.set_font(pdf.font_name, '', 9)
+    widths = LISTING_PDF_WIDTHS[kind]
+    for row in rows:
+        # The first column is drawn rightmost
+        for width, value in reversed(list(zip(widths, row))):
+            text = str(value)[:int(width / 1.8)]
+            pdf.cell(width, 7, shape_text(text), border=1, align='R')
+        pdf.ln()
+    return pdf.output(dest='S').encode('latin-1')
+
+
+async def send_listing(message, user_id, kind, empty_text):
+    if not get_user_data(user_id).get(kind):
+        await message.reply_text(empty_text)
         return
+    text, reply_markup = listing_view(user_id, kind)
+    await message.reply_text(text, reply_markup=reply_markup)
+
 
-    product_list = "لیست محصولات شما:\n"
-    for product_id, product in products.items():
-        product_list += f"ID: {product_id}, نام: {product['name']}, قیمت: {product['price']} تومان\n"
-    await update.message.reply_text(product_list)
+async def listing_page_callback(kind, update, context, page):
+    user_id = str(update.effective_user.id)
+    await update.callback_query.answer()
+    text, reply_markup = listing_view(user_id, kind, int(page))
+    await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+
+
+async def send_catalog_file(message, user_id, kind, file_format):
+    entries = get_user_data(user_id).get(kind, {})
+    timestamp = datetime.now().strftime('%Y%m%d-%H%M')
+    if file_format == 'pdf':
+        # Queued and timed out like invoices, which share the render pool
+        try:
+            document = await run_render_job(generate_listing_pdf, kind, list(catalog_rows(kind, entries)))
+        except RenderQueueFull:
+            await message.reply_text("سرور در حال حاضر شلوغ است. لطفاً چند لحظه دیگر دوباره تلاش کنید.")
+            return
+        except asyncio.TimeoutError:
+            logger.warning("آماده‌سازی PDF فهرست کاربر %s بیش از %s ثانیه طول کشید.", user_id, RENDER_TIMEOUT)
+            await message.reply_text("آماده‌سازی فایل PDF بیش از حد طول کشید. لطفاً دوباره تلاش کنید یا فایل CSV را دریافت کنید.")
+            return
+    elif file_format == 'xlsx' and openpyxl is not None:
+        document = await asyncio.to_thread(catalog_xlsx, kind, dict(entries))
+    else:
+        file_format = 'csv'
+        document = await asyncio.to_thread(catalog_csv, kind, dict(entries))
+    try:
+        await message.reply_document(document=document, filename=f'{kind}-{timestamp}.{file_format}')
+    finally:
+        # CSV and XLSX exports are spooled files that may have spilled to disk
+        if hasattr(document, 'close'):
+            document.close()
+
+
+async def export_callback(kind, update, context, file_format):
+    user_id = str(update.effective_user.id)
+    await update.callback_query.answer("در حال آماده‌سازی فایل...")
+    await send_catalog_file(update.callback_query.message, user_id, kind, file_format)
+
+
+async def view_products(update, context):
+    user_id = str(update.effective_user.id)
+    await send_listing(update.message, user_id, 'products', "شما هیچ محصولی ثبت نکرده‌اید.")
 
 
 async def store_logo_handler(update, context):
     user_id = str(update.effective_user.id)
-    user_data = get_user_data(user_id)
 
     # Check if the user is in the correct state
-    if user_data.get('state') != 'awaiting_logo_upload':
+    if get_user_state(user_id) != 'awaiting_logo_upload':
         await update.message.reply_text("لطفاً ابتدا گزینه 'آپلود لوگوی فروشگاه' را انتخاب کنید.")
         return
 
-    # Check if a photo is included in the update
-    if not update.message.photo:
+    # A photo, or an image sent as a file (keeps a PNG logo's transparency)
+    if update.message.photo:
+        # Get the highest resolution photo (last in the list)
+        upload = update.message.photo[-1]
+    elif update.message.document and (update.message.document.mime_type or '').startswith('image/'):
+        upload = update.message.document
+    else:
         await update.message.reply_text("لطفاً یک عکس ارسال کنید.")
         return
 
-    # Get the highest resolution photo (last in the list)
-    photo_file = await update.message.photo[-1].get_file()
+    # Telegram reports the size, so oversized uploads are not even downloaded
+    if upload.file_size and upload.file_size > LOGO_MAX_UPLOAD_BYTES:
+        await update.message.reply_text(f"حجم تصویر نباید بیشتر از {LOGO_MAX_UPLOAD_BYTES // (1024 * 1024)} مگابایت باشد.")
+        return
 
-    # Download the photo to a temporary location
+    await update.message.reply_text("تصویر دریافت شد و در حال پردازش است...")
+    photo_file = await upload.get_file()
     temp_file = io.BytesIO()
     await photo_file.download_to_memory(out=temp_file)
-    temp_file.seek(0)
 
-    # Convert the image to PNG format
+    # Scale down and convert the image to a PDF-ready PNG in the logo workers
+    file_path = os.path.join(LOGO_DIR, f"{user_id}.png")
     try:
-        image = Image.open(temp_file)
-        logo_dir = 'logos'
-        os.makedirs(logo_dir, exist_ok=True)
-        file_path = os.path.join(logo_dir, f"{user_id}.png")
-        image.save(file_path, format="PNG")
-    except Exception as e:
-        await update.message.reply_text(f"خطایی رخ داد: {str(e)}")
+        with metrics.stage('logo'):
+            await process_logo(temp_file.getvalue(), file_path)
+    except LogoRejected as e:
+        await update.message.reply_text(str(e))
+        return
+    except Exception:
+        logger.exception("خطا در پردازش لوگوی کاربر %s", user_id)
+        await update.message.reply_text("خطایی در پردازش تصویر رخ داد. لطفاً دوباره تلاش کنید.")
         return
+    logo_cache.invalidate(file_path)
+    invalidate_invoice_template(user_id)
 
     # Reset the user state
-    user_data['state'] = 'ready'
-    save_user_data(user_id, user_data)
+    update_user_state(user_id, 'ready')
 
     await update.message.reply_text("لوگوی فروشگاه شما با موفقیت ذخیره شد.")
 
 
 async def prompt_upload_logo_handler(update, context):
     user_id = str(update.effective_user.id)
-    user_data = get_user_data(user_id)
-    user_data['state'] = 'awaiting_logo_upload'
-    save_user_data(user_id, user_data)
+    update_user_state(user_id, 'awaiting_logo_upload')
     await update.message.reply_text("لطفاً لوگوی فروشگاه خود را به عنوان یک عکس ارسال کنید.")
 
 async def add_customer_handler(update, context):
     user_id = str(update.effective_user.id)
-    user_data = get_user_data(user_id)
-    user_data['state'] = 'adding_customer'
-    save_user_data(user_id, user_data)
+    update_user_state(user_id, 'adding_customer')
 
     await update.message.reply_text(
         "لطفاً اطلاعات مشتری را به شکل زیر وارد کنید:\n\n"
@@ -547,24 +2886,26 @@ async def add_customer_handler(update, context):
 
 async def save_customer(update, context):
     user_id = str(update.effective_user.id)
-    user_data = get_user_data(user_id)
-
-    if user_data.get('state') != 'adding_customer':
+    if get_user_state(user_id) != 'adding_customer':
         return False  # State does not match, so return and continue to next handler
 
+    user_data = get_user_data(user_id)
     try:
         customer_info = update.message.text.split('-')
         name = customer_info[0].strip()
         phone = customer_info[1].strip()
         address = customer_info[2].strip()
         code = customer_info[3].strip()
+        if not code or len(code.encode()) > CUSTOMER_CODE_MAX_BYTES:
+            raise ValueError(code)
 
         if 'customers' not in user_data:
             user_data['customers'] = {}
 
         user_data['customers'][code] = {"name": name, "phone": phone, "address": address, "code": code}
-        user_data['state'] = 'ready'
         save_user_data(user_id, user_data)
+        search_indexes.add(user_id, 'customers', code, user_data['customers'][code])
+        update_user_state(user_id, 'ready')
 
         await update.message.reply_text(f"مشتری '{name}' با کد '{code}' ذخیره شد.")
         return True  # Input processed successfully
@@ -575,21 +2916,8 @@ async def save_customer(update, context):
 
 async def view_customers(update, context):
     user_id = str(update.effective_user.id)
-    user_data = get_user_data(user_id)
-
-    customers = user_data.get('customers', {})
-    if not customers:
-        await update.message.reply_text("شما هیچ مشتری‌ای ثبت نکرده‌اید.")
-        return
-
-    customer_list = "لیست مشتریان شما:\n"
-    for code, customer in customers.items():
-        customer_list += f"کد: {code}, نام: {customer['name']}, شماره: {customer['phone']}, آدرس: {customer['address']}\n"
+    await send_listing(update.message, user_id, 'customers', "شما هیچ مشتری‌ای ثبت نکرده‌اید.")
 
-    await update.message.reply_text(customer_list)
-
-
-from telegram import ReplyKeyboardMarkup, KeyboardButton
 
 async def select_customer_handler(update, context):
     user_id = str(update.effective_user.id)
@@ -600,49 +2928,100 @@ async def select_customer_handler(update, context):
         await update.message.reply_text("شما هیچ مشتری‌ای ثبت نکرده‌اید. ابتدا مشتری اضافه کنید.")
         return
 
-    # Prepare a dynamic keyboard with customer names
-    keyboard = [[KeyboardButton(customer["name"])] for customer in customers.values()]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+    # Update the user state to 'selecting_customer'
+    session = get_session(user_id)
+    session['state'] = 'selecting_customer'
+    session['customer_query'] = None
+    save_session(user_id)
+
+    # Ask the user to select a customer from one page of an inline keyboard
+    text, reply_markup = customer_picker(user_id)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+
+def customer_picker(user_id, page=0):
+    """Returns the text and inline keyboard for one page of the customer picker."""
+    customers = get_user_data(user_id).get('customers', {})
+    query = get_session(user_id).get('customer_query')
+    index = customer_index(user_id, customers)
+    codes = index.search(query) if query else index.keys
+    shown, page, pages = paginate(codes, page)
+    buttons = [(code, f"{customers[code]['name']} - {customers[code]['phone']} ({code})")
+               for code in shown if code in customers]
+    reply_markup = picker_keyboard('customer', buttons, page, pages)
+    if query:
+        if not codes:
+            text = f"مشتری‌ای با «{query}» یافت نشد. نام، شماره یا کد دیگری بفرستید."
+        else:
+            text = f"{len(codes)} مشتری برای «{query}» پیدا شد:"
+        reply_markup = InlineKeyboardMarkup(tuple(reply_markup.inline_keyboard) + (
+            (InlineKeyboardButton('همه مشتریان', callback_data='customer:all:'),),))
+    else:
+        text = "لطفاً مشتری مورد نظر خود را انتخاب کنید یا نام، شماره یا کد او را بفرستید:"
+    return text, reply_markup
 
-    # Ask the user to select a customer
-    await update.message.reply_text("لطفاً مشتری مورد نظر خود را انتخاب کنید:", reply_markup=reply_markup)
 
-    # Update the user state to 'selecting_customer'
-    user_data['state'] = 'selecting_customer'
-    save_user_data(user_id, user_data)
+async def customer_pick_callback(update, context, code):
+    user_id = str(update.effective_user.id)
+    if get_user_state(user_id) != 'selecting_customer':
+        await update.callback_query.answer("این فهرست دیگر فعال نیست. دوباره «انتخاب مشتری» را بزنید.")
+        return
+    await update.callback_query.answer()
+    customer = get_user_data(user_id).get('customers', {}).get(code)
+    if customer is None:
+        await update.callback_query.message.reply_text("مشتری انتخاب‌شده دیگر وجود ندارد.")
+        return
+    await select_customer(update.callback_query.message, user_id, customer)
+
+
+async def customer_page_callback(update, context, page):
+    user_id = str(update.effective_user.id)
+    await update.callback_query.answer()
+    text, reply_markup = customer_picker(user_id, int(page))
+    await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+
+
+async def customer_all_callback(update, context, argument):
+    user_id = str(update.effective_user.id)
+    get_session(user_id)['customer_query'] = None
+    save_session(user_id)
+    await customer_page_callback(update, context, 0)
 
 
 
 async def save_selected_customer(update, context):
     user_id = str(update.effective_user.id)
-    user_data = get_user_data(user_id)
+    session = get_session(user_id)
 
-    if user_data.get('state') != 'selecting_customer':
+    if session['state'] != 'selecting_customer':
         await update.message.reply_text("دستور نامعتبر است.")
         return False
 
-    # Get the selected customer name
-    selected_name = update.message.text.strip()
-    customers = user_data.get('customers', {})
-
-    # Find the customer based on the name
-    selected_customer = None
-    for customer in customers.values():
-        if customer["name"] == selected_name:
-            selected_customer = customer
-            break
+    # An exact code, phone number or name selects directly; anything else
+    # (or a name several customers share) is shown as search results
+    selected_text = update.message.text.strip()
+    customers = get_user_data(user_id).get('customers', {})
+    codes = customer_index(user_id, customers).lookup(selected_text)
+    if len(codes) == 1:
+        await select_customer(update.message, user_id, customers[codes[0]])
+        return True
+
+    session['customer_query'] = selected_text
+    save_session(user_id)
+    text, reply_markup = customer_picker(user_id)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+    return True
 
-    if not selected_customer:
-        await update.message.reply_text(f"مشتری با نام '{selected_name}' یافت نشد. لطفاً دوباره تلاش کنید.")
-        return False
 
-    # Save the selected customer in the context
-    context.user_data['selected_customer'] = selected_customer
-    user_data['state'] = 'ready'
-    save_user_data(user_id, user_data)
+async def select_customer(message, user_id, selected_customer):
+    # Save the selected customer in the session
+    session = get_session(user_id)
+    session['selected_customer'] = selected_customer
+    session['state'] = 'ready'
+    save_session(user_id)
 
     # Send confirmation message with the selected customer
-    await update.message.reply_text(
+    await message.reply_text(
         f"مشتری '{selected_customer['name']}' انتخاب شد."
     )
 
@@ -654,96 +3033,980 @@ async def save_selected_customer(update, context):
         [KeyboardButton("انتخاب مشتری"), KeyboardButton("آپلود لوگوی فروشگاه")]
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard)
-    await update.message.reply_text('لطفاً انتخاب کنید:', reply_markup=reply_markup)
+    await message.reply_text('لطفاً انتخاب کنید:', reply_markup=reply_markup)
+
+
+
+# پیش‌نمایش متنی فاکتور پیش از صدور PDF
+PREVIEW_CACHE_SIZE = int(os.environ.get('PREVIEW_CACHE_SIZE', 1024))
+PREVIEW_MAX_LINES = int(os.environ.get('PREVIEW_MAX_LINES', 40))  # Keeps the preview within one message
+
+
+def draft_fingerprint(items, customer, rate_version):
+    """Short hash of everything the preview shows; it changes with the draft, the customer or the rate."""
+    draft = [[list(item) for item in items], customer and customer.get('code'), customer and customer.get('name'),
+             rate_version]
+    return hashlib.sha256(json.dumps(draft, ensure_ascii=False).encode()).hexdigest()[:16]
+
+
+class PreviewCache:
+    """Latest preview text per user, reused while the draft's fingerprint is unchanged."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.previews = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id, fingerprint):
+        with self.lock:
+            cached = self.previews.get(str(user_id))
+            if cached is None or cached[0] != fingerprint:
+                return None
+            self.previews.move_to_end(str(user_id))
+            return cached[1]
+
+    def put(self, user_id, fingerprint, text):
+        with self.lock:
+            self.previews[str(user_id)] = (fingerprint, text)
+            self.previews.move_to_end(str(user_id))
+            while len(self.previews) > self.max_size:
+                self.previews.popitem(last=False)
+
+
+preview_cache = PreviewCache(PREVIEW_CACHE_SIZE)
+
+
+def invoice_preview_text(invoice, customer):
+    """The invoice table and totals as a message, from the same priced model the PDF is drawn from."""
+    lines = [f"پیش‌نمایش فاکتور برای {customer['name']} (کد {customer['code']}):", ""]
+    for line in invoice.lines[:PREVIEW_MAX_LINES]:
+        lines.append(f"{line.row}. {line.name}: {line.quantity} × {format_amount(line.adjusted_unit_price)} = "
+                     f"{format_amount(line.total)}")
+    if len(invoice.lines) > PREVIEW_MAX_LINES:
+        lines.append(f"... و {len(invoice.lines) - PREVIEW_MAX_LINES} ردیف دیگر")
+    lines += [
+        "",
+        f"جمع اقلام: {format_amount(invoice.subtotal)} تومان",
+        f"اجرت نصب: {format_amount(invoice.installation_fee)} تومان",
+        f"مبلغ کل: {format_amount(invoice.total)} تومان",
+        f"نرخ دلار: {format_amount(invoice.dollar_fee)} تومان",
+    ]
+    return "\n".join(lines)
+
+
+def draft_preview(user_id, session):
+    """Returns (fingerprint, preview text) for the user's draft, pricing it again only when it changed."""
+    items, customer = session['items'], session['selected_customer']
+    fingerprint = draft_fingerprint(items, customer, rate_service.get().version)
+    text = preview_cache.get(user_id, fingerprint)
+    if text is None:
+        text = invoice_preview_text(price_invoice(items), customer)
+        preview_cache.put(user_id, fingerprint, text)
+    return fingerprint, text
+
+
+async def check_draft(message, session):
+    if not session['items']:
+        await message.reply_text("هیچ آیتمی برای صدور فاکتور وجود ندارد.")
+        return False
+    if not session['selected_customer']:
+        await message.reply_text("لطفاً ابتدا یک مشتری انتخاب کنید.")
+        return False
     return True
 
 
+async def send_preview(message, user_id, session):
+    fingerprint, text = draft_preview(user_id, session)
+    reply_markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("تأیید و صدور فاکتور", callback_data=f'invoice:confirm:{fingerprint}'),
+        InlineKeyboardButton("انصراف", callback_data=f'invoice:cancel:{fingerprint}'),
+    ]])
+    await message.reply_text(text, reply_markup=reply_markup)
+
 
 async def generate_invoice(update, context):
+    # Only a preview here; the PDF is rendered once the user confirms it
     user_id = update.effective_user.id
-    items = context.user_data.get('items', [])
-    customer = context.user_data.get('selected_customer')
+    session = get_session(user_id)
+    if await check_draft(update.message, session):
+        await send_preview(update.message, user_id, session)
+
 
-    if not items:
-        await update.message.reply_text("هیچ آیتمی برای صدور فاکتور وجود ندارد.")
+async def invoice_confirm_callback(update, context, fingerprint):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    session = get_session(user_id)
+    await query.answer()
+    if not await check_draft(query.message, session):
+        return
+    if draft_preview(user_id, session)[0] != fingerprint:
+        # The draft or the rate changed after this preview was sent
+        await query.message.reply_text("پیش‌نویس فاکتور پس از این پیش‌نمایش تغییر کرده است. پیش‌نمایش جدید:")
+        await send_preview(query.message, user_id, session)
         return
+    await query.edit_message_reply_markup(reply_markup=None)
+    await issue_invoice(query.message, user_id, session)
+
 
-    if not customer:
-        await update.message.reply_text("لطفاً ابتدا یک مشتری انتخاب کنید.")
+async def invoice_cancel_callback(update, context, fingerprint):
+    query = update.callback_query
+    await query.answer()
+    await query.edit_message_reply_markup(reply_markup=None)
+    await query.message.reply_text("صدور فاکتور لغو شد. پیش‌نویس شما حفظ شده است.")
+
+
+async def issue_invoice(message, user_id, session):
+    items = session['items']
+    customer = session['selected_customer']
+
+    # Render in the worker pool so other users are not blocked meanwhile
+    seller = get_seller_info(user_id)
+    if pending_renders >= RENDER_WORKERS:
+        await message.reply_text("درخواست شما در صف صدور فاکتور قرار گرفت، لطفاً کمی صبر کنید...")
+    invoice = price_invoice(items)
+    invoice_number = (await next_invoice_numbers(user_id))[0]
+    try:
+        file_path, data = await render_invoice(list(items), user_id, customer, seller, invoice, invoice_number)
+    except RenderQueueFull:
+        await message.reply_text("سرور در حال حاضر شلوغ است. لطفاً چند لحظه دیگر دوباره «صدور فاکتور» را بزنید.")
+        return
+    except asyncio.TimeoutError:
+        logger.warning("صدور فاکتور کاربر %s بیش از %s ثانیه طول کشید.", user_id, RENDER_TIMEOUT)
+        await message.reply_text("صدور فاکتور بیش از حد طول کشید. لطفاً دوباره تلاش کنید.")
         return
 
-    # Generate the invoice file and get the file path
-    file_path = generate_invoice_pdf(items=items, user_id=user_id, customer=customer)
+    # The file and its ledger entry are written in the background while the
+    # PDF is uploaded straight from memory
+    save_invoice_file(file_path, data, [invoice_ledger_entry(user_id, invoice_number, customer, invoice, file_path)])
 
     # Send the invoice file with the correct name
-    with open(file_path, 'rb') as file:
-        await update.message.reply_document(document=file)
+    with metrics.stage('upload'):
+        await message.reply_document(document=data, filename=os.path.basename(file_path))
+    metrics.inc('invoices_issued_total')
 
     # Clear items and customer after sending the invoice
-    context.user_data['items'] = []
-    context.user_data['selected_customer'] = None
+    session['items'] = []
+    session['selected_customer'] = None
+    save_session(user_id)
 
-    await update.message.reply_text("فاکتور شما صادر شد.")
+    await message.reply_text("فاکتور شما صادر شد.")
 
 
-async def handle_input(update, context, handlers):
-        """
-        Iterates over the handlers and calls the first one that can process the input.
-        """
-        for handler in handlers:
-            # Check if the handler can process the input
-            if await handler(update, context):
-                return  # Exit as the handler has processed the input
-        # If no handler processed the input, continue to the next one
-        await update.message.reply_text("فرمت وارد شده معتبر نیست یا در حال حاضر قابل پردازش نیست.")
+async def batch_command_handler(update, context):
+    user_id = str(update.effective_user.id)
+    update_user_state(user_id, 'awaiting_batch_file')
+    await update.message.reply_text(
+        "فایل JSON پیش‌نویس‌ها را ارسال کنید. هر پیش‌نویس به این شکل است:\n\n"
+        '{"customer": "CUST001", "items": [["شناسه محصول", 2]]}\n\n'
+        "قیمت‌ها از لیست محصولات فعلی شما خوانده می‌شوند."
+    )
 
 
-async def main_handler(update, context):
-    handlers = [add_product, save_customer,save_selected_customer, handle_store_info, handle_add_item]
-    await handle_input(update, context, handlers)
+async def batch_document_handler(update, context):
+    user_id = str(update.effective_user.id)
+    if get_user_state(user_id) != 'awaiting_batch_file':
+        await update.message.reply_text("برای صدور گروهی ابتدا دستور /batch را ارسال کنید.")
+        return
 
+    document_file = await update.message.document.get_file()
+    buffer = io.BytesIO()
+    await document_file.download_to_memory(out=buffer)
+    try:
+        drafts = json.loads(buffer.getvalue().decode('utf-8'))
+        if not isinstance(drafts, list):
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("فایل ارسالی یک لیست JSON معتبر نیست.")
+        return
+    if len(drafts) > BATCH_MAX_DRAFTS:
+        await update.message.reply_text(f"حداکثر {BATCH_MAX_DRAFTS} پیش‌نویس در هر فایل مجاز است.")
+        return
 
-# تابع اصلی
-def main():
-    # توکن بات خود را اینجا وارد کنید
-    application = Application.builder().token("7519056333:AAHY5c1yScb9ezdeJwpkL3FJVnVlf2XsPuM").build()
+    update_user_state(user_id, 'ready')
+    resolved, rows, errors = resolve_batch_drafts(drafts, get_user_data(user_id))
+    if errors:
+        await update.message.reply_text("این پیش‌نویس‌ها نادیده گرفته شدند:\n" + "\n".join(errors[:20]))
+    if not resolved:
+        return
 
-    # اضافه کردن هندلرها
-    application.add_handler(CommandHandler("start", start))                         # Start the bot
-    application.add_handler(MessageHandler(filters.CONTACT, contact_handler))       # Handle contact sharing
-    application.add_handler(MessageHandler(filters.Regex('^مشاهده محصولات$'), view_products))     # View Products
-    application.add_handler(MessageHandler(filters.Regex('^افزودن محصول$'), add_product_handler))  # Add Product
-    application.add_handler(MessageHandler(filters.Regex('^صدور فاکتور$'), generate_invoice))     # Generate Invoice
-    application.add_handler(MessageHandler(filters.Regex('^آپلود لوگوی فروشگاه$'), prompt_upload_logo_handler))  # Button handler
-    application.add_handler(MessageHandler(filters.Regex('^افزودن آیتم$'), add_item_handler))  # Show products
+    status = await update.message.reply_text(f"در حال صدور {len(resolved)} فاکتور...")
+
+    async def progress(done, total):
+        # Editing on every invoice would hit Telegram's rate limits
+        if done == total or done % 5 == 0:
+            await status.edit_text(f"صدور فاکتورها: {done}/{total}")
+
+    archive = io.BytesIO()
+    count, failed = await render_invoice_batch_async(resolved, user_id, get_seller_info(user_id), archive, progress)
+    if count:
+        archive.seek(0)
+        filename = f"invoices-{datetime.now().strftime('%y%m%d%H%M')}.zip"
+        await update.message.reply_document(document=archive, filename=filename)
+    if failed:
+        await update.message.reply_text(
+            "صدور این پیش‌نویس‌ها به دلیل شلوغی سرور متوقف شد؛ لطفاً آن‌ها را دوباره ارسال کنید:\n" +
+            "، ".join(str(rows[index]) for index in failed[:50]) + ("، ..." if len(failed) > 50 else "")
+        )
+    await update.message.reply_text(f"{count} فاکتور صادر شد.")
+
+
+# فهرست و ارسال دوباره فاکتورهای صادرشده
+def parse_ledger_date(text):
+    """Parses 1403/10/12 (Jalali) or 2025-01-02 (Gregorian) into a local-midnight timestamp."""
+    year, month, day = map(int, re.split(r'[/.-]', text.translate(PERSIAN_NORMALIZATION)))
+    if year < 1700:
+        gregorian = jdatetime.date(year, month, day).togregorian()
+    else:
+        gregorian = datetime(year, month, day)
+    return time.mktime(gregorian.timetuple())
 
-    application.add_handler(MessageHandler(filters.Regex('^افزودن مشتری$'), add_customer_handler))
-    application.add_handler(MessageHandler(filters.Regex('^مشاهده مشتریان$'), view_customers))
-    application.add_handler(MessageHandler(filters.Regex('^انتخاب مشتری$'), select_customer_handler))
 
-    # Product Selection
-    application.add_handler(MessageHandler(filters.Regex(r'.*\(ID:.*\)'), handle_product_selection))  
+def invoice_line(entry):
+    customer = entry['customer_name'] or entry['customer_code'] or '-'
+    total = f"{format_amount(entry['total'])} تومان" if entry['total'] is not None else '-'
+    created = jdatetime.datetime.fromtimestamp(entry['created_at']).strftime('%Y/%m/%d %H:%M')
+    return f"{entry['invoice_number']} | {customer} | {total} | {created}"
 
-    # Quantity Input
-    application.add_handler(MessageHandler(filters.Regex(r'^[Qq]\d+$'), handle_quantity_input))
-    application.add_handler(MessageHandler(filters.Regex(r'^[Cc]\d+$'), save_selected_customer))
-    application.add_handler(MessageHandler(filters.PHOTO, store_logo_handler))  # Photo upload handler
 
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, main_handler))  # Save customer info
+async def list_invoices_handler(update, context):
+    user_id = str(update.effective_user.id)
+    # Arguments: an optional customer code and one date (that day) or two dates (a range)
+    customer_code, dates = None, []
+    try:
+        for argument in context.args or []:
+            if re.fullmatch(r'[\d۰-۹٠-٩]+[/.-][\d۰-۹٠-٩]+[/.-][\d۰-۹٠-٩]+', argument):
+                dates.append(parse_ledger_date(argument))
+            else:
+                customer_code = argument
+        if len(dates) > 2:
+            raise ValueError(dates)
+    except ValueError:
+        await update.message.reply_text(
+            "نمونه‌ها: /invoices  یا  /invoices CUST001  یا  /invoices 1403/10/01 1403/10/30"
+        )
+        return
+    since = dates[0] if dates else None
+    until = (dates[-1] + 86400) if dates else None  # The last day is included
 
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_store_info))  # Store information
+    entries = await asyncio.to_thread(find_invoices, user_id, customer_code, since, until)
+    if not entries:
+        await update.message.reply_text("فاکتوری پیدا نشد.")
+        return
+    more = f"\n(فقط {INVOICE_LIST_LIMIT} فاکتور آخر نمایش داده شد)" if len(entries) == INVOICE_LIST_LIMIT else ""
+    await update.message.reply_text(
+        "فاکتورهای شما:\n" + "\n".join(invoice_line(entry) for entry in entries) + more +
+        "\n\nبرای دریافت دوباره: /resend شماره فاکتور"
+    )
 
-    # Product Management Handlers
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, add_product))          # Process Product Input
 
-    # Invoice Management Handlers
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_add_item))      # Process Item Addition
+async def resend_invoice_handler(update, context):
+    user_id = str(update.effective_user.id)
+    if not context.args:
+        await update.message.reply_text("شماره فاکتور را بعد از دستور بفرستید، مثلاً: /resend 250102-0001")
+        return
+    invoice_number = context.args[0].translate(PERSIAN_NORMALIZATION)
+    entries = await asyncio.to_thread(find_invoices, user_id, None, None, None, invoice_number, 1)
+    if not entries:
+        await update.message.reply_text("فاکتوری با این شماره پیدا نشد.")
+        return
+    file_path = entries[0]['file_path']
+    try:
+        file = await asyncio.to_thread(open_invoice, file_path)
+        with file:
+            await update.message.reply_document(document=file, filename=os.path.basename(file_path))
+    except FileNotFoundError:
+        await update.message.reply_text("فایل این فاکتور دیگر موجود نیست.")
 
 
+async def rate_command_handler(update, context):
+    user_id = str(update.effective_user.id)
+    if not context.args:
+        current = rate_service.current
+        set_at = jdatetime.datetime.fromtimestamp(current.set_at).strftime('%Y/%m/%d %H:%M')
+        await update.message.reply_text(
+            f"نرخ فعلی دلار: {current.rate} تومان\nنسخه {current.version}، منبع: {current.source}، {set_at}"
+        )
+        return
+    if user_id not in RATE_ADMIN_IDS:
+        await update.message.reply_text("فقط مدیر بات می‌تواند نرخ دلار را تغییر دهد.")
+        return
+    try:
+        rate = parse_rate(context.args[0])
+    except ValueError:
+        await update.message.reply_text("نرخ وارد شده معتبر نیست. مثال: /rate 84500")
+        return
+    current = await asyncio.wrap_future(submit_write(rate_service.set, rate, f'admin:{user_id}'))
+    await update.message.reply_text(f"نرخ دلار به {rate} تومان تغییر کرد (نسخه {current.version}).")
+
+
+# ورود و خروج گروهی محصولات و مشتریان (CSV/XLSX)
+try:
+    import openpyxl  # Optional: only needed for .xlsx files
+except ImportError:
+    openpyxl = None
+
+IMPORT_MAX_ROWS = int(os.environ.get('IMPORT_MAX_ROWS', 20000))
+
+# Header names accepted besides the export column names
+CATALOG_HEADER_ALIASES = {
+    'شناسه': 'id', 'شناسه محصول': 'id', 'نام': 'name', 'نام محصول': 'name', 'نام مشتری': 'name',
+    'قیمت': 'price', 'قیمت واحد': 'price', 'کد': 'code', 'کد مشتری': 'code',
+    'شماره': 'phone', 'شماره تلفن': 'phone', 'تلفن': 'phone', 'آدرس': 'address',
+}
+
+# Columns a header must have; customers are checked first since both catalogs have a name
+CATALOG_REQUIRED_COLUMNS = {
+    'customers': ('code', 'name'),
+    'products': ('name', 'price'),
+}
+
+
+class CatalogImportError(Exception):
+    """The uploaded file cannot be imported at all (format, encoding, header or size)."""
+
+
+def catalog_xlsx(kind, entries):
+    """Writes the catalog as an XLSX sheet in openpyxl's streaming write-only mode."""
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet(kind)
+    sheet.append(LISTINGS[kind][4])
+    for row in catalog_rows(kind, entries):
+        sheet.append(row)
+    buffer = tempfile.SpooledTemporaryFile(CATALOG_SPOOL_BYTES)
+    workbook.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+
+def read_table_rows(file, filename):
+    """Yields the rows of an uploaded CSV or XLSX file one at a time, as lists of strings."""
+    if filename.lower().endswith('.xlsx'):
+        if openpyxl is None:
+            raise CatalogImportError("پشتیبانی از فایل XLSX روی سرور نصب نیست؛ لطفاً فایل را به صورت CSV بفرستید.")
+        try:
+            workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        except (zipfile.BadZipFile, KeyError, ValueError):
+            raise CatalogImportError("فایل XLSX قابل خواندن نیست.")
+        try:
+            for row in workbook.active.iter_rows(values_only=True):
+                yield ['' if value is None else str(value) for value in row]
+        finally:
+            workbook.close()
+        return
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    try:
+        yield from csv.reader(text)
+    except UnicodeDecodeError:
+        raise CatalogImportError("فایل CSV باید با کدگذاری UTF-8 ذخیره شده باشد.")
+    except csv.Error:
+        raise CatalogImportError("فایل CSV قابل خواندن نیست.")
+    finally:
+        text.detach()
+
+
+def catalog_columns(header):
+    """Matches a header row to a catalog; returns the kind and {column: position}."""
+    names = [CATALOG_HEADER_ALIASES.get(cell.strip(), cell.strip().lower()) for cell in header]
+    for kind, required in CATALOG_REQUIRED_COLUMNS.items():
+        if all(column in names for column in required):
+            return kind, {column: names.index(column) for column in LISTINGS[kind][4] if column in names}
+    raise CatalogImportError(
+        "سطر اول فایل باید نام ستون‌ها باشد:\n"
+        "محصولات: id, name, price (ستون id اختیاری است)\n"
+        "مشتریان: code, name, phone, address"
+    )
+
+
+def parse_price(text):
+    try:
+        price = Decimal(text.translate(PERSIAN_NORMALIZATION).replace(',', '').replace('٬', ''))
+    except ArithmeticError:
+        raise ValueError(text)
+    if not price.is_finite() or price < 0:
+        raise ValueError(text)
+    return int(price) if price == price.to_integral_value() else float(price)
+
+
+def parse_product_row(values):
+    if not values['name']:
+        raise ValueError("نام محصول خالی است")
+    try:
+        price = parse_price(values['price'])
+    except ValueError:
+        raise ValueError(f"قیمت «{values['price']}» معتبر نیست")
+    return values.get('id') or None, {"name": values['name'], "price": price}
+
+
+def parse_customer_row(values):
+    code = values['code']
+    if not code or len(code.encode()) > CUSTOMER_CODE_MAX_BYTES:
+        raise ValueError(f"کد مشتری «{code}» معتبر نیست")
+    if not values['name']:
+        raise ValueError("نام مشتری خالی است")
+    return code, {"name": values['name'], "phone": values.get('phone', ''),
+                  "address": values.get('address', ''), "code": code}
+
+
+CATALOG_ROW_PARSERS = {
+    'products': parse_product_row,
+    'customers': parse_customer_row,
+}
+
+
+def parse_catalog_file(file, filename, max_rows=IMPORT_MAX_ROWS):
+    """
+    Reads an uploaded catalog one row at a time and validates it. Returns the
+    catalog kind, the valid rows as (key, entry) pairs and one error per bad
+    row. Products without an id (or with an id from another catalog) have a
+    key of None and are numbered when the import is applied.
+    """
+    entries, errors = [], []
+    rows = read_table_rows(file, filename)
+    try:
+        kind, positions = catalog_columns(next(rows, []))
+        parse_row = CATALOG_ROW_PARSERS[kind]
+        for line, row in enumerate(rows, start=2):
+            if not any(cell.strip() for cell in row):
+                continue
+            if len(entries) + len(errors) >= max_rows:
+                raise CatalogImportError(f"حداکثر {max_rows} ردیف در هر فایل مجاز است.")
+            values = {column: row[position].strip() if position < len(row) else ''
+                      for column, position in positions.items()}
+            try:
+                entries.append(parse_row(values))
+            except ValueError as e:
+                errors.append(f"ردیف {line}: {e}")
+    finally:
+        rows.close()  # Releases the reader before the upload is closed
+    return kind, entries, errors
+
+
+def apply_catalog_import(user_id, kind, entries):
+    """
+    Merges imported rows into the user's catalog: existing ids and codes are
+    updated, new products get a block of consecutive ids in one step. The
+    record is saved once; returns (added, updated).
+    """
+    user_data = get_user_data(user_id)
+    catalog = user_data.setdefault(kind, {})
+    before = len(catalog)
+    if kind == 'products':
+        next_id = user_data.get('last_product_id', 0)
+        new = sum(1 for product_id, _ in entries if product_id not in catalog)
+        user_data['last_product_id'] = next_id + new
+        for product_id, product in entries:
+            if product_id not in catalog:
+                next_id += 1
+                product_id = f"{user_id}-{next_id}"
+            catalog[product_id] = product
+    else:
+        catalog.update(entries)
+    save_user_data(user_id, user_data)
+    search_indexes.invalidate(user_id, kind)
+    added = len(catalog) - before
+    return added, len(entries) - added
+
+
+async def import_command_handler(update, context):
+    user_id = str(update.effective_user.id)
+    update_user_state(user_id, 'awaiting_import_file')
+    await update.message.reply_text(
+        "فایل CSV یا XLSX محصولات یا مشتریان را ارسال کنید. سطر اول نام ستون‌هاست:\n\n"
+        "محصولات: id, name, price (برای محصول جدید id را خالی بگذارید)\n"
+        "مشتریان: code, name, phone, address\n\n"
+        "ردیف‌هایی که شناسه یا کد موجود دارند به‌روزرسانی می‌شوند. "
+        "برای دریافت فهرست فعلی در همین قالب /export را بفرستید."
+    )
+
+
+async def import_document_handler(update, context):
+    user_id = str(update.effective_user.id)
+    document = update.message.document
+    upload = tempfile.SpooledTemporaryFile(CATALOG_SPOOL_BYTES)
+    try:
+        document_file = await document.get_file()
+        await document_file.download_to_memory(out=upload)
+        upload.seek(0)
+        kind, entries, errors = await asyncio.to_thread(parse_catalog_file, upload, document.file_name or '')
+    except CatalogImportError as e:
+        await update.message.reply_text(str(e))
+        return
+    finally:
+        upload.close()
+
+    update_user_state(user_id, 'ready')
+    if errors:
+        more = f"\nو {len(errors) - 20} ردیف دیگر." if len(errors) > 20 else ""
+        await update.message.reply_text("این ردیف‌ها نادیده گرفته شدند:\n" + "\n".join(errors[:20]) + more)
+    if not entries:
+        await update.message.reply_text("هیچ ردیف معتبری در فایل نبود.")
+        return
+    added, updated = apply_catalog_import(user_id, kind, entries)
+    # The whole import is one record, written in a single transaction
+    await asyncio.wrap_future(user_cache.flush(user_id))
+    label = "محصول" if kind == 'products' else "مشتری"
+    await update.message.reply_text(f"{added} {label} جدید اضافه شد و {updated} مورد به‌روزرسانی شد.")
 
 
+async def export_command_handler(update, context):
+    user_id = str(update.effective_user.id)
+    file_format = 'xlsx' if context.args and context.args[0].lower() == 'xlsx' else 'csv'
+    if file_format == 'xlsx' and openpyxl is None:
+        await update.message.reply_text("خروجی XLSX روی سرور در دسترس نیست؛ فایل CSV ارسال می‌شود.")
+    user_data = get_user_data(user_id)
+    kinds = [kind for kind in ('products', 'customers') if user_data.get(kind)]
+    if not kinds:
+        await update.message.reply_text("شما هیچ محصول یا مشتری‌ای ثبت نکرده‌اید.")
+        return
+    for kind in kinds:
+        await send_catalog_file(update.message, user_id, kind, file_format)
+
+
+# مسیریاب پیام‌ها: انتخاب هندلر با یک بار خواندن وضعیت کاربر
+INVALID_INPUT_MESSAGE = "فرمت وارد شده معتبر نیست یا در حال حاضر قابل پردازش نیست."
+
+# Main menu buttons work in every state
+MENU_ACTIONS = {
+    'مشاهده محصولات': view_products,
+    'افزودن محصول': add_product_handler,
+    'صدور فاکتور': generate_invoice,
+    'آپلود لوگوی فروشگاه': prompt_upload_logo_handler,
+    'افزودن آیتم': add_item_handler,
+    'افزودن مشتری': add_customer_handler,
+    'مشاهده مشتریان': view_customers,
+    'انتخاب مشتری': select_customer_handler,
+}
+
+# (state, input kind) -> handler
+STATE_ROUTES = {
+    ('awaiting_store_info', 'text'): handle_store_info,
+    ('adding_product', 'text'): add_product,
+    ('adding_item', 'text'): handle_add_item,
+    ('selecting_product', 'text'): handle_product_selection,
+    ('awaiting_quantity', 'text'): handle_quantity_input,
+    ('adding_customer', 'text'): save_customer,
+    ('selecting_customer', 'text'): save_selected_customer,
+    ('awaiting_import_file', 'document'): import_document_handler,
+    ('awaiting_logo_upload', 'document'): store_logo_handler,
+}
+
+# Inputs handled the same way in every state; the handlers explain what to
+# do when the user is not in the matching state
+INPUT_ROUTES = {
+    'contact': contact_handler,
+    'photo': store_logo_handler,
+    'document': batch_document_handler,
+}
+
+
+def classify_input(message):
+    if message.contact:
+        return 'contact'
+    if message.photo:
+        return 'photo'
+    if message.document:
+        return 'document'
+    if message.text is not None:
+        return 'text'
+    return None
+
+
+def resolve_route(update):
+    message = update.effective_message
+    kind = classify_input(message)
+    if kind == 'text':
+        action = MENU_ACTIONS.get(message.text.strip())
+        if action:
+            return action
+    return STATE_ROUTES.get((get_user_state(update.effective_user.id), kind)) or INPUT_ROUTES.get(kind)
+
+
+# (kind, action) from callback data "kind:action:argument" -> handler(update, context, argument)
+CALLBACK_ROUTES = {
+    ('product', 'pick'): product_pick_callback,
+    ('product', 'page'): product_page_callback,
+    ('product', 'all'): product_all_callback,
+    ('customer', 'pick'): customer_pick_callback,
+    ('customer', 'page'): customer_page_callback,
+    ('customer', 'all'): customer_all_callback,
+    ('invoice', 'confirm'): invoice_confirm_callback,
+    ('invoice', 'cancel'): invoice_cancel_callback,
+    ('list', 'products'): functools.partial(listing_page_callback, 'products'),
+    ('list', 'customers'): functools.partial(listing_page_callback, 'customers'),
+    ('export', 'products'): functools.partial(export_callback, 'products'),
+    ('export', 'customers'): functools.partial(export_callback, 'customers'),
+}
+
+
+def name_update(handler):
+    # Labels the update's timings with the handler that ran it
+    record = current_update.get()
+    if record is not None:
+        record['handler'] = getattr(handler, 'func', handler).__name__
+
+
+async def route_callback(update, context):
+    query = update.callback_query
+    parts = (query.data or '').split(':', 2)
+    handler = CALLBACK_ROUTES.get(tuple(parts[:2])) if len(parts) == 3 else None
+    if handler is None:
+        # Page counters and stale buttons: just stop the client's spinner
+        await query.answer()
+        return
+    name_update(handler)
+    await handler(update, context, parts[2])
+
+
+async def route_message(update, context):
+    handler = resolve_route(update)
+    if handler is None:
+        if update.effective_message.text is not None:
+            await update.effective_message.reply_text(INVALID_INPUT_MESSAGE)
+        return
+    name_update(handler)
+    # State handlers return False when they could not use the input
+    if await handler(update, context) is False:
+        await update.effective_message.reply_text(INVALID_INPUT_MESSAGE)
+
+
+# زمان‌سنجی هر به‌روزرسانی، لاگ ساخت‌یافته و پروفایل نمونه‌برداری از به‌روزرسانی‌های کند
+PROFILE_SLOW_UPDATES = float(os.environ.get('PROFILE_SLOW_UPDATES', 0))  # seconds; 0 disables the profiler
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))  # seconds between stack samples
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+LOOP_LAG_INTERVAL = float(os.environ.get('LOOP_LAG_INTERVAL', 0.5))  # seconds
+
+
+class SlowUpdateProfiler:
+    """
+    Sampling profiler for the event loop thread. While updates are in flight
+    a background thread records the loop's Python stack every
+    PROFILE_INTERVAL; when an update took longer than PROFILE_SLOW_UPDATES,
+    the stacks sampled during it are written to PROFILE_DIR in the folded
+    format flamegraph tools read. Updates share the loop, so the samples show
+    whatever held it during the slow update, which is what needs fixing.
+    """
+
+    def __init__(self, interval, max_samples=20000):
+        self.interval = interval
+        self.samples = deque(maxlen=max_samples)  # (time, folded stack)
+        self.active = 0
+        self.busy = threading.Event()
+        self.loop_thread = None
+        self.thread = None
+
+    def start(self):
+        self.active += 1
+        self.busy.set()
+        if self.thread is None:
+            self.loop_thread = threading.get_ident()
+            self.thread = threading.Thread(target=self.run, name='update-profiler', daemon=True)
+            self.thread.start()
+        return time.perf_counter()
+
+    def stop(self):
+        self.active -= 1
+        if not self.active:
+            self.busy.clear()
+
+    def run(self):
+        while True:
+            self.busy.wait()
+            frame = sys._current_frames().get(self.loop_thread)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            self.samples.append((time.perf_counter(), ';'.join(reversed(stack))))
+            time.sleep(self.interval)
+
+    def collect(self, started, finished):
+        return Counter(stack for sampled_at, stack in list(self.samples) if started <= sampled_at <= finished)
+
+    def dump(self, stacks, name):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        file_path = os.path.join(PROFILE_DIR, f'{name}.folded')
+        with open(file_path, 'w', encoding='utf-8') as file:
+            file.writelines(f'{stack} {count}\n' for stack, count in stacks.most_common())
+        return file_path
+
+
+update_profiler = SlowUpdateProfiler(PROFILE_INTERVAL) if PROFILE_SLOW_UPDATES > 0 else None
+updates_in_flight = 0
+
+
+def update_handler_name(update):
+    # Commands are registered directly; everything else is named by the routers
+    text = update.effective_message.text if update.effective_message else None
+    if text and text.startswith('/'):
+        return text.split()[0].split('@')[0]
+    return 'unrouted'
+
+
+@contextlib.asynccontextmanager
+async def measure_update(update, owner):
+    """Times one update per handler; logs it (METRICS_LOG) and profiles it if it was slow."""
+    global updates_in_flight
+    record = {'handler': update_handler_name(update), 'timings': {}}
+    token = current_update.set(record)
+    updates_in_flight += 1
+    profiled_from = update_profiler.start() if update_profiler else None
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        elapsed = time.perf_counter() - started
+        current_update.reset(token)
+        updates_in_flight -= 1
+        metrics.observe('update_seconds', elapsed, handler=record['handler'])
+        if METRICS_LOG:
+            metrics_logger.info(json.dumps({
+                'event': 'update', 'update_id': update.update_id, 'user': owner, 'handler': record['handler'],
+                'seconds': round(elapsed, 6), 'timings': {name: round(value, 6) for name, value in record['timings'].items()},
+            }, ensure_ascii=False))
+        if update_profiler:
+            update_profiler.stop()
+            if elapsed >= PROFILE_SLOW_UPDATES:
+                stacks = update_profiler.collect(profiled_from, time.perf_counter())
+                name = f"{datetime.now():%Y%m%d-%H%M%S}-{update.update_id}-{record['handler']}"
+                file_path = await asyncio.to_thread(update_profiler.dump, stacks, name)
+                logger.warning("به‌روزرسانی %s (%s) %.2f ثانیه طول کشید؛ پروفایل در %s",
+                               update.update_id, record['handler'], elapsed, file_path)
+
+
+async def monitor_event_loop():
+    # A sleep that wakes up late means the loop was blocked for that long
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        metrics.set('event_loop_lag_seconds', max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL))
+
+
+def collect_gauges():
+    metrics.set('updates_in_flight', updates_in_flight)
+    metrics.set('render_queue_depth', pending_renders)
+    metrics.set('cached_user_records', len(user_cache.records))
+    metrics.set('dirty_user_records', len(user_cache.dirty))
+    metrics.set('active_sessions', len(session_store.sessions))
+    for name, cached in (('shape_text', shape_text), ('adjusted_unit_price', adjusted_unit_price)):
+        info = cached.cache_info()
+        metrics.set('cache_hits', info.hits, cache=name)
+        metrics.set('cache_misses', info.misses, cache=name)
+
+
+async def serve_metrics_request(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)).strip():
+            pass  # Headers are not needed
+        path = request.split()[1].decode() if len(request.split()) > 1 else ''
+        if path.split('?')[0] == '/metrics':
+            collect_gauges()
+            status, body = '200 OK', metrics.render().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server():
+    """Serves http://METRICS_LISTEN:METRICS_PORT/metrics for Prometheus, on the bot's event loop."""
+    server = await asyncio.start_server(serve_metrics_request, METRICS_LISTEN, METRICS_PORT)
+    logger.info("سنجه‌ها روی http://%s:%s/metrics", METRICS_LISTEN, METRICS_PORT)
+    return server
+
+
+# پردازش همزمان پیام‌ها: کاربران مختلف موازی، پیام‌های هر کاربر به ترتیب
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', 256))
+
+
+def update_owner(update):
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs updates from different users concurrently while updates from the
+    same user run one at a time, in the order they arrived.
+    PTB starts update tasks in arrival order and both asyncio.Lock and the
+    semaphore wake waiters first-in first-out, so a per-user lock is enough
+    to keep each user's updates ordered.
+    PTB takes its own semaphore before do_process_update, so it is sized
+    never to block; the max_concurrent_updates slots are taken only once an
+    update holds its user's lock (and, with SHARED_STORAGE, the lease). A
+    user's queued updates therefore hold no slot, and one user flooding the
+    bot occupies a single slot however many updates they send.
+    With SHARED_STORAGE, the user is also leased in the database for the
+    duration of the update, their record and session are re-read first and
+    written through at the end, so replicas never overwrite each other.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(sys.maxsize)
+        self.slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self.user_locks = {}  # owner -> [lock, queued updates]
+
+    async def do_process_update(self, update, coroutine):
+        owner = update_owner(update)
+        if owner is None:
+            async with self.slots:
+                await coroutine
+            return
+        entry = self.user_locks.get(owner)
+        if entry is None:
+            entry = self.user_locks[owner] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                if SHARED_STORAGE:
+                    await self.process_shared(update, owner, coroutine)
+                else:
+                    async with self.slots, measure_update(update, owner):
+                        await user_cache.prefetch(owner)
+                        await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.user_locks[owner]
+
+    async def process_shared(self, update, owner, coroutine):
+        # Waiting for another replica to release the user does not take a slot
+        while not await asyncio.wrap_future(submit_write(try_user_lease, owner, REPLICA_ID, STORAGE_LEASE_TTL)):
+            await asyncio.sleep(0.02)
+        try:
+            async with self.slots, measure_update(update, owner):
+                try:
+                    await user_cache.reload(owner)
+                    await session_store.reload(owner)
+                    await coroutine
+                finally:
+                    await asyncio.wrap_future(user_cache.flush(owner))
+                    await asyncio.wrap_future(session_store.flush(owner))
+        finally:
+            submit_write(release_user_lease, owner, REPLICA_ID)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+async def post_init(application):
+    application.bot_data['flush_task'] = asyncio.create_task(flush_user_data_periodically())
+    application.bot_data['rate_task'] = asyncio.create_task(refresh_rate_periodically())
+    if ARCHIVE_INTERVAL > 0:
+        application.bot_data['archive_task'] = asyncio.create_task(archive_invoices_periodically())
+    application.bot_data['loop_lag_task'] = asyncio.create_task(monitor_event_loop())
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await start_metrics_server()
+
+
+async def post_shutdown(application):
+    for name in ('flush_task', 'rate_task', 'archive_task', 'loop_lag_task'):
+        task = application.bot_data.pop(name, None)
+        if task:
+            task.cancel()
+    server = application.bot_data.pop('metrics_server', None)
+    if server:
+        server.close()
+    # Application.stop() has already waited for in-flight updates; this also
+    # drains renders whose handler gave up waiting (RENDER_TIMEOUT)
+    if pending_renders:
+        logger.info("در انتظار پایان %d فاکتور در حال صدور...", pending_renders)
+    shutdown_render_pool()
+    close_storage()
+
+
+# حالت اجرا: polling (پیش‌فرض) یا webhook
+# توکن بات از BotFather، فقط از متغیر محیطی خوانده می‌شود
+BOT_TOKEN = os.environ.get('BOT_TOKEN')
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')  # e.g. http://127.0.0.1:8081/bot for a local Bot API
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # Public base URL, e.g. https://bot.example.com
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40))
+
+
+def run_webhook(application):
+    """
+    Serves updates from Telegram on an embedded HTTP server (tornado, from
+    python-telegram-bot[webhooks]). TLS is expected to end at a reverse proxy
+    or load balancer in front of WEBHOOK_URL.
+    """
+    webhook_url = None
+    if WEBHOOK_URL:
+        webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH.lstrip('/')}"
+    logger.info("webhook روی %s:%s/%s (نمونه %s)", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, REPLICA_ID)
+    application.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=webhook_url,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+
+
+# تابع اصلی
+def main():
+    if not BOT_TOKEN:
+        raise SystemExit("BOT_TOKEN تنظیم نشده است؛ توکن بات را از BotFather بگیرید و در متغیر محیطی BOT_TOKEN قرار دهید.")
+    init_storage()
+    font_registry.load()  # For PDFs built in this process; render workers load their own
+    if NORMALIZE_LOGOS:
+        normalize_existing_logos()
+
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        file_url = TELEGRAM_API_URL.rsplit('/bot', 1)[0] + '/file/bot'
+        builder = builder.base_url(TELEGRAM_API_URL).base_file_url(file_url)
+    application = builder.build()
+
+    # اضافه کردن هندلرها
+    application.add_handler(CommandHandler("start", start))                         # Start the bot
+    application.add_handler(CommandHandler("batch", batch_command_handler))         # Batch export
+    application.add_handler(CommandHandler("import", import_command_handler))       # Bulk catalog import
+    application.add_handler(CommandHandler("export", export_command_handler))       # Catalog export
+    application.add_handler(CommandHandler("invoices", list_invoices_handler))      # Past invoices
+    application.add_handler(CommandHandler("resend", resend_invoice_handler))       # Resend a past invoice
+    application.add_handler(CommandHandler("rate", rate_command_handler))           # Dollar rate
+    # Everything else goes through the (state, input kind) router
+    application.add_handler(MessageHandler(~filters.COMMAND, route_message))
+    application.add_handler(CallbackQueryHandler(route_callback))               # Inline pickers
+
     # شروع بات
-    application.run_polling()
+    # Both modes stop gracefully on SIGINT/SIGTERM: in-flight updates finish,
+    # then post_shutdown drains the render pool and flushes the user cache;
+    # atexit covers any other exit path.
+    atexit.register(close_storage)
+    if BOT_MODE == 'webhook':
+        run_webhook(application)
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:2] == ['batch']:
+        batch_cli(sys.argv[2:])
+    elif sys.argv[1:2] == ['archive']:
+        archive_cli(sys.argv[2:])
+    else:
+        main()